@@ -0,0 +1,73 @@
+""" Compares the catalog matching of stonesteps/skymatch.py with
+    astropy SkyCoord.match_to_catalog_sky (speed and result).
+
+    Usage:
+        python skymatchbench.py [SIZE ...]
+
+    For each size (default 1e3 1e4 1e5 1e6) a random catalog of SIZE
+    sources in a 2 degree field and a second catalog of the same sources
+    shifted by up to 1 arcsec (plus 10% unrelated sources) are made. The
+    script prints the time of SkyCoord matching and of SkyMatcher (tree,
+    nearest, match within 2 arcsec, one to one within 2 arcsec) and exits
+    with an error if the nearest neighbours of both methods differ.
+"""
+
+import os
+import sys
+import time
+import numpy
+from astropy.coordinates import SkyCoord
+import astropy.units as u
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', 'source'))
+from stonesteps.skymatch import SkyMatcher
+
+radius = 2.0 / 3600. # match radius (degrees)
+
+def catalogs(size, rng):
+    """ Returns the positions of the catalog and of the shifted sources """
+    ra = 150.0 + rng.uniform(-1.0, 1.0, size) / numpy.cos(numpy.radians(30.0))
+    dec = 30.0 + rng.uniform(-1.0, 1.0, size)
+    shift = rng.uniform(0.0, 1.0 / 3600., size)
+    angle = rng.uniform(0.0, 2 * numpy.pi, size)
+    ra2 = ra + shift * numpy.cos(angle) / numpy.cos(numpy.radians(dec))
+    dec2 = dec + shift * numpy.sin(angle)
+    extra = size // 10
+    ra2 = numpy.concatenate((ra2, 150.0 + rng.uniform(-1.0, 1.0, extra) / numpy.cos(numpy.radians(30.0))))
+    dec2 = numpy.concatenate((dec2, 30.0 + rng.uniform(-1.0, 1.0, extra)))
+    return ra, dec, ra2, dec2
+
+def timed(function, *args):
+    """ Returns the result and the run time of function(*args) """
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+if __name__ == '__main__':
+    sizes = [int(float(s)) for s in sys.argv[1:]] or [1000, 10000, 100000, 1000000]
+    rng = numpy.random.default_rng(1)
+    failed = False
+    print('%8s %9s | %9s %9s %9s %9s' % ('size', 'skycoord', 'tree', 'nearest', 'match', 'onetoone'))
+    for size in sizes:
+        ra, dec, ra2, dec2 = catalogs(size, rng)
+        # astropy: the catalog coordinates are made for the match
+        start = time.time()
+        idx, d2d, d3d = SkyCoord(ra2 * u.deg, dec2 * u.deg).match_to_catalog_sky(
+            SkyCoord(ra * u.deg, dec * u.deg))
+        skytime = time.time() - start
+        # skymatch
+        matcher, treetime = timed(SkyMatcher, ra, dec)
+        (ind, sep), neartime = timed(matcher.nearest, ra2, dec2)
+        (first, second, dist), matchtime = timed(matcher.match, ra2, dec2, radius)
+        (first1, second1, dist1), onetime = timed(matcher.onetoone, ra2, dec2, radius)
+        print('%8d %8.3fs | %8.3fs %8.3fs %8.3fs %8.3fs' %
+              (size, skytime, treetime, neartime, matchtime, onetime))
+        # Same nearest neighbours (up to ties) and separations
+        differ = (ind != idx) & (numpy.abs(sep - d2d.deg) > 1e-9)
+        if differ.any() or numpy.max(numpy.abs(sep - d2d.deg)) * 3600. > 1e-6:
+            print('  nearest neighbours differ for %d sources' % differ.sum())
+            failed = True
+        if len(numpy.unique(second1)) != len(second1) or len(numpy.unique(first1)) != len(first1):
+            print('  one to one matches are not unique')
+            failed = True
+        print('  matched %d / %d within 2 arcsec, %d one to one' % (len(first), len(ra2), len(first1)))
+    sys.exit(1 if failed else 0)
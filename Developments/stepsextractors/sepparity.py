@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+""" SEP / SEXTRACTOR PARITY TEST
+
+    Compares the in-memory sep extraction of StepFluxCalSex
+    (extractor = sep, see stonesteps/sepextract.py sexcatalog) with a
+    SExtractor run with the same configuration files on FITS frames
+    (default: the frames in Examples/m57). For each frame the sources
+    are matched by sky position and the following is printed:
+    - number of sources of each backend and of matched sources
+    - median and robust scatter of the FLUX_AUTO and FLUX_APER ratios
+    - median and largest position offset of the calibration stars
+    - median magnitude difference of the S/N > 10 stars used by the
+      calibration, median difference of the background images
+    - PHTZPRAW of StepFluxCalSex with extractor = sep and sextractor
+      (if a pipeline configuration is given)
+    The values are checked against the tolerances below, the script
+    exits with status 1 if any frame is out of tolerance. Needs the sex
+    command and source on the PYTHONPATH. The frames need a WCS for the
+    PHTZPRAW comparison. Run with:
+        python sepparity.py [-config pipeconf.txt] [FITSFILE ...]
+"""
+
+import os # os library
+import sys # sys library
+import glob # to find the frames
+import time # time library
+import tempfile # folder for the SExtractor files
+import subprocess # to run SExtractor
+import numpy # numpy library
+from astropy.io import fits # to read the frames
+from astropy.table import Table # to read the SExtractor catalog
+from astropy.coordinates import SkyCoord # to match the catalogs
+from astropy import wcs # to get the pixel scale
+from astropy.wcs.utils import proj_plane_pixel_scales # pixel scale of a WCS
+import astropy.units as u
+from configobj import ConfigObj # to set the extractor
+from darepype.drp import DataParent # to load the frames
+from stonesteps.sepextract import readsexconfig, readsexfilter, sexcatalog
+from stonesteps.stepfluxcalsex import StepFluxCalSex
+
+# Location of the configuration files and the example frames
+codefolder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+auxfolder = os.path.join(codefolder, 'auxfiles')
+confname = os.path.join(auxfolder, 'sourcextractor_config.sex')
+paramname = os.path.join(auxfolder, 'sourcextractor_params.param')
+filtername = os.path.join(auxfolder, 'sourcextractor_filter.conv')
+
+# Tolerances of sep against SExtractor
+maxratiooffset = {'FLUX_AUTO': 0.02, 'FLUX_APER': 0.01} # |median flux ratio - 1|
+maxratioscatter = {'FLUX_AUTO': 0.03, 'FLUX_APER': 0.02} # robust scatter of the flux ratio
+minmatched = 0.9 # fraction of the SExtractor calibration stars matched by sep
+maxmedianoffset = 0.05 # median position offset of the calibration stars (pixels)
+maxoffset = 0.5 # largest position offset of the calibration stars (pixels)
+maxzpdiff = 0.01 # PHTZPRAW difference (mag)
+
+def runsex(filename, folder):
+    """ Runs SExtractor on a frame like StepFluxCalSex, returns the catalog,
+        the background image and the run time
+    """
+    catname = os.path.join(folder, 'sex_cat.fits')
+    bkgdname = os.path.join(folder, 'SxBkgd.fits')
+    command = 'sex %s -c %s -CATALOG_NAME %s -PARAMETERS_NAME %s -FILTER_NAME %s' % (
+        filename, confname, catname, paramname, filtername)
+    command += ' -CHECKIMAGE_TYPE BACKGROUND -CHECKIMAGE_NAME ' + bkgdname
+    start = time.time()
+    subprocess.run(command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT,
+                   check = True)
+    catalog = Table.read(catname, format = 'fits', hdu = 'LDAC_OBJECTS')
+    background = fits.getdata(bkgdname)
+    return catalog, background, time.time() - start
+
+def robust(values):
+    """ Returns the median and the normalized median absolute deviation
+    """
+    values = values[numpy.isfinite(values)]
+    median = numpy.median(values)
+    return median, 1.4826 * numpy.median(numpy.abs(values - median))
+
+def stars(catalog):
+    """ Returns the selection of the calibration stars (as StepFluxCalSex)
+    """
+    sn = catalog['FLUX_AUTO'] / catalog['FLUXERR_AUTO']
+    return (sn > 10) & (sn < 1000) & ((catalog['FLUX_APER'] - catalog['FLUX_AUTO']) < 250)
+
+def zeropoint(config, filename, extractor):
+    """ Returns PHTZPRAW of StepFluxCalSex on the frame with the extractor
+    """
+    conf = ConfigObj(config)
+    conf['stepcache'] = {'cachefolder': ''}
+    conf['checkpoint'] = {'enabled': False}
+    fcal = conf.setdefault('fluxcalsex', {})
+    fcal['extractor'] = extractor
+    fcal['sx_confilename'] = confname
+    fcal['sx_paramfilename'] = paramname
+    fcal['sx_filterfilename'] = filtername
+    fcal['delete_cat'] = True
+    fcal['fitplot'] = fcal['sourcetable'] = fcal['savebackground'] = False
+    data = DataParent(config = conf).load(filename)
+    return StepFluxCalSex()(data).getheadval('PHTZPRAW')
+
+def compare(filename, config = ''):
+    """ Runs both backends on a frame, prints the comparison and returns
+        the list of values out of tolerance
+    """
+    failed = []
+    image = fits.getdata(filename).astype(float)
+    header = fits.getheader(filename)
+    start = time.time()
+    sepcat, sepmodel = sexcatalog(image, header, readsexconfig(confname), readsexfilter(filtername))
+    septime = time.time() - start
+    sepbkgd = sepmodel.background()
+    with tempfile.TemporaryDirectory() as folder:
+        sexcat, sexbkgd, sextime = runsex(filename, folder)
+    # Match the sources by sky position (1 arcsec)
+    sepsky = SkyCoord(sepcat['ALPHA_J2000'], sepcat['DELTA_J2000'], unit = 'deg')
+    sexsky = SkyCoord(sexcat['ALPHA_J2000'], sexcat['DELTA_J2000'], unit = 'deg')
+    idx, dist, d3d = sepsky.match_to_catalog_sky(sexsky)
+    matched = dist < 1.0 * u.arcsec
+    sep = sepcat[matched]
+    sex = sexcat[idx[matched]]
+    print(os.path.split(filename)[1])
+    print('  sources: sep %d (%.2f s)  sextractor %d (%.2f s)  matched %d' %
+          (len(sepcat), septime, len(sexcat), sextime, matched.sum()))
+    for column in ['FLUX_AUTO', 'FLUX_APER']:
+        median, scatter = robust(numpy.array(sep[column] / sex[column]))
+        print('  %s ratio sep/sextractor: median %.4f scatter %.4f' % (column, median, scatter))
+        if abs(median - 1) > maxratiooffset[column] or scatter > maxratioscatter[column]:
+            failed.append('%s ratio' % column)
+    good = stars(sep) & stars(sex)
+    fraction = good.sum() / max(stars(sexcat).sum(), 1)
+    # Position offsets in pixels (the SExtractor catalog has sky positions only)
+    pixscale = 3600 * numpy.mean(proj_plane_pixel_scales(wcs.WCS(header)))
+    offset = dist[matched][good].arcsec / pixscale
+    if good.sum():
+        print('  calibration stars matched %.1f%%: position offset median %.3f max %.3f pixels' %
+              (100 * fraction, numpy.median(offset), offset.max()))
+    if (fraction < minmatched or not good.sum() or numpy.median(offset) > maxmedianoffset
+        or offset.max() > maxoffset):
+        failed.append('calibration star match')
+    dmag = -2.5 * numpy.log10(numpy.array(sep['FLUX_AUTO'][good] / sex['FLUX_AUTO'][good]))
+    median, scatter = robust(dmag)
+    print('  calibration stars %d: magnitude difference median %.4f scatter %.4f' %
+          (good.sum(), median, scatter))
+    median, scatter = robust((sepbkgd - sexbkgd).ravel())
+    print('  background difference: median %.3f scatter %.3f' % (median, scatter))
+    if len(config):
+        sepzp = zeropoint(config, filename, 'sep')
+        sexzp = zeropoint(config, filename, 'sextractor')
+        print('  PHTZPRAW: sep %.4f sextractor %.4f difference %.4f' %
+              (sepzp, sexzp, sepzp - sexzp))
+        if abs(sepzp - sexzp) > maxzpdiff:
+            failed.append('PHTZPRAW')
+    print('  %s' % ('FAILED: ' + ', '.join(failed) if len(failed) else 'OK'))
+    return failed
+
+if __name__ == '__main__':
+    filenames = sys.argv[1:]
+    config = ''
+    if '-config' in filenames:
+        ind = filenames.index('-config')
+        config = filenames[ind+1]
+        del filenames[ind:ind+2]
+    if not len(filenames):
+        filenames = sorted(glob.glob(os.path.join(codefolder, 'Examples', 'm57', 'm57_*_seo.fits')))
+    failed = [filename for filename in filenames if len(compare(filename, config))]
+    if len(failed):
+        print('FAILED: %d of %d frames out of tolerance' % (len(failed), len(filenames)))
+        sys.exit(1)
+    print('OK: %d frames within tolerance' % len(filenames))
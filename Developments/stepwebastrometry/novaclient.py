@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+""" NOVA CLIENT - Version 1.0.0
+
+    Client for the Astrometry.net web API (nova) which solves a batch of
+    frames at once. AstrometryNet.solve_from_image uploads one frame and
+    waits until its solve is done. NovaClient.solvebatch instead:
+    - submits all frames of the batch concurrently (thread pool)
+    - polls the status of all pending submissions / jobs together, the
+      polling interval grows by 'backoff' up to 'maxinterval'
+    - uploads source lists (X, Y table, brightest first) where available,
+      full images only for frames without sources
+    - keeps the results in a JSON cache file, keyed by the SHA1 hash of
+      the uploaded file and the solve options, so frames which are sent
+      again are not submitted
+
+    API (see http://astrometry.net/doc/net/api.html):
+      api/login, api/upload -> subid, api/submissions/SUBID -> job ids,
+      api/jobs/JOBID -> status, wcs_file/JOBID -> WCS FITS header
+    The local stand-in server novastandin.py emulates this API for tests.
+"""
+
+import io # to read the WCS files
+import os # os library
+import json # JSON library
+import time # time library
+import hashlib # to hash the uploads
+import logging # logging library
+import threading # lock for the cache file
+from concurrent.futures import ThreadPoolExecutor # concurrent requests
+import numpy # numpy library
+import requests # http request library
+from astropy.io import fits # to make upload files and read results
+
+# Default nova API URL
+NOVAURL = 'http://nova.astrometry.net'
+
+# Header keywords which are not copied from the WCS files
+NOWCSKEYS = ['SIMPLE', 'BITPIX', 'NAXIS', 'EXTEND', 'COMMENT', 'HISTORY', '']
+
+# Lock for reading / writing the cache file
+novacachelock = threading.Lock()
+
+log = logging.getLogger('pipe.novaclient')
+
+def sourcefile(x, y, width, height):
+    """ Returns the content of a source list FITS file (X, Y columns, FITS
+        pixel positions starting at 1) for the upload
+    """
+    table = fits.BinTableHDU.from_columns([
+        fits.Column(name = 'X', format = 'E', array = numpy.asarray(x, float) + 1.0),
+        fits.Column(name = 'Y', format = 'E', array = numpy.asarray(y, float) + 1.0)])
+    table.header['IMAGEW'] = width
+    table.header['IMAGEH'] = height
+    content = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), table]).writeto(content)
+    return content.getvalue()
+
+def imagefile(image):
+    """ Returns the content of a FITS image file for the upload
+    """
+    content = io.BytesIO()
+    fits.PrimaryHDU(numpy.asarray(image, dtype = numpy.float32)).writeto(content)
+    return content.getvalue()
+
+class NovaClient(object):
+    """ Astrometry.net API client for batches of frames
+    """
+
+    def __init__(self, apikey, apiurl = NOVAURL, cachefile = '', threads = 4,
+                 interval = 5.0, backoff = 1.5, maxinterval = 60.0, reqtimeout = 60):
+        """ Constructor: set the API key and URL, the cache file (empty for
+            no cache), the number of concurrent requests, the polling
+            intervals (seconds) and the timeout of each request (seconds)
+        """
+        self.apikey = apikey
+        self.apiurl = apiurl.rstrip('/')
+        self.cachefile = os.path.expandvars(cachefile)
+        self.threads = threads
+        self.interval = interval
+        self.backoff = backoff
+        self.maxinterval = maxinterval
+        self.reqtimeout = reqtimeout
+        self.session = None
+        self.http = requests.Session()
+
+    def post(self, service, args, upload = None):
+        """ Sends an API request with the JSON arguments args (and the file
+            content upload), returns the JSON result
+        """
+        data = {'request-json': json.dumps(args)}
+        files = None
+        if upload is not None:
+            files = {'file': ('upload.fits', upload, 'application/octet-stream')}
+        result = self.http.post('%s/api/%s' % (self.apiurl, service), data = data,
+                                files = files, timeout = self.reqtimeout)
+        result.raise_for_status()
+        result = result.json()
+        if result.get('status') == 'error':
+            raise RuntimeError('Nova %s failed: %s' % (service, result.get('errormessage', '')))
+        return result
+
+    def get(self, service):
+        """ Returns the JSON result of an API status request
+        """
+        result = self.http.get('%s/api/%s' % (self.apiurl, service), timeout = self.reqtimeout)
+        result.raise_for_status()
+        return result.json()
+
+    def login(self):
+        """ Logs in with the API key (once)
+        """
+        if self.session is None:
+            self.session = self.post('login', {'apikey': self.apikey})['session']
+            log.debug('Logged in to %s' % self.apiurl)
+        return self.session
+
+    def submit(self, upload, options):
+        """ Uploads a file with the solve options, returns the submission id
+        """
+        args = dict(options)
+        args.update({'session': self.login(), 'publicly_visible': 'n',
+                     'allow_commercial_use': 'n', 'allow_modifications': 'n'})
+        return self.post('upload', args, upload)['subid']
+
+    def poll(self, subid, jobid):
+        """ Returns the state of a submission: 'pending', 'failure' or
+            'success', and the job id (None if the job is not started)
+        """
+        if jobid is None:
+            jobs = [job for job in self.get('submissions/%d' % subid).get('jobs', [])
+                    if job is not None]
+            if not len(jobs):
+                return 'pending', None
+            jobid = jobs[0]
+        status = self.get('jobs/%d' % jobid).get('status', '')
+        if status in ['success', 'failure']:
+            return status, jobid
+        return 'pending', jobid
+
+    def wcsheader(self, jobid):
+        """ Returns the WCS keywords of a solved job (as header)
+        """
+        result = self.http.get('%s/wcs_file/%d' % (self.apiurl, jobid), timeout = self.reqtimeout)
+        result.raise_for_status()
+        with fits.open(io.BytesIO(result.content)) as hdus:
+            return fits.Header([card for card in hdus[0].header.cards
+                                if card.keyword not in NOWCSKEYS])
+
+    def cachekey(self, upload, options):
+        """ Returns the cache key of an upload: hash of the file content and
+            the solve options
+        """
+        sha = hashlib.sha1(upload)
+        sha.update(json.dumps(options, sort_keys = True).encode())
+        return sha.hexdigest()
+
+    def readcache(self):
+        """ Returns the cached results {key: {keyword: [value, comment]}}
+        """
+        if not len(self.cachefile) or not os.path.exists(self.cachefile):
+            return {}
+        with novacachelock:
+            with open(self.cachefile) as f:
+                return json.load(f)
+
+    def writecache(self, results):
+        """ Adds results {key: header} to the cache file
+        """
+        if not len(self.cachefile) or not len(results):
+            return
+        with novacachelock:
+            cache = {}
+            if os.path.exists(self.cachefile):
+                with open(self.cachefile) as f:
+                    cache = json.load(f)
+            for key, header in results.items():
+                cache[key] = {card.keyword: [card.value, card.comment] for card in header.cards}
+            tmpname = self.cachefile + '.tmp'
+            with open(tmpname, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmpname, self.cachefile)
+
+    def solvebatch(self, uploads, timeout = 300):
+        """ Solves a batch of frames. uploads is a list of (file content,
+            solve options) pairs. Returns the list of WCS headers (None for
+            frames which are not solved within timeout seconds).
+        """
+        results = [None] * len(uploads)
+        keys = [self.cachekey(upload, options) for upload, options in uploads]
+        # Use the cached results
+        cache = self.readcache()
+        todo = []
+        for i, key in enumerate(keys):
+            if key in cache:
+                results[i] = fits.Header([(k, v[0], v[1]) for k, v in cache[key].items()])
+                log.debug('Using cached result for upload %d' % i)
+            else:
+                todo.append(i)
+        if not len(todo):
+            return results
+        start = time.time()
+        with ThreadPoolExecutor(max_workers = self.threads) as pool:
+            # Submit all uploads
+            self.login()
+            subids = {}
+            for i, subid in zip(todo, pool.map(lambda i: self.trysubmit(*uploads[i]), todo)):
+                if subid is not None:
+                    subids[i] = subid
+            log.info('Submitted %d uploads in %.1f seconds' % (len(subids), time.time() - start))
+            # Poll all pending submissions together
+            pending = {i: None for i in subids}
+            solved = {}
+            interval = self.interval
+            while len(pending) and time.time() - start < timeout:
+                time.sleep(min(interval, max(0.0, timeout - (time.time() - start))))
+                interval = min(interval * self.backoff, self.maxinterval)
+                order = list(pending)
+                states = pool.map(lambda i: self.trypoll(subids[i], pending[i]), order)
+                for i, (status, jobid) in zip(order, states):
+                    if status == 'pending':
+                        pending[i] = jobid
+                        continue
+                    del pending[i]
+                    if status == 'success':
+                        solved[i] = jobid
+                    else:
+                        log.warning('Nova solve failed for upload %d (job %s)' % (i, jobid))
+            if len(pending):
+                log.warning('Nova timeout for %d uploads after %d seconds' % (len(pending), timeout))
+            # Get the WCS of the solved jobs
+            order = list(solved)
+            headers = pool.map(lambda i: self.trywcsheader(solved[i]), order)
+            newresults = {}
+            for i, header in zip(order, headers):
+                if header is None:
+                    continue
+                results[i] = header
+                newresults[keys[i]] = header
+        self.writecache(newresults)
+        log.info('Solved %d of %d uploads in %.1f seconds' %
+                 (len(newresults), len(todo), time.time() - start))
+        return results
+
+    def trysubmit(self, upload, options):
+        """ Submits an upload, returns None if the submission fails
+        """
+        try:
+            return self.submit(upload, options)
+        except Exception as error:
+            log.warning('Nova upload failed: %s' % str(error))
+            return None
+
+    def trypoll(self, subid, jobid):
+        """ Polls a submission, the submission stays pending if the request
+            fails
+        """
+        try:
+            return self.poll(subid, jobid)
+        except Exception as error:
+            log.debug('Nova status request failed: %s' % str(error))
+            return 'pending', jobid
+
+    def trywcsheader(self, jobid):
+        """ Returns the WCS header of a solved job, None if the download
+            fails
+        """
+        try:
+            return self.wcsheader(jobid)
+        except Exception as error:
+            log.warning('Nova WCS download failed for job %s: %s' % (jobid, str(error)))
+            return None
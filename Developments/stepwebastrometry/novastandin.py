@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+""" NOVA STAND-IN SERVER - Version 1.0.0
+
+    Local HTTP server which emulates the Astrometry.net API (nova) for
+    tests of novaclient.py / StepWebAstrometryBatch without an account
+    or network access:
+    - api/login: any API key is accepted
+    - api/upload: stores the submission, its job starts after 1 second
+    - api/submissions/SUBID, api/jobs/JOBID: job status, a job is solved
+      'delay' seconds after the upload
+    - wcs_file/JOBID: WCS header of the solution
+    Uploads with at least 'minsources' sources (source lists) or any image
+    are solved. The "solution" is a TAN WCS centered on the center_ra /
+    center_dec hint (0 / 0 without hint) with the middle of the scale
+    range, it only tests the protocol. Run with:
+        python novastandin.py [PORT] [DELAY] [MINSOURCES]
+    and set api_url = http://localhost:PORT
+"""
+
+import io # to read uploads and write results
+import sys # sys library
+import json # JSON library
+import time # time library
+import email # to parse multipart uploads
+import threading # lock for the job list
+import urllib.parse # to parse form data
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from astropy.io import fits # to read uploads
+from astropy import wcs # to make solutions
+
+class NovaStandin(object):
+    """ State of the stand-in server: submissions and jobs
+    """
+
+    def __init__(self, delay = 5.0, minsources = 10):
+        """ Constructor: set the solve delay (seconds) and the minimal
+            number of sources of solved source lists
+        """
+        self.delay = delay
+        self.minsources = minsources
+        self.lock = threading.Lock()
+        self.submissions = [] # list of dicts: time, options, solved, wcs
+        self.uploads = 0 # number of uploads (for tests)
+
+    def upload(self, args, content):
+        """ Stores a submission, returns the submission id
+        """
+        solved = True
+        width = args.get('image_width', 0)
+        height = args.get('image_height', 0)
+        with fits.open(io.BytesIO(content)) as hdus:
+            if len(hdus) > 1 and hdus[1].data is not None:
+                solved = len(hdus[1].data) >= self.minsources
+            else:
+                height, width = hdus[0].data.shape
+        scale = 0.5 * (args.get('scale_lower', 1.0) + args.get('scale_upper', 1.0))
+        w = wcs.WCS(naxis = 2)
+        w.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+        w.wcs.crval = [args.get('center_ra', 0.0), args.get('center_dec', 0.0)]
+        w.wcs.crpix = [(width + 1) / 2.0, (height + 1) / 2.0]
+        w.wcs.cd = [[-scale / 3600.0, 0.0], [0.0, scale / 3600.0]]
+        with self.lock:
+            self.submissions.append({'time': time.time(), 'solved': solved,
+                                     'wcs': w.to_header()})
+            self.uploads += 1
+            return len(self.submissions)
+
+    def status(self, subid):
+        """ Returns the job status of a submission: None (no job),
+            'solving', 'success' or 'failure'
+        """
+        sub = self.submissions[subid - 1]
+        age = time.time() - sub['time']
+        if age < min(1.0, self.delay):
+            return None
+        if age < self.delay:
+            return 'solving'
+        return 'success' if sub['solved'] else 'failure'
+
+class NovaHandler(BaseHTTPRequestHandler):
+    """ Request handler: API calls are answered from the server state
+    """
+
+    def log_message(self, format, *args):
+        """ No request log
+        """
+        pass
+
+    def reply(self, content, ctype = 'application/json', code = 200):
+        """ Sends the reply
+        """
+        if not isinstance(content, bytes):
+            content = json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        """ Login and upload
+        """
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        ctype = self.headers.get('Content-Type', '')
+        args = {}
+        content = None
+        if ctype.startswith('multipart/form-data'):
+            message = email.message_from_bytes(('Content-Type: %s\r\n\r\n' % ctype).encode() + body)
+            for part in message.get_payload():
+                if part.get_param('name', header = 'content-disposition') == 'request-json':
+                    args = json.loads(part.get_payload(decode = True))
+                else:
+                    content = part.get_payload(decode = True)
+        else:
+            args = json.loads(urllib.parse.parse_qs(body.decode())['request-json'][0])
+        state = self.server.state
+        if self.path == '/api/login':
+            self.reply({'status': 'success', 'session': 'standin'})
+        elif self.path == '/api/upload' and content is not None:
+            self.reply({'status': 'success', 'subid': state.upload(args, content)})
+        else:
+            self.reply({'status': 'error', 'errormessage': 'unknown request %s' % self.path})
+
+    def do_GET(self):
+        """ Submission and job status, WCS files (job id = submission id)
+        """
+        state = self.server.state
+        parts = self.path.strip('/').split('/')
+        try:
+            number = int(parts[-1])
+            status = state.status(number)
+        except (ValueError, IndexError):
+            self.reply({'status': 'error'}, code = 404)
+            return
+        if parts[:2] == ['api', 'submissions']:
+            self.reply({'jobs': [] if status is None else [number]})
+        elif parts[:2] == ['api', 'jobs']:
+            self.reply({'status': status or 'solving'})
+        elif parts[0] == 'wcs_file' and status == 'success':
+            content = io.BytesIO()
+            fits.PrimaryHDU(header = state.submissions[number - 1]['wcs']).writeto(content)
+            self.reply(content.getvalue(), 'application/fits')
+        else:
+            self.reply({'status': 'error'}, code = 404)
+
+def startserver(port = 8042, delay = 5.0, minsources = 10):
+    """ Starts the server in a thread, returns the server object (stop
+        it with server.shutdown())
+    """
+    server = ThreadingHTTPServer(('localhost', port), NovaHandler)
+    server.state = NovaStandin(delay, minsources)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    return server
+
+if __name__ == '__main__':
+    """ Runs the server: python novastandin.py [PORT] [DELAY] [MINSOURCES]
+    """
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8042
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    minsources = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    server = ThreadingHTTPServer(('localhost', port), NovaHandler)
+    server.state = NovaStandin(delay, minsources)
+    print('Nova stand-in server on http://localhost:%d' % port)
+    server.serve_forever()
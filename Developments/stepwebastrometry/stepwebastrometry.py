@@ -5,6 +5,7 @@
     website Astrometry.net to update the WCS information of the data.
     An API key must be specified in the config file for the upload 
     to work. Files extracted using SExtractor or SEP are supported.
+    StepWebAstrometryBatch solves all frames of a batch at once.
     
     @author: Josh Garza / Prechelt / Berthoud
 """
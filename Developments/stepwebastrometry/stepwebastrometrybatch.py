@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+""" PIPE STEP WEBASTROMETRY BATCH - Version 1.0.0
+
+    Multi-input version of StepWebAstrometry: all frames of the batch are
+    solved on Astrometry.net at once with NovaClient (see novaclient.py)
+    instead of one blocking solve per frame. Source lists are uploaded
+    instead of images: from a source table in the data (SExtractor / SEP
+    X_IMAGE, Y_IMAGE columns) or extracted with sep. Images are only
+    uploaded for frames where no sources are found. Results are cached
+    by upload hash (cachefile).
+
+    Frames which are not solved are removed from the output.
+"""
+
+import os # os library
+import logging # logging object library
+import numpy # numpy library
+from astropy import wcs
+from astropy.coordinates import Angle
+import astropy.units as u
+from darepype.drp import StepMOParent # pipe step parent object
+from stonesteps.sepextract import extract # source extraction
+from stonesteps.wcsmatch import setwcs # WCS keywords
+from novaclient import NovaClient, sourcefile, imagefile # nova API client
+
+class StepWebAstrometryBatch(StepMOParent):
+    """ Pipeline Step Object to solve a batch of frames on Astrometry.net
+    """
+    stepver = '0.1' # pipe step version
+
+    def __init__(self):
+        """ Constructor: Initialize data objects and variables
+        """
+        # call superclass constructor (calls setup)
+        super(StepWebAstrometryBatch,self).__init__()
+        # set configuration
+        self.log.debug('Init: done')
+
+    def setup(self):
+        """ ### Names and Parameters need to be Set Here ###
+            Sets the internal names for the function and for saved files.
+            Defines the input parameters for the current pipe step.
+            Setup() is called at the end of __init__
+            The parameters are stored in a list containing the following
+            information:
+            - name: The name for the parameter. This name is used when
+                    calling the pipe step from command line or python shell.
+                    It is also used to identify the parameter in the pipeline
+                    configuration file.
+            - default: A default value for the parameter. If nothing, set
+                       '' for strings, 0 for integers and 0.0 for floats
+            - help: A short description of the parameter.
+        """
+        ### Set Names
+        # Name of the pipeline reduction step
+        self.name='webastrometrybatch'
+        # Shortcut for pipeline reduction step and identifier for
+        # saved file names.
+        self.procname = 'WCS'
+        # Set Logger for this pipe step
+        self.log = logging.getLogger('pipe.step.%s' % self.name)
+        ### Set Parameter list
+        # Clear Parameter list
+        self.paramlist = []
+        # Append parameters
+        self.paramlist.append(['timeout', 300,
+                               'Timeout for solving the whole batch (seconds)'])
+        self.paramlist.append(['radius', 5.,
+                               'Search within this many degrees of the center RA and Dec'])
+        self.paramlist.append(['scale_lower', 0.5,
+                               'Lower limit of the image scale'])
+        self.paramlist.append(['scale_upper', 2.,
+                               'Upper limit of the image scale'])
+        self.paramlist.append(['scale_units', 'arcsecperpix',
+                               'Image plate scale units'])
+        self.paramlist.append(['api_key', 'XXXXXXXX',
+                               'API key used for interfacing with Astrometry.net'])
+        self.paramlist.append(['api_url', 'http://nova.astrometry.net',
+                               'URL of the Astrometry.net API server'])
+        self.paramlist.append(['threads', 4,
+                               'Number of concurrent uploads / status requests'])
+        self.paramlist.append(['interval', [5.0, 1.5, 60.0],
+                               'Polling interval: first interval (seconds), growth factor, ' +
+                               'maximal interval (seconds)'])
+        self.paramlist.append(['sourcethresh', 5.0,
+                               'Star detection threshold (in background rms) for source lists'])
+        self.paramlist.append(['sourcecount', 300,
+                               'Maximal number of sources (brightest) to upload'])
+        self.paramlist.append(['cachefile', '',
+                               'JSON file to keep the results by upload hash (empty for none)'])
+        # confirm end of setup
+        self.log.debug('Setup: done')
+
+    def run(self):
+        """ Runs the data reduction algorithm. The self.datain is run
+            through the code, the result is in self.dataout.
+        """
+        interval = [float(i) for i in self.getarg('interval')]
+        client = NovaClient(self.getarg('api_key'), self.getarg('api_url'),
+                            self.getarg('cachefile'), int(self.getarg('threads')), *interval)
+        uploads = [self.upload(data) for data in self.datain]
+        headers = client.solvebatch(uploads, self.getarg('timeout'))
+        self.dataout = []
+        for data, header in zip(self.datain, headers):
+            filename = os.path.split(data.filename)[1]
+            if header is None:
+                self.log.warning('No WCS solution for %s - removing file' % filename)
+                continue
+            dataout = data.copy()
+            w = wcs.WCS(header)
+            setwcs(dataout.header, w)
+            # Update RA/Dec from astrometry
+            height, width = dataout.image.shape
+            ra, dec = w.all_pix2world(width / 2.0, height / 2.0, 1)
+            dataout.header['RA'] = Angle(float(ra), u.deg).to_string(unit=u.hour, sep=':')
+            dataout.header['Dec'] = Angle(float(dec), u.deg).to_string(sep=':')
+            self.dataout.append(dataout)
+        if not len(self.dataout):
+            raise RuntimeError('No frame solved by Astrometry.net')
+        self.log.debug('Run: Done')
+
+    def upload(self, data):
+        """ Returns the upload file content and the solve options of a frame
+        """
+        height, width = data.image.shape
+        options = {'scale_lower': self.getarg('scale_lower'),
+                   'scale_upper': self.getarg('scale_upper'),
+                   'scale_units': self.getarg('scale_units'),
+                   'scale_type': 'ul'}
+        try:
+            options['center_ra'] = Angle(data.getheadval('RA'), unit=u.hour).degree
+            options['center_dec'] = Angle(data.getheadval('DEC'), unit=u.deg).degree
+            options['radius'] = self.getarg('radius')
+        except Exception:
+            self.log.debug('No RA/Dec in %s, solving without position' % data.filename)
+        x, y = self.sources(data)
+        if len(x):
+            options.update({'image_width': width, 'image_height': height})
+            return sourcefile(x, y, width, height), options
+        self.log.debug('No sources for %s, uploading the image' % data.filename)
+        return imagefile(data.image), options
+
+    def sources(self, data):
+        """ Returns the source positions (pixels starting at 0, brightest
+            first) from a source table of the data or from source extraction
+        """
+        count = self.getarg('sourcecount')
+        for table in data.tabdata:
+            if table is None or table.dtype.names is None:
+                continue
+            names = table.dtype.names
+            if 'X_IMAGE' in names and 'Y_IMAGE' in names:
+                fluxes = [name for name in ['FLUX_APER', 'FLUX_AUTO', 'FLUX'] if name in names]
+                order = numpy.arange(len(table))
+                if len(fluxes):
+                    order = numpy.argsort(table[fluxes[0]])[::-1]
+                # Table positions are FITS pixels starting at 1
+                return table['X_IMAGE'][order[:count]] - 1.0, table['Y_IMAGE'][order[:count]] - 1.0
+        try:
+            objects = extract(data.image, self.getarg('sourcethresh'), count)
+        except Exception as error:
+            self.log.warning('Source extraction failed: %s' % str(error))
+            return [], []
+        return objects['x'], objects['y']
+
+if __name__ == '__main__':
+    """ Main function to run the pipe step from command line on a file.
+        Command:
+          python stepparent.py input.fits -arg1 -arg2 . . .
+        Standard arguments:
+          --config=ConfigFilePathName.txt : name of the configuration file
+          -t, --test : runs the functionality test i.e. pipestep.test()
+          --loglevel=LEVEL : configures the logging output for a particular level
+          -h, --help : Returns a list of
+    """
+    StepWebAstrometryBatch().execute()
+
+""" === History ===
+2026-10-18  -Initial version, batch solving with NovaClient
+"""
@@ -0,0 +1,164 @@
+""" Compares the photometric calibration of images reduced with
+    workdtype = float32 and workdtype = float64 (see stonesteps/workdtype.py).
+
+    Usage:
+        python dtype_parity.py pipeconf.txt image1.fits image2.fits ...
+            [-wcs solved.fits] [-catstore folder]
+            [-bias mbias.fits -dark mdark.fits -flat mflat.fits]
+
+    Each raw image runs through load -> StepBiasDarkFlat -> StepHotpix ->
+    StepFluxCalSex with both data types. The WCS for StepFluxCalSex is the
+    WCS in the image or, with -wcs, the WCS stored in solved.fits, so
+    StepAstrometry is not needed. Without -bias/-dark/-flat synthetic
+    masters are made in a temporary folder (constant bias below the
+    image minimum, flat with a vignetting and 1% pixel to pixel
+    variations, zero dark or the dark frame given with -dark). StepFluxCalSex uses the sep extractor and the
+    catalog store (-catstore or catstore in the configuration, no queries).
+
+    The float32 result is compared to the float64 result:
+      - PHTZPRAW has to agree within zptolerance (mag)
+      - The Sources magnitudes (matched by position within matchradius)
+        with Magnitude_Err < maxerr have to agree within magtolerance,
+        at least minmatched of the float64 sources have to be matched
+    The script prints the differences and exits with status 1 if any
+    tolerance is exceeded, with status 2 if an image can not be calibrated.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import numpy
+from astropy.io import fits
+from astropy import wcs
+from astropy.coordinates import SkyCoord
+from astropy import units as u
+from configobj import ConfigObj
+from darepype.drp import DataParent
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', 'source'))
+from stonesteps.stepbiasdarkflat import StepBiasDarkFlat
+from stonesteps.stephotpix import StepHotpix
+from stonesteps.stepfluxcalsex import StepFluxCalSex
+from stonesteps.wcsmatch import setwcs
+
+zptolerance = 0.001 # maximal PHTZPRAW difference (mag)
+magtolerance = 0.002 # maximal source magnitude difference (mag)
+maxerr = 0.05 # only compare sources with Magnitude_Err below this (mag)
+minmatched = 0.98 # minimal fraction of matched float64 sources
+matchradius = 1.0 # source match radius (arcsec)
+
+def makemasters(filename, folder, darkfile = ''):
+    """ Writes synthetic bias, dark and flat masters for the image in
+        filename to folder and returns their filenames.
+    """
+    header = fits.getheader(filename)
+    shape = (header['NAXIS2'], header['NAXIS1'])
+    mhead = fits.Header()
+    for key in ['XBIN', 'FILTER', 'DATE-OBS', 'EXPTIME']:
+        if key in header:
+            mhead[key] = header[key]
+    bias = numpy.full(shape, numpy.percentile(fits.getdata(filename), 0.1) - 10,
+                      dtype = numpy.float32)
+    if len(darkfile):
+        dark = fits.getdata(darkfile).astype(numpy.float32)
+        dark -= numpy.percentile(dark, 1)
+        mhead['EXPTIME'] = fits.getheader(darkfile).get('EXPTIME', header['EXPTIME'])
+    else:
+        dark = numpy.zeros(shape, dtype = numpy.float32)
+    yy, xx = numpy.mgrid[:shape[0], :shape[1]]
+    rr = numpy.hypot((yy - shape[0]/2) / shape[0], (xx - shape[1]/2) / shape[1])
+    rng = numpy.random.default_rng(1)
+    flat = 20000.0 * (1 - 0.2*rr**2) * rng.normal(1.0, 0.01, shape)
+    names = []
+    for name, img in [('bias', bias), ('dark', dark), ('flat', flat.astype(numpy.float32))]:
+        names.append(os.path.join(folder, 'synthetic_M%s.fits' % name.upper()))
+        fits.writeto(names[-1], img, mhead, overwrite = True)
+    return names
+
+def calibrate(config, filename, dtype, masters, wcsfile, catstore):
+    """ Returns PHTZPRAW and the Sources table of the image calibrated
+        with the given working data type
+    """
+    conf = ConfigObj(config)
+    conf['data']['workdtype'] = dtype
+    # Don't use the step cache or checkpoints
+    conf['stepcache'] = {'cachefolder': ''}
+    conf['checkpoint'] = {'enabled': False}
+    bdf = conf.setdefault('biasdarkflat', {})
+    bdf['biasfile'], bdf['darkfile'], bdf['flatfile'] = masters
+    bdf['biasfitkeys'] = bdf['darkfitkeys'] = bdf['flatfitkeys'] = ['XBIN']
+    fcal = conf.setdefault('fluxcalsex', {})
+    auxfolder = os.path.join(os.path.dirname(__file__), '..', '..', 'auxfiles')
+    fcal['extractor'] = 'sep'
+    fcal['sx_confilename'] = os.path.join(auxfolder, 'sourcextractor_config.sex')
+    fcal['sx_paramfilename'] = os.path.join(auxfolder, 'sourcextractor_params.param')
+    fcal['sx_filterfilename'] = os.path.join(auxfolder, 'sourcextractor_filter.conv')
+    fcal['catstore'] = catstore
+    fcal['catfetch'] = False
+    fcal['fitplot'] = fcal['sourcetable'] = fcal['savebackground'] = False
+    data = DataParent(config = conf).load(filename)
+    data = StepBiasDarkFlat()(data)
+    data = StepHotpix()(data)
+    if len(wcsfile):
+        setwcs(data.header, wcs.WCS(fits.getheader(wcsfile)))
+    data = StepFluxCalSex()(data)
+    return data.getheadval('PHTZPRAW'), data.tableget('Sources')
+
+def compare(zp64, src64, zp32, src32):
+    """ Returns the PHTZPRAW difference, the largest source magnitude
+        difference and the fraction of matched sources
+    """
+    good = src64['Magnitude_Err'] < maxerr
+    src64 = src64[good]
+    pos64 = SkyCoord(src64['RA'], src64['Dec'], unit = 'deg')
+    pos32 = SkyCoord(src32['RA'], src32['Dec'], unit = 'deg')
+    ind, sep, _ = pos64.match_to_catalog_sky(pos32)
+    matched = sep < matchradius * u.arcsec
+    dmag = numpy.abs(src32['Magnitude'][ind[matched]] - src64['Magnitude'][matched])
+    return (abs(zp32 - zp64), dmag.max() if len(dmag) else numpy.inf,
+            matched.sum() / max(len(src64), 1), len(src64))
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    opts = {'-wcs': '', '-catstore': '', '-bias': '', '-dark': '', '-flat': ''}
+    for opt in opts:
+        if opt in args:
+            ind = args.index(opt)
+            opts[opt] = args[ind+1]
+            del args[ind:ind+2]
+    config, filenames = args[0], args[1:]
+    catstore = opts['-catstore'] or ConfigObj(config).get('fluxcalsex', {}).get('catstore', '')
+    tempfolder = tempfile.mkdtemp(prefix = 'dtypeparity')
+    failed = error = False
+    try:
+        for filename in filenames:
+            if len(opts['-bias']) and len(opts['-flat']):
+                masters = [opts['-bias'], opts['-dark'], opts['-flat']]
+            else:
+                masters = makemasters(filename, tempfolder, opts['-dark'])
+            try:
+                zp64, src64 = calibrate(config, filename, 'float64', masters,
+                                        opts['-wcs'], catstore)
+                zp32, src32 = calibrate(config, filename, 'float32', masters,
+                                        opts['-wcs'], catstore)
+            except Exception as exc:
+                print('%s: calibration failed - %s' % (os.path.split(filename)[1], exc))
+                error = True
+                continue
+            dzp, dmag, frac, nsrc = compare(zp64, src64, zp32, src32)
+            ok = dzp <= zptolerance and dmag <= magtolerance and frac >= minmatched
+            failed = failed or not ok
+            print('%s: PHTZPRAW %.4f / %.4f (delta %.1e), %d sources, %.1f%% matched, '
+                  'max delta mag %.1e - %s' % (os.path.split(filename)[1], zp64, zp32,
+                  dzp, nsrc, 100*frac, dmag, 'OK' if ok else 'FAILED'))
+    finally:
+        shutil.rmtree(tempfolder)
+    print('Tolerances: PHTZPRAW %.1e mag, sources %.1e mag (Magnitude_Err < %.2f), '
+          '%.0f%% matched within %.1f arcsec' % (zptolerance, magtolerance, maxerr,
+          100*minmatched, matchradius))
+    if failed:
+        print('FAILED')
+        sys.exit(1)
+    if error:
+        sys.exit(2)
+    print('OK')
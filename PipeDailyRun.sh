@@ -5,7 +5,9 @@
 #
 # Script to automatically run pipeline services. The following things are run:
 #   * Make master bias / darks / flats
+#   * Fill the catalog store for today's targets
 #   * Run all of today's data by using PipeExecuteAutoDay
+#   * Add today's calibrated sources to the photometry archive
 
 ### Setup
 export PATH=/usr/lib64/qt-3.3/bin:/usr/local/bin:/bin:/usr/bin:/usr/local/sbin:/usr/sbin:/sbin:$HOME/bin:$PATH
@@ -19,5 +21,11 @@ cd /data/scripts/DataReduction
 /usr/local/bin/python3 $DRPath/drp/pipeline.py --loglevel DEBUG --logfile PipeLineLog.txt --pipemode masterdark pipeconf_stonedge_auto.txt >> AstroLog.txt 2>&1
 /usr/local/bin/python3 $DRPath/drp/pipeline.py --loglevel DEBUG --logfile PipeLineLog.txt --pipemode masterflat pipeconf_stonedge_auto.txt >> AstroLog.txt 2>&1
 
+### Fill the catalog store for today's targets
+/usr/local/bin/python3 source/stonesteps/catalogstore.py $SEO_AUXFOLDER/catstore /data/images/StoneEdge/0.5meter/$(date +%Y)/$(date +%Y-%m-%d) >> AstroLog.txt 2>&1
+
 ### Run Pipeline
-./PipeExecuteAutoDay.py >> AstroLog.txt 2>&1
+./PipeExecuteAutoDay.py --render-plots >> AstroLog.txt 2>&1
+
+### Add today's calibrated sources to the photometry archive
+/usr/local/bin/python3 source/stonesteps/photarchive.py ingest /data/images/StoneEdge/0.5meter/photarchive /data/images/StoneEdge/0.5meter/$(date +%Y)/$(date +%Y-%m-%d) >> AstroLog.txt 2>&1
@@ -19,6 +19,7 @@
 
 import os
 import sys
+import argparse
 import logging
 import traceback
 import datetime
@@ -36,7 +37,10 @@ log.info('Starting up')
 # Change directory & import the pipeline settings
 #sys.path.append('/Users/atreyopal/Desktop/pipeline/source/')
 sys.path.append('/data/scripts/DataReduction/source/')
+from configobj import ConfigObj
 from darepype.drp.pipeline import PipeLine
+from stonesteps.steploadprefetch import StepLoadPrefetch
+from stonesteps.plotrender import findplots, renderall
 
 today = datetime.date.today()
 year = str(today.year)
@@ -53,19 +57,42 @@ date = year + '-' + month + '-' + day
 datefilepath = '/data/images/StoneEdge/0.5meter/'+year+'/'+date
 
 def execute():
+    # Read the command line arguments
+    parser = argparse.ArgumentParser(description = 'Run the pipeline on all object folders of a night')
+    parser.add_argument('topdirectory', nargs = '?', default = datefilepath,
+                        help = 'folder with the object folders (default: folder of today)')
+    parser.add_argument('--checkpoint', dest = 'checkpoint', action = 'store_true',
+                        help = 'record completed steps of each file (saves the step '
+                               'products), steps already done are not run again')
+    parser.add_argument('--restart-from', dest = 'restartfrom', default = '',
+                        help = 'run all steps again from this step on (ex. StepAstrometry), '
+                               'steps before are loaded from their checkpoints (implies '
+                               '--checkpoint)')
+    parser.add_argument('--render-plots', dest = 'renderplots', action = 'store_true',
+                        help = 'render the saved plot data of the night (ex. FluxCalSex '
+                               'fit plots) to png files after the reduction')
+    parser.add_argument('--plot-processes', dest = 'plotprocesses', type = int, default = None,
+                        help = 'number of processes to render the plots (default: number of CPUs)')
+    args = parser.parse_args()
+    print(sys.argv)
     # Call the pipeline configuration
-    #pipe = PipeLine(config = '/Users/atreyopal/Desktop/pipeline/pipeconf_stonedge_remote.txt')
-    pipe = PipeLine(config = '/data/scripts/DataReduction/pipeconf_stonedge_auto.txt')
+    #config = ConfigObj('/Users/atreyopal/Desktop/pipeline/pipeconf_stonedge_remote.txt')
+    config = ConfigObj('/data/scripts/DataReduction/pipeconf_stonedge_auto.txt')
+    if args.checkpoint or len(args.restartfrom):
+        if 'checkpoint' not in config:
+            config['checkpoint'] = {}
+        config['checkpoint']['enabled'] = True
+    if len(args.restartfrom):
+        config['checkpoint']['restartfrom'] = args.restartfrom
+        log.info('Restarting from step %s' % args.restartfrom)
+    pipe = PipeLine(config = config)
     # This version only needs to be executed from a terminal. A specific image folder
     # (like the ones on the stars base) is specified for the pipeline.  The pipeline
     # will look in the folder and find any of the sub-folders that contain the FITS images.
     # It will then automatically take the files it finds and run them through the pipeline.
-    print(sys.argv)
-    if len(sys.argv) > 1:
-        # Load the specified directory -- entered as the second argument in the terminal command
-        topdirectory = str(sys.argv[1])
-    else:
-        topdirectory = datefilepath
+    # Steps which are already done for an image (see StepCheckpoint) are not run again
+    # (with --checkpoint or --restart-from).
+    topdirectory = args.topdirectory
     # Load a list of everything in the specified directory.
     rawlist = os.listdir(topdirectory)
     objectlist = []
@@ -75,8 +102,8 @@ def execute():
         if not '.' in Object:            # This line makes sure to exlude any stray files
             objectlist.append(Object)
     log.info('Object list = %s' %repr(objectlist))
-    # Run this loop for each object folder ('entry') found in objectlist
-    # THIS IS THE MAIN LOOP OVER ALL OBSERVED OBJECTS
+    # Make the list of images for each object folder ('entry') found in objectlist
+    objectimages = []
     for entry in objectlist:
         # The empty list is created here so that it keeps getting rewritten for the pipeline
         imagelist = []
@@ -102,6 +129,14 @@ def execute():
         if len(imagelist) == 0 :
             log.warning('Image List is Empty, skipping object = %s' % entry)
             continue
+        objectimages.append((entry, imagelist))
+    # Give all images of the night to the prefetcher, so the next file (also
+    # from the next object) is loaded while the pipeline reduces the current one
+    StepLoadPrefetch.setfilelist([image for entry, imagelist in objectimages
+                                  for image in imagelist])
+    # Run this loop for each object folder with images
+    # THIS IS THE MAIN LOOP OVER ALL OBSERVED OBJECTS
+    for entry, imagelist in objectimages:
         # Now the program will run the files placed in imagelist through the pipeline.
         # It will do this for every entry in objectlist (i.e. for every object)
         pipe.reset()
@@ -121,6 +156,11 @@ def execute():
             except Exception as f:
                 log.warning('Unable to print traceback')
                 print(traceback.format_exc(),trb)
+    # Render the plots of the night in batch (off the per-frame path)
+    if args.renderplots:
+        plotfiles = findplots([topdirectory])
+        rendered = renderall(plotfiles, args.plotprocesses)
+        log.info('Rendered %d of %d plots' % (rendered, len(plotfiles)))
 
 
 # Run the setup code in an error with reporting traceback
@@ -141,6 +181,13 @@ except Exception as e:
 
 ''' 
 HISTORY:
+2026/10/18: Added --render-plots option to render the saved plot data of the
+            night after the reduction (see stonesteps/plotrender.py)
+2026/10/18: Arguments are read with argparse, added --checkpoint option to
+            record completed steps and --restart-from option to run the
+            steps again from a given step (see StepCheckpoint)
+2026/10/18: Image lists for all objects are made first and handed to
+            StepLoadPrefetch, which loads the next file in the background
 2017/06/23: This version processes all inputs into the pipeine instead of just 3
             inputs, so StepMakeRGB can get the desired  3 best inputs for a jpg
             image -- Atreyo Pal
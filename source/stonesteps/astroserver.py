@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+""" ASTROMETRY SOLVER SERVER - Version 1.0.0
+
+    Each solve-field call is a new process which loads the astrometry.net
+    index files again, for a night of frames this takes most of the
+    astrometry time. This module runs a solver server which loads the
+    index files once and keeps them in memory, and it has the client
+    functions used by StepAstrometry (parameter serverdir).
+
+    The server uses the astrometry python package (python bindings of the
+    astrometry.net solver, pip install astrometry) and solves source
+    lists (see sepextract.py) in several threads at the same time. The
+    server and its clients communicate through a job directory:
+    - the client writes JOBID.job: a JSON file with the source positions
+      (pixels, starting at 0, brightest first), the image size, the pixel
+      scale range (arcsec/pixel) and optionally the search position
+    - the server renames the job to JOBID.run, solves it and writes
+      JOBID.result: a JSON file with success, the solve time and the WCS
+      header keywords {keyword: [value, comment]}
+    - the server writes heartbeat.json every HEARTBEAT seconds with its
+      host, process id, number of index files and waiting jobs. Clients
+      only send jobs if the heartbeat is recent (serverhealthy), else
+      StepAstrometry runs astrocmd as usual.
+    Start the server (for example at the beginning of the night) with:
+        python astroserver.py JOBDIR INDEXDIR [THREADS]
+    INDEXDIR is the folder with the index-*.fits files.
+"""
+
+import os # os library
+import sys # sys library
+import json # job and result files
+import glob # to find jobs and index files
+import time # time library
+import uuid # job ids
+import socket # host name
+import logging # logging library
+import pathlib # path objects for the astrometry package
+import threading # lock for the job counters
+from concurrent.futures import ThreadPoolExecutor # solver threads
+
+# Seconds between two heartbeats of the server
+HEARTBEAT = 5.0
+# Name of the heartbeat file in the job directory
+HEARTBEATFILE = 'heartbeat.json'
+# Seconds after which results nobody collected are removed
+RESULTAGE = 3600.0
+
+log = logging.getLogger('pipe.astroserver')
+
+def writejson(filename, content):
+    """ Writes content to a JSON file (the file appears complete or not
+        at all)
+    """
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump(content, f)
+    os.replace(tmpname, filename)
+
+def serverhealthy(jobdir, maxage = 3 * HEARTBEAT):
+    """ Returns True if a server is running for jobdir: the heartbeat is
+        not older than maxage seconds and, if the server runs on this
+        host, its process exists.
+    """
+    try:
+        with open(os.path.join(jobdir, HEARTBEATFILE)) as f:
+            heartbeat = json.load(f)
+    except (IOError, ValueError):
+        return False
+    if time.time() - heartbeat.get('time', 0) > maxage:
+        return False
+    if heartbeat.get('host') == socket.gethostname():
+        try:
+            os.kill(heartbeat['pid'], 0)
+        except OSError:
+            return False
+    return heartbeat.get('indexes', 0) > 0
+
+def submitjob(jobdir, stars, width, height, scalelow, scalehigh,
+              ra = None, dec = None, radius = None, siporder = 3):
+    """ Sends a solve job to the server and returns the job id
+        - stars: list of [x, y] source positions (brightest first)
+        - width, height: image size (pixels)
+        - scalelow, scalehigh: pixel scale range (arcsec/pixel)
+        - ra, dec, radius: search position and radius (degrees), optional
+    """
+    jobid = uuid.uuid4().hex
+    job = {'stars': [[float(x), float(y)] for x, y in stars],
+           'width': int(width), 'height': int(height),
+           'scalelow': float(scalelow), 'scalehigh': float(scalehigh),
+           'siporder': int(siporder)}
+    if ra is not None and dec is not None:
+        job.update({'ra': float(ra), 'dec': float(dec), 'radius': float(radius)})
+    writejson(os.path.join(jobdir, jobid + '.job'), job)
+    return jobid
+
+def waitresult(jobdir, jobid, timeout):
+    """ Waits for the result of a job and returns it as dictionary (see
+        above). Returns None if there is no result after timeout seconds
+        or the server stopped, the job is removed if it has not started.
+    """
+    resultname = os.path.join(jobdir, jobid + '.result')
+    start = time.time()
+    while time.time() - start < timeout:
+        if os.path.exists(resultname):
+            try:
+                with open(resultname) as f:
+                    result = json.load(f)
+            except (IOError, ValueError):
+                result = None
+            os.remove(resultname)
+            return result
+        if not serverhealthy(jobdir):
+            break
+        time.sleep(0.2)
+    try:
+        os.remove(os.path.join(jobdir, jobid + '.job'))
+    except OSError:
+        pass
+    return None
+
+class AstroServer(object):
+    """ Solver server: solves the jobs in the job directory with the
+        index files loaded at start
+    """
+
+    def __init__(self, jobdir, indexfiles, threads = 2):
+        """ Constructor: loads the index files
+        """
+        # Import here, the package is only needed to run the server
+        import astrometry
+        self.astrometry = astrometry
+        self.jobdir = jobdir
+        self.indexfiles = indexfiles
+        self.threads = threads
+        start = time.time()
+        self.solver = astrometry.Solver([pathlib.Path(f) for f in indexfiles])
+        log.info('Loaded %d index files in %.1f seconds' % (len(indexfiles), time.time() - start))
+        self.waiting = 0
+        self.solved = 0
+        self.countlock = threading.Lock()
+
+    def heartbeat(self):
+        """ Writes the heartbeat file
+        """
+        writejson(os.path.join(self.jobdir, HEARTBEATFILE),
+                  {'host': socket.gethostname(), 'pid': os.getpid(),
+                   'time': time.time(), 'indexes': len(self.indexfiles),
+                   'threads': self.threads, 'waiting': self.waiting,
+                   'solved': self.solved})
+
+    def solvejob(self, jobid):
+        """ Solves the job jobid and writes its result
+        """
+        runname = os.path.join(self.jobdir, jobid + '.run')
+        result = {'success': False, 'time': 0.0}
+        start = time.time()
+        try:
+            with open(runname) as f:
+                job = json.load(f)
+            sizehint = self.astrometry.SizeHint(lower_arcsec_per_pixel = job['scalelow'],
+                                                upper_arcsec_per_pixel = job['scalehigh'])
+            positionhint = None
+            if 'ra' in job:
+                positionhint = self.astrometry.PositionHint(ra_deg = job['ra'],
+                                                            dec_deg = job['dec'],
+                                                            radius_deg = job['radius'])
+            params = self.astrometry.SolutionParameters(sip_order = job['siporder'],
+                                                        solve_id = jobid)
+            solution = self.solver.solve(stars = job['stars'], size_hint = sizehint,
+                                         position_hint = positionhint,
+                                         solution_parameters = params)
+            if solution.has_match():
+                match = solution.best_match()
+                result['success'] = True
+                result['wcs'] = {key: [value[0], value[1]]
+                                 for key, value in match.wcs_fields.items()}
+                result['logodds'] = match.logodds
+                result['scale'] = match.scale_arcsec_per_pixel
+                result['index'] = os.path.split(str(match.index_path))[1]
+        except Exception as error:
+            log.warning('Job %s failed: %s' % (jobid, str(error)))
+            result['error'] = str(error)
+        result['time'] = time.time() - start
+        writejson(os.path.join(self.jobdir, jobid + '.result'), result)
+        try:
+            os.remove(runname)
+        except OSError:
+            pass
+        with self.countlock:
+            self.waiting -= 1
+            self.solved += 1
+        log.info('Job %s: success = %s (%.1f seconds)' % (jobid, result['success'], result['time']))
+
+    def serve(self):
+        """ Runs the server until it is stopped
+        """
+        executor = ThreadPoolExecutor(max_workers = self.threads)
+        lastbeat = 0.0
+        try:
+            while True:
+                now = time.time()
+                if now - lastbeat > HEARTBEAT:
+                    self.heartbeat()
+                    lastbeat = now
+                    # Remove results which were not collected
+                    for resultname in glob.glob(os.path.join(self.jobdir, '*.result')):
+                        try:
+                            if now - os.path.getmtime(resultname) > RESULTAGE:
+                                os.remove(resultname)
+                        except OSError:
+                            pass
+                for jobname in sorted(glob.glob(os.path.join(self.jobdir, '*.job')),
+                                      key = os.path.getmtime):
+                    jobid = os.path.split(jobname)[1][:-4]
+                    # Claim the job (fails if the client removed it)
+                    try:
+                        os.rename(jobname, os.path.join(self.jobdir, jobid + '.run'))
+                    except OSError:
+                        continue
+                    with self.countlock:
+                        self.waiting += 1
+                    executor.submit(self.solvejob, jobid)
+                time.sleep(0.1)
+        finally:
+            try:
+                os.remove(os.path.join(self.jobdir, HEARTBEATFILE))
+            except OSError:
+                pass
+            executor.shutdown(wait = False)
+
+if __name__ == '__main__':
+    """ Runs the server: python astroserver.py JOBDIR INDEXDIR [THREADS]
+    """
+    if len(sys.argv) < 3:
+        print('Usage: python astroserver.py JOBDIR INDEXDIR [THREADS]')
+        sys.exit(1)
+    logging.basicConfig(level = logging.INFO,
+                        format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    jobdir = os.path.expandvars(sys.argv[1])
+    if not os.path.exists(jobdir):
+        os.makedirs(jobdir)
+    indexfiles = sorted(glob.glob(os.path.join(os.path.expandvars(sys.argv[2]), 'index-*.fits')))
+    if not len(indexfiles):
+        print('No index-*.fits files in %s' % sys.argv[2])
+        sys.exit(1)
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else (os.cpu_count() or 1)
+    AstroServer(jobdir, indexfiles, threads).serve()
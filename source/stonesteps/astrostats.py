@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+""" ASTROMETRY STATISTICS - Version 1.0.0
+
+    This module keeps a record of which astrometry options solved which
+    kind of frame. Frames are grouped by binning, filter, exposure time
+    and star density (see framestats.py). For each group, the store holds
+    the number of tries, successes and the total solve time for each
+    option (a downsample / paramoptions combination).
+
+    StepAstrometry uses the store to try the options which solved
+    similar frames fastest first. The store is a small JSON file, the
+    statistics can be printed with:
+        python astrostats.py astrostats.json
+    FailRecord keeps the fields which failed to solve in each night, so
+    StepAstrometry can give up sooner on fields which failed before.
+"""
+
+import os # os library
+import sys # sys library
+import json # to store the statistics
+import math # math library
+import threading # lock for the store
+
+# Lock for reading / writing the statistics file
+statslock = threading.Lock()
+
+def densitybucket(density):
+    """ Returns the density group for a star density (stars per million
+        pixels): groups are factors of 2 wide.
+    """
+    return int(math.log(density + 1.0, 2))
+
+def statskey(xbin, filt, exptime, density):
+    """ Returns the group key for a frame
+    """
+    try:
+        exptime = '%g' % float(exptime)
+    except (TypeError, ValueError):
+        exptime = str(exptime)
+    return 'XBIN=%s|FILTER=%s|EXPTIME=%s|DENSITY=%d' % (xbin, filt, exptime,
+                                                        densitybucket(density))
+
+def optionkey(downsample, paramoption):
+    """ Returns the key for an astrometry option
+    """
+    return '%s|%s' % (downsample, paramoption)
+
+class AstroStats(object):
+    """ Store of astrometry statistics in a JSON file:
+        {group key: {'frames': N, 'firsthits': N,
+                     'options': {option key: {'tries': N, 'successes': N,
+                                              'time': seconds}}}}
+    """
+
+    def __init__(self, filename):
+        """ Constructor: set the file name
+        """
+        self.filename = os.path.expandvars(filename)
+
+    def read(self):
+        """ Returns the statistics from the file
+        """
+        if not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write(self, stats):
+        """ Writes the statistics to the file
+        """
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(stats, f, indent = 1)
+        os.replace(tmpname, self.filename)
+
+    def order(self, key, combinations):
+        """ Returns the (downsample, paramoption) combinations sorted for
+            the frame group key: options which have solved frames of this
+            group come first (fastest average solve time first), followed
+            by untried options and options which only failed. Options in
+            the same class keep the order given.
+        """
+        with statslock:
+            options = self.read().get(key, {}).get('options', {})
+        def rank(combination):
+            entry = options.get(optionkey(*combination))
+            if entry is None:
+                return (1, 0.0)
+            if entry['successes'] > 0:
+                return (0, entry['time'] / entry['successes'])
+            return (2, 0.0)
+        return sorted(combinations, key = rank)
+
+    def record(self, key, results, firsthit):
+        """ Adds the results for a frame of group key
+            - results: list of (downsample, paramoption, success, seconds)
+            - firsthit: flag if the first option tried was successful
+        """
+        with statslock:
+            stats = self.read()
+            group = stats.setdefault(key, {'frames': 0, 'firsthits': 0, 'options': {}})
+            group['frames'] += 1
+            group['firsthits'] += int(bool(firsthit))
+            for downsample, paramoption, success, seconds in results:
+                entry = group['options'].setdefault(optionkey(downsample, paramoption),
+                                                    {'tries': 0, 'successes': 0, 'time': 0.0})
+                entry['tries'] += 1
+                if success:
+                    entry['successes'] += 1
+                    entry['time'] += seconds
+            self.write(stats)
+
+    def report(self):
+        """ Returns the statistics as a text table
+        """
+        with statslock:
+            stats = self.read()
+        lines = []
+        frames = sum(g['frames'] for g in stats.values())
+        firsthits = sum(g['firsthits'] for g in stats.values())
+        if frames:
+            lines.append('All groups: %d frames, first option solved %d (%.0f%%)' %
+                         (frames, firsthits, 100.0 * firsthits / frames))
+        for key in sorted(stats):
+            group = stats[key]
+            lines.append('%s: %d frames, first option solved %d (%.0f%%)' %
+                         (key, group['frames'], group['firsthits'],
+                          100.0 * group['firsthits'] / max(1, group['frames'])))
+            for option, entry in sorted(group['options'].items()):
+                meantime = entry['time'] / entry['successes'] if entry['successes'] else 0.0
+                lines.append('    %-50s tries %4d  solved %4d (%3.0f%%)  mean time %6.1fs' %
+                             (option, entry['tries'], entry['successes'],
+                              100.0 * entry['successes'] / max(1, entry['tries']), meantime))
+        return '\n'.join(lines)
+
+class FailRecord(object):
+    """ Record of the fields which failed to solve in each night, in a
+        JSON file: {night: {field key: number of failures}}. Only the
+        last 'keepnights' nights are kept.
+    """
+
+    def __init__(self, filename, keepnights = 10):
+        """ Constructor: set the file name
+        """
+        self.filename = os.path.expandvars(filename)
+        self.keepnights = keepnights
+
+    def read(self):
+        """ Returns the record from the file
+        """
+        if not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def count(self, night, field):
+        """ Returns the number of failures of field in night
+        """
+        with statslock:
+            return self.read().get(night, {}).get(field, 0)
+
+    def add(self, night, field):
+        """ Adds a failure of field in night
+        """
+        with statslock:
+            record = self.read()
+            fields = record.setdefault(night, {})
+            fields[field] = fields.get(field, 0) + 1
+            for old in sorted(record)[:-self.keepnights]:
+                del record[old]
+            tmpname = self.filename + '.tmp'
+            with open(tmpname, 'w') as f:
+                json.dump(record, f, indent = 1)
+            os.replace(tmpname, self.filename)
+
+if __name__ == '__main__':
+    """ Prints the statistics in the file given as argument
+    """
+    if len(sys.argv) < 2:
+        print('Usage: python astrostats.py astrostats.json')
+        sys.exit(1)
+    print(AstroStats(sys.argv[1]).report())
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+""" BACKGROUND MODEL - Version 1.0.0
+
+    Low resolution background model of an image, like the SExtractor /
+    sep background: the image is split into meshes of meshsize pixels,
+    the background (clipped mode) and rms of each mesh are estimated and
+    the mesh grids are median filtered. Only these small grids are kept.
+    The full resolution background and rms surfaces are made when they
+    are needed by bicubic (natural cubic spline) interpolation between
+    the mesh centers, vectorized over whole rows and columns.
+
+    BkgModel.store() attaches the grids to a DataFits object as the small
+    image BKGMESH (background and rms grid, mesh and image size in the
+    header), BkgModel.load() reads them back. So steps can use the model
+    of a previous step instead of estimating the background again:
+    StepHotpix (hot pixel threshold from the local rms), StepFluxCalSex
+    (background subtraction, stored model is scaled with the image) and
+    StepRGB (minimum scaling from the background level).
+"""
+
+import numpy # numpy library
+from astropy.io import fits # mesh image header
+from scipy.ndimage import median_filter # to filter the mesh grids
+from scipy.interpolate import CubicSpline # to interpolate the mesh grids
+
+# Name of the mesh grid image in the data
+BKGIMAGENAME = 'BKGMESH'
+
+def meshstats(image, meshsize = 64, mask = None, nsigma = 3.0, maxiter = 10):
+    """ Returns the background (clipped mode) and rms grids of image for
+        meshes of meshsize (int or [width, height]) pixels. The values of
+        each mesh are clipped at nsigma around the median until no more
+        values are clipped. The mode estimate is 2.5 median - 1.5 mean
+        (the median for crowded meshes where mean and median differ by
+        more than 0.3 sigma), as in SExtractor. Pixels where mask is True
+        and non-finite pixels are ignored. Meshes without valid pixels
+        are NaN.
+    """
+    meshw, meshh = (meshsize, meshsize) if numpy.isscalar(meshsize) else meshsize
+    height, width = image.shape
+    nx = (width - 1) // meshw + 1
+    ny = (height - 1) // meshh + 1
+    # Pad the image to whole meshes with NaN, one row of values per mesh
+    data = numpy.full((ny * meshh, nx * meshw), numpy.nan, dtype = numpy.float32)
+    data[:height, :width] = image
+    if mask is not None:
+        data[:height, :width][mask] = numpy.nan
+    data = data.reshape(ny, meshh, nx, meshw).transpose(0, 2, 1, 3).reshape(ny * nx, -1)
+    data[~numpy.isfinite(data)] = numpy.nan
+    # Sorted values (NaN at the end) and cumulative sums: the statistics
+    # of a clipping range are then a few index operations per mesh
+    data.sort(axis = 1)
+    count = numpy.isfinite(data).sum(axis = 1)
+    values = numpy.nan_to_num(data).astype(numpy.float64)
+    cumsum = numpy.concatenate([numpy.zeros((len(values), 1)), values.cumsum(axis = 1)], axis = 1)
+    cumsq = numpy.concatenate([numpy.zeros((len(values), 1)), (values ** 2).cumsum(axis = 1)], axis = 1)
+    rows = numpy.arange(len(data))
+    low = numpy.zeros(len(data), dtype = int)
+    high = count.copy()
+    for iteration in range(maxiter):
+        n = numpy.maximum(high - low, 1)
+        mean = (cumsum[rows, high] - cumsum[rows, low]) / n
+        sigma = numpy.sqrt(numpy.maximum((cumsq[rows, high] - cumsq[rows, low]) / n - mean ** 2, 0.0))
+        last = numpy.minimum(numpy.maximum(high - 1, low), values.shape[1] - 1)
+        median = 0.5 * (values[rows, numpy.minimum(low + (n - 1) // 2, last)] +
+                        values[rows, numpy.minimum(low + n // 2, last)])
+        # Clip around the median
+        newlow = (data < (median - nsigma * sigma)[:, None]).sum(axis = 1)
+        newhigh = (data <= (median + nsigma * sigma)[:, None]).sum(axis = 1)
+        if numpy.all((newlow == low) & (newhigh == high)):
+            break
+        low = numpy.minimum(newlow, count)
+        high = numpy.maximum(newhigh, low)
+    mode = numpy.where(numpy.abs(mean - median) < 0.3 * sigma, 2.5 * median - 1.5 * mean, median)
+    empty = high <= low
+    mode[empty] = numpy.nan
+    sigma[empty] = numpy.nan
+    return mode.reshape(ny, nx), sigma.reshape(ny, nx)
+
+def filtergrid(grid, filtersize = 3):
+    """ Returns the mesh grid with NaN meshes replaced by the median of
+        the grid and median filtered with filtersize (int or [width, height])
+    """
+    filterw, filterh = (filtersize, filtersize) if numpy.isscalar(filtersize) else filtersize
+    grid = numpy.array(grid, dtype = numpy.float64)
+    bad = ~numpy.isfinite(grid)
+    if bad.all():
+        return numpy.zeros_like(grid)
+    grid[bad] = numpy.median(grid[~bad])
+    if filterw > 1 or filterh > 1:
+        grid = median_filter(grid, size = (filterh, filterw), mode = 'nearest')
+    return grid
+
+def interpolate(grid, meshsize, shape):
+    """ Returns the full resolution surface of shape (height, width) from
+        a mesh grid: natural cubic splines through the mesh centers along
+        the columns, then along the rows. Outside the outer mesh centers
+        the end splines are extrapolated.
+    """
+    meshw, meshh = (meshsize, meshsize) if numpy.isscalar(meshsize) else meshsize
+    height, width = shape
+    ny, nx = grid.shape
+    # Along y: spline through all grid columns at once
+    if ny > 1:
+        ycenter = numpy.arange(ny) * meshh + (meshh - 1) / 2.0
+        rows = CubicSpline(ycenter, grid, axis = 0, bc_type = 'natural')(numpy.arange(height))
+    else:
+        rows = numpy.repeat(grid, height, axis = 0)
+    # Along x: spline through all image rows at once
+    if nx > 1:
+        xcenter = numpy.arange(nx) * meshw + (meshw - 1) / 2.0
+        surface = CubicSpline(xcenter, rows, axis = 1, bc_type = 'natural')(numpy.arange(width))
+    else:
+        surface = numpy.repeat(rows, width, axis = 1)
+    return numpy.ascontiguousarray(surface, dtype = numpy.float32)
+
+class BkgModel(object):
+    """ Background model: background and rms mesh grids
+    """
+
+    def __init__(self, back, rms, meshsize, shape):
+        """ Constructor: set the background and rms grids (ny, nx), the
+            mesh size (int or [width, height]) and the image shape
+        """
+        self.back = numpy.asarray(back, dtype = numpy.float64)
+        self.rms = numpy.asarray(rms, dtype = numpy.float64)
+        if numpy.isscalar(meshsize):
+            meshsize = [meshsize, meshsize]
+        self.meshsize = [int(meshsize[0]), int(meshsize[1])]
+        self.shape = tuple(int(n) for n in shape)
+
+    @classmethod
+    def fromimage(cls, image, meshsize = 64, filtersize = 3, mask = None):
+        """ Returns the background model of an image
+        """
+        back, rms = meshstats(image, meshsize, mask)
+        return cls(filtergrid(back, filtersize), filtergrid(rms, filtersize), meshsize, image.shape)
+
+    def background(self):
+        """ Returns the full resolution background
+        """
+        return interpolate(self.back, self.meshsize, self.shape)
+
+    def rmsimage(self):
+        """ Returns the full resolution background rms
+        """
+        return interpolate(self.rms, self.meshsize, self.shape)
+
+    def level(self):
+        """ Returns the median background level and rms
+        """
+        return float(numpy.median(self.back)), float(numpy.median(self.rms))
+
+    def scaled(self, scale, offset = 0.0):
+        """ Returns the model of the image scale * (image - offset), where
+            offset is a number or a model of the same grid (offset = self
+            gives the model of the background subtracted image)
+        """
+        if isinstance(offset, BkgModel):
+            offset = offset.back
+        return BkgModel(scale * (self.back - offset), abs(scale) * self.rms, self.meshsize, self.shape)
+
+    def store(self, data):
+        """ Stores the grids in the data as BKGMESH image (background and
+            rms planes)
+        """
+        header = fits.Header()
+        header['BKGMESHX'] = (self.meshsize[0], 'Background mesh width (pixels)')
+        header['BKGMESHY'] = (self.meshsize[1], 'Background mesh height (pixels)')
+        header['BKGIMGX'] = (self.shape[1], 'Image width for the background mesh')
+        header['BKGIMGY'] = (self.shape[0], 'Image height for the background mesh')
+        header['BKGPLANE'] = ('BACKGROUND,RMS', 'Planes of the background mesh')
+        data.imageset(numpy.array([self.back, self.rms], dtype = numpy.float32),
+                      BKGIMAGENAME, header)
+
+    @classmethod
+    def load(cls, data, meshsize = None):
+        """ Returns the model stored in the data, None if there is none,
+            if it is for a different image size or (if meshsize is set) for
+            a different mesh size
+        """
+        if BKGIMAGENAME not in data.imgnames:
+            return None
+        index = data.imageindex(BKGIMAGENAME)
+        header = data.imgheads[index]
+        grids = data.imgdata[index]
+        try:
+            model = cls(grids[0], grids[1], [header['BKGMESHX'], header['BKGMESHY']],
+                        [header['BKGIMGY'], header['BKGIMGX']])
+        except (KeyError, IndexError, TypeError):
+            return None
+        if data.image is None or model.shape != data.image.shape:
+            return None
+        if meshsize is not None:
+            if numpy.isscalar(meshsize):
+                meshsize = [meshsize, meshsize]
+            if model.meshsize != [int(meshsize[0]), int(meshsize[1])]:
+                return None
+        return model
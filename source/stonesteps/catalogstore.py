@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+""" CATALOG STORE - Version 1.0.0
+
+    Local store of guide star catalog (GSC 2.4.1) stars, so photometric
+    calibration can run without queries to the StSci web service. The
+    sky is split into HEALPix tiles (nested scheme, nside 64: tiles of
+    about 0.9 degrees). Each tile is a numpy .npz file with the columns
+    ra, dec and the SDSS g/r/i/z magnitudes and errors (SDSSgMag,
+    SDSSgMagErr, ...: the column names of the GSC query result). Tiles
+    without stars are stored as well, so each tile is queried only once.
+
+    CatalogStore.cone() returns the stars within a radius of a position
+    as astropy table, like gsccatalog.querygsc(). Missing tiles are
+    queried (with fetch = True) or raise an error. Fill the store for the
+    targets of a night before the reduction (the pointing RA / DEC of all
+    FITS files in the folders is used) with:
+        python catalogstore.py STOREDIR FOLDER [FOLDER ...]
+"""
+
+import os # os library
+import sys # sys library
+import glob # to find the FITS files
+import logging # logging library
+import numpy # numpy library
+from astropy.io import fits # to read the FITS headers
+from astropy.table import Table # query result table
+from astropy.coordinates import Angle
+import astropy.units as u
+from astropy_healpix import HEALPix # sky tiles
+from stonesteps.gsccatalog import querygsc # guide star catalog
+from stonesteps.indexmap import distance # angular distance
+
+# Columns kept in the tiles
+CATCOLUMNS = ['ra', 'dec'] + ['SDSS%sMag%s' % (band, err)
+                              for band in 'griz' for err in ['', 'Err']]
+
+log = logging.getLogger('pipe.catalogstore')
+
+class CatalogStore(object):
+    """ Store of catalog stars in HEALPix tiles
+    """
+
+    def __init__(self, folder, nside = 64):
+        """ Constructor: set the store folder and the tile size
+        """
+        self.folder = os.path.expandvars(folder)
+        self.healpix = HEALPix(nside = nside, order = 'nested')
+
+    def tilename(self, tile):
+        """ Returns the file name of a tile
+        """
+        return os.path.join(self.folder, 'nside%d' % self.healpix.nside,
+                            'tile_%07d.npz' % tile)
+
+    def tiles(self, ra, dec, radius):
+        """ Returns the tiles which overlap the cone of radius (degrees)
+            around ra, dec (degrees)
+        """
+        return self.healpix.cone_search_lonlat(ra * u.deg, dec * u.deg, radius * u.deg)
+
+    def fetch(self, tile):
+        """ Queries the catalog for the stars of a tile and stores them.
+            The query radius is the distance of the tile center to its
+            furthest boundary point.
+        """
+        ra, dec = self.healpix.healpix_to_lonlat([tile])
+        ra = ra.to(u.deg).value[0]
+        dec = dec.to(u.deg).value[0]
+        borderra, borderdec = self.healpix.boundaries_lonlat([tile], step = 4)
+        radius = numpy.max(distance(ra, dec, borderra.to(u.deg).value[0],
+                                    borderdec.to(u.deg).value[0]))
+        table = querygsc(ra, dec, round(radius * 1.02, 3))
+        # Keep the stars of this tile
+        intile = self.healpix.lonlat_to_healpix(numpy.array(table['ra'], float) * u.deg,
+                                                numpy.array(table['dec'], float) * u.deg) == tile
+        columns = {}
+        for name in CATCOLUMNS:
+            if name in table.colnames:
+                column = numpy.ma.filled(numpy.ma.asarray(table[name], dtype = float), numpy.nan)
+            else:
+                column = numpy.full(len(table), numpy.nan)
+            columns[name] = column[intile].astype(float if name in ['ra', 'dec'] else numpy.float32)
+        filename = self.tilename(tile)
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename), exist_ok = True)
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'wb') as f:
+            numpy.savez(f, **columns)
+        os.replace(tmpname, filename)
+        log.debug('Stored %d stars in tile %d' % (intile.sum(), tile))
+
+    def prefetch(self, ra, dec, radius = 0.5):
+        """ Queries and stores the missing tiles of a cone, returns the
+            number of queried tiles
+        """
+        missing = [tile for tile in self.tiles(ra, dec, radius)
+                   if not os.path.exists(self.tilename(tile))]
+        for tile in missing:
+            self.fetch(tile)
+        return len(missing)
+
+    def cone(self, ra, dec, radius = 0.5, fetch = True):
+        """ Returns the stars within radius (degrees) of ra, dec (degrees)
+            as astropy table. Missing tiles are queried if fetch is True,
+            else an IOError is raised.
+        """
+        parts = []
+        for tile in self.tiles(ra, dec, radius):
+            filename = self.tilename(tile)
+            if not os.path.exists(filename):
+                if not fetch:
+                    raise IOError('Catalog tile %d is not in the store %s' % (tile, self.folder))
+                log.info('Catalog tile %d is missing - querying catalog' % tile)
+                self.fetch(tile)
+            with numpy.load(filename) as content:
+                parts.append({name: content[name] for name in CATCOLUMNS})
+        columns = {name: numpy.concatenate([part[name] for part in parts]) for name in CATCOLUMNS}
+        inside = distance(ra, dec, columns['ra'], columns['dec']) <= radius
+        return Table({name: columns[name][inside] for name in CATCOLUMNS}, names = CATCOLUMNS)
+
+def pointings(folders):
+    """ Returns the pointings (RA, DEC in degrees) of the FITS files in
+        the folders and their subfolders
+    """
+    result = []
+    for folder in folders:
+        filenames = glob.glob(os.path.join(folder, '**', '*.fits'), recursive = True)
+        for filename in sorted(filenames):
+            try:
+                header = fits.getheader(filename)
+                result.append((Angle(header['RA'], unit = u.hour).degree,
+                               Angle(header['DEC'], unit = u.deg).degree))
+            except Exception:
+                continue
+    return result
+
+if __name__ == '__main__':
+    """ Fills the store: python catalogstore.py STOREDIR FOLDER [FOLDER ...]
+    """
+    if len(sys.argv) < 3:
+        print('Usage: python catalogstore.py STOREDIR FOLDER [FOLDER ...]')
+        sys.exit(1)
+    logging.basicConfig(level = logging.INFO)
+    store = CatalogStore(sys.argv[1])
+    fetched = 0
+    targets = pointings([os.path.expandvars(folder) for folder in sys.argv[2:]])
+    for ra, dec in targets:
+        try:
+            fetched += store.prefetch(ra, dec)
+        except Exception as error:
+            log.warning('Query for %.4f %+.4f failed: %s' % (ra, dec, str(error)))
+    print('%d pointings, %d tiles queried, store %s' % (len(targets), fetched, store.folder))
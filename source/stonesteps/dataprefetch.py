@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+""" DATA PREFETCH - Version 1.0.0
+
+    This module provides a background reader for the pipeline. While the
+    pipe steps are busy reducing one file, a worker thread reads and
+    decodes the next input file(s) and the matching bias/dark/flat
+    masters. Loaded data objects are handed over through a bounded queue,
+    so at most 'depth' frames are held in memory ahead of the pipeline.
+
+    The prefetcher is used by StepLoadPrefetch, which replaces the 'load'
+    entry in the stepslist of the pipeline configuration.
+"""
+
+import os # os library
+import queue # bounded queue for loaded data
+import logging # logging object library
+import threading # worker thread
+from darepype.drp import DataParent # Pipeline Data object
+
+class DataPrefetcher(object):
+    """ Background loader for pipeline input files
+        The files are loaded in the order given, loaded data objects
+        are retrieved with get(filename).
+    """
+
+    def __init__(self, config, filenames, depth = 1, masters = True):
+        """ Constructor: Initialize the queue and variables
+            - config: pipeline configuration for the loaded data objects
+            - filenames: ordered list of the files the pipeline will reduce
+            - depth: number of frames that are loaded ahead of the pipeline
+            - masters: flag to also read the calibration masters for
+                       each frame (see StepBiasDarkFlat)
+        """
+        self.config = config
+        self.filenames = list(filenames)
+        self.masters = masters
+        self.queue = queue.Queue(maxsize = max(1, depth))
+        self.stopflag = threading.Event()
+        self.thread = None
+        self.lastindex = -1 # index in filenames of the last file taken from the queue
+        self.log = logging.getLogger('pipe.prefetch')
+
+    def start(self):
+        """ Starts the worker thread (unless it's already running)
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopflag.clear()
+        self.thread = threading.Thread(target = self.worker,
+                                       name = 'pipe-prefetch')
+        self.thread.daemon = True
+        self.thread.start()
+        self.log.debug('Start: prefetching %d files' % len(self.filenames))
+
+    def worker(self):
+        """ Thread function: loads the files one after another and puts
+            them into the queue. put() blocks while the queue is full,
+            this limits how far the worker runs ahead.
+        """
+        for filename in self.filenames:
+            if self.stopflag.is_set():
+                break
+            try:
+                data = DataParent(config = self.config).load(filename)
+            except Exception as error:
+                # The pipeline will load the file itself and report the error
+                self.log.warning('Worker: unable to load %s (%s)' % (filename, str(error)))
+                data = None
+            if data is not None and self.masters:
+                self.loadmasters(data)
+            # Wait for free space in the queue, check the stop flag regularly
+            while not self.stopflag.is_set():
+                try:
+                    self.queue.put((filename, data), timeout = 1.0)
+                    break
+                except queue.Full:
+                    continue
+        self.log.debug('Worker: done')
+
+    def loadmasters(self, data):
+        """ Reads the bias, dark and flat masters matching data into the
+            master cache of StepBiasDarkFlat. Errors are only logged, the
+            pipe step will search the files again and report problems.
+        """
+        # Import here to avoid loading ccdproc if masters are not used
+        from stonesteps.stepbiasdarkflat import StepBiasDarkFlat, readmaster
+        from stonesteps.workdtype import workdtype
+        step = StepBiasDarkFlat()
+        step.config = self.config
+        for auxpar in ['bias', 'dark', 'flat']:
+            try:
+                name = step.loadauxname(auxpar, data = data, multi = False)
+                readmaster(name, workdtype(self.config))
+            except Exception as error:
+                self.log.debug('LoadMasters: no %s for %s (%s)' %
+                               (auxpar, os.path.split(data.filename)[1], str(error)))
+
+    def get(self, filename, timeout = None):
+        """ Returns the loaded data object for filename. Queued files
+            that come before filename were skipped by the pipeline and
+            are dropped. Returns None if the file was not prefetched or
+            could not be loaded, the caller then has to load it.
+        """
+        if filename not in self.filenames:
+            return None
+        # The worker has already passed this file
+        if self.filenames.index(filename) <= self.lastindex:
+            return None
+        while self.thread is not None:
+            # Stop waiting if the worker has finished and the queue is empty
+            if not self.thread.is_alive() and self.queue.empty():
+                return None
+            try:
+                name, data = self.queue.get(timeout = 1.0 if timeout is None else timeout)
+            except queue.Empty:
+                if timeout is not None:
+                    return None
+                continue
+            self.lastindex = self.filenames.index(name)
+            if name == filename:
+                return data
+            self.log.debug('Get: dropping unused prefetched file %s' % name)
+        return None
+
+    def stop(self):
+        """ Stops the worker thread and empties the queue
+        """
+        self.stopflag.set()
+        while not self.queue.empty():
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        if self.thread is not None:
+            self.thread.join()
+        self.thread = None
+        self.log.debug('Stop: done')
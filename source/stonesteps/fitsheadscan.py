@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+""" FITS HEADER SCANNER - Version 1.0.0
+
+    This module provides a fast reader for primary FITS headers. Only the
+    2880 byte header blocks up to the END card are read from disk, the
+    80 character cards are parsed into a dictionary {KEYWORD: value}.
+    The data part of the file is never touched.
+
+    Results are cached by (filename, modification time) and many files
+    can be scanned in parallel with scanheaders(). The cache can also be
+    stored in a file, so repeated scans of large folders (for example a
+    year of data) only read new or changed files.
+
+    The module also compiles the include/exclude rules of StepLoadInput
+    into predicate functions.
+"""
+
+import os # os library
+import gzip # to read compressed FITS files
+import json # to store the header cache
+import logging # logging object library
+import threading # lock for the header cache
+from concurrent.futures import ThreadPoolExecutor # scan in parallel
+
+log = logging.getLogger('pipe.headscan')
+
+BLOCKSIZE = 2880 # FITS block size
+CARDSIZE = 80 # FITS card size
+
+# Header cache: {filename: (mtime, header dictionary)}
+headcache = {}
+headcachelock = threading.Lock()
+
+def parsevalue(valstr):
+    """ Converts the value part of a FITS card (after '= ') into a python
+        value. Strings loose their quotes and trailing blanks, T/F are
+        returned as bool, numbers as int or float. Comments are removed.
+    """
+    valstr = valstr.strip()
+    # String value - look for closing quote, '' is an escaped quote
+    if valstr.startswith("'"):
+        i = 1
+        chars = []
+        while i < len(valstr):
+            if valstr[i] == "'":
+                if valstr[i+1:i+2] == "'":
+                    chars.append("'")
+                    i += 2
+                    continue
+                break
+            chars.append(valstr[i])
+            i += 1
+        return ''.join(chars).rstrip()
+    # Remove the comment
+    valstr = valstr.split('/')[0].strip()
+    if valstr == 'T':
+        return True
+    if valstr == 'F':
+        return False
+    if valstr == '':
+        return ''
+    try:
+        return int(valstr)
+    except ValueError:
+        pass
+    try:
+        return float(valstr.replace('D', 'E'))
+    except ValueError:
+        return valstr
+
+def readheader(filename):
+    """ Reads the primary header of a FITS file and returns it as a
+        dictionary. Only the header blocks are read. COMMENT, HISTORY and
+        blank cards are skipped. Raises IOError if the file is not a
+        valid FITS file.
+    """
+    if filename.endswith('.gz'):
+        fileobj = gzip.open(filename, 'rb')
+    else:
+        fileobj = open(filename, 'rb')
+    header = {}
+    with fileobj:
+        first = True
+        ended = False
+        while not ended:
+            block = fileobj.read(BLOCKSIZE)
+            if len(block) < BLOCKSIZE:
+                raise IOError('ReadHeader: no END card in %s' % filename)
+            block = block.decode('ascii', 'replace')
+            if first and not block.startswith('SIMPLE  ='):
+                raise IOError('ReadHeader: %s is not a FITS file' % filename)
+            first = False
+            for i in range(0, BLOCKSIZE, CARDSIZE):
+                card = block[i:i+CARDSIZE]
+                key = card[:8].strip()
+                if key == 'END':
+                    ended = True
+                    break
+                # Only cards with values are kept
+                if card[8:10] != '= ' or key in ['', 'COMMENT', 'HISTORY']:
+                    continue
+                header[key] = parsevalue(card[10:])
+    return header
+
+def getheader(filename):
+    """ Returns the header dictionary for filename, from the cache if the
+        file has not changed since it was read.
+    """
+    mtime = os.path.getmtime(filename)
+    with headcachelock:
+        entry = headcache.get(filename)
+    if entry is not None and entry[0] == mtime:
+        return entry[1]
+    header = readheader(filename)
+    with headcachelock:
+        headcache[filename] = (mtime, header)
+    return header
+
+def scanheaders(filenames, threads = 8):
+    """ Reads the headers of all filenames using a pool of threads.
+        Returns a dictionary {filename: header}. Files that can not be
+        read are logged and left out.
+    """
+    def scanone(filename):
+        try:
+            return getheader(filename)
+        except (IOError, OSError) as error:
+            log.warning('ScanHeaders: unable to read %s (%s)' % (filename, str(error)))
+            return None
+    with ThreadPoolExecutor(max_workers = max(1, threads)) as pool:
+        headers = list(pool.map(scanone, filenames))
+    return dict((f, h) for f, h in zip(filenames, headers) if h is not None)
+
+def loadcache(cachefile):
+    """ Loads the header cache from cachefile (if it exists)
+    """
+    if not os.path.exists(cachefile):
+        return
+    try:
+        with open(cachefile) as f:
+            stored = json.load(f)
+    except (IOError, ValueError) as error:
+        log.warning('LoadCache: unable to read %s (%s)' % (cachefile, str(error)))
+        return
+    with headcachelock:
+        for filename, entry in stored.items():
+            if filename not in headcache:
+                headcache[filename] = (entry[0], entry[1])
+    log.debug('LoadCache: %d headers loaded from %s' % (len(stored), cachefile))
+
+def savecache(cachefile):
+    """ Saves the header cache to cachefile. Entries of files which no
+        longer exist are dropped.
+    """
+    with headcachelock:
+        stored = dict((f, list(e)) for f, e in headcache.items() if os.path.exists(f))
+    tmpname = cachefile + '.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump(stored, f)
+    os.replace(tmpname, cachefile)
+    log.debug('SaveCache: %d headers saved to %s' % (len(stored), cachefile))
+
+def filepredicate(include, exclude):
+    """ Returns a function f(filename) -> bool which is True if the file
+        name (without path) contains any of the strings in include (or
+        include is empty) and none of the strings in exclude.
+        include and exclude are '|' separated strings, empty entries are
+        ignored.
+    """
+    incl = [s for s in include.split('|') if len(s)]
+    excl = [s for s in exclude.split('|') if len(s)]
+    def predicate(filename):
+        name = os.path.split(filename)[1]
+        if len(incl) and not any(s in name for s in incl):
+            return False
+        return not any(s in name for s in excl)
+    return predicate
+
+def headpredicate(include, exclude, config = None):
+    """ Returns a function f(header) -> bool which is True if the header
+        matches any of the KEY=VALUE pairs in include (or include is
+        empty) and none of the pairs in exclude. Values are compared as
+        strings. include and exclude are '|' separated strings.
+        Keyword replacements from the [header] section of config are
+        applied the same way as in DataParent.getheadval().
+    """
+    def parse(rules):
+        pairs = []
+        for rule in rules.split('|'):
+            if '=' in rule:
+                key, value = rule.split('=', 1)
+                pairs.append((key.strip().upper(), value.strip()))
+        return pairs
+    incl = parse(include)
+    excl = parse(exclude)
+    # Get keyword replacements from the configuration
+    replace = {}
+    try:
+        for key, val in config['header'].items():
+            replace[key.upper()] = val
+    except (KeyError, TypeError, AttributeError):
+        pass
+    def lookup(header, key):
+        """ Returns the header value as string, None if it's missing """
+        if key in replace:
+            val = replace[key]
+            if val[:2] in ['?_', '? ', '?-']:
+                if key not in header:
+                    key = val[2:].upper()
+            elif val[0].isupper() and val[:2] not in ['T ', 'F ']:
+                key = val.upper()
+            else:
+                return str(parsevalue(val))
+        if key not in header:
+            return None
+        return str(header[key])
+    def predicate(header):
+        if len(incl) and not any(lookup(header, k) == v for k, v in incl):
+            return False
+        return not any(lookup(header, k) == v for k, v in excl)
+    return predicate
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+""" FORCED PHOTOMETRY - Version 1.0.0
+
+    Forced circular aperture photometry of many targets on many frames at
+    once, in pure numpy. The targets are given in RA / Dec and projected
+    through the WCS of each frame, the apertures are not recentered.
+
+    For each frame a square cutout around every target is taken with one
+    fancy index operation (pixels outside the image are NaN), so all
+    further work is done on arrays (frames, targets, size, size):
+    - the aperture weights are the fractions of the pixels inside the
+      aperture, computed by subsampling each pixel (subpix x subpix points)
+    - the sky is the median of the annulus pixels, clipped once at 3
+      robust standard deviations around the median, its error is the
+      standard deviation of the remaining annulus pixels
+    - flux = sum(weight * (pixel - sky))
+    - fluxerr^2 = area * skyrms^2 + area^2 * skyrms^2 / nsky + flux / gain
+    The radii and the gain can be different for each frame (for example
+    fixed radii in arcsec on frames of different pixel scales).
+
+    measure() splits the frames into chunks, so the cutouts of a chunk
+    have about maxvalues values (memory bound for long sequences).
+
+    Flags (bit values):
+    - 1: aperture pixels outside the image or not finite
+    - 2: target outside the image (no flux)
+    - 4: no valid sky pixels (sky set to 0)
+"""
+
+import numpy # numpy library
+from astropy import wcs # WCS object
+
+# Flag bit values
+FLAGEDGE = 1
+FLAGOUTSIDE = 2
+FLAGNOSKY = 4
+
+def pixelpositions(header, ra, dec):
+    """ Returns the pixel positions x, y (0 based) of the targets ra, dec
+        (degrees) in the frame with header and the pixel scale (arcsec)
+    """
+    frame = wcs.WCS(header)
+    if not frame.has_celestial:
+        raise ValueError('no celestial WCS in header')
+    x, y = frame.all_world2pix(numpy.asarray(ra, dtype = numpy.float64),
+                               numpy.asarray(dec, dtype = numpy.float64), 0)
+    scale = numpy.mean(wcs.utils.proj_plane_pixel_scales(frame.celestial)) * 3600.
+    return x, y, scale
+
+def cutouts(image, x, y, half):
+    """ Returns the cutouts (targets, size, size) of size = 2 * half + 1
+        pixels around the pixels closest to x, y (NaN outside the image)
+        and the offsets dx, dy of the cutout pixel centers from x, y
+    """
+    ny, nx = image.shape
+    offsets = numpy.arange(-half, half + 1)
+    ix = numpy.round(x).astype(numpy.intp)[:, None] + offsets
+    iy = numpy.round(y).astype(numpy.intp)[:, None] + offsets
+    inx = (ix >= 0) & (ix < nx)
+    iny = (iy >= 0) & (iy < ny)
+    values = image[numpy.clip(iy, 0, ny - 1)[:, :, None],
+                   numpy.clip(ix, 0, nx - 1)[:, None, :]].astype(numpy.float32)
+    values[~(iny[:, :, None] & inx[:, None, :])] = numpy.nan
+    dx = (ix - numpy.asarray(x)[:, None])[:, None, :]
+    dy = (iy - numpy.asarray(y)[:, None])[:, :, None]
+    return values, dx, dy
+
+def apertureweights(dx, dy, radius, subpix = 5):
+    """ Returns the fractions of the pixels with center offsets dx, dy
+        inside the circle of radius (arrays broadcast), from subpix x
+        subpix points in each pixel. Pixels completely inside or outside
+        the circle are not subsampled.
+    """
+    dist2 = dx ** 2 + dy ** 2
+    radius = numpy.asarray(radius, dtype = numpy.float64)
+    weights = (dist2 <= (radius - 0.7072).clip(0) ** 2).astype(numpy.float32)
+    edge = (dist2 > (radius - 0.7072).clip(0) ** 2) & (dist2 < (radius + 0.7072) ** 2)
+    if edge.any():
+        # Only the pixels on the circle are subsampled
+        dx, dy, radius = (numpy.broadcast_to(v, edge.shape)[edge]
+                          for v in numpy.broadcast_arrays(dx, dy, radius))
+        steps = (numpy.arange(max(subpix, 1)) + 0.5) / max(subpix, 1) - 0.5
+        inside = numpy.zeros(len(dx), dtype = numpy.float32)
+        for sx in steps:
+            for sy in steps:
+                inside += ((dx + sx) ** 2 + (dy + sy) ** 2) <= radius ** 2
+        weights[edge] = inside / len(steps) ** 2
+    return weights
+
+def sortedquantile(values, start, count, q):
+    """ Returns the quantile q of the count values from index start of
+        the sorted rows values (..., n) (linear interpolation)
+    """
+    position = numpy.maximum(count - 1, 0) * q
+    low = numpy.floor(position).astype(numpy.intp)
+    high = numpy.minimum(low + 1, numpy.maximum(count - 1, 0))
+    fraction = position - low
+    low = numpy.minimum(low + start, values.shape[-1] - 1)
+    high = numpy.minimum(high + start, values.shape[-1] - 1)
+    take = lambda index: numpy.take_along_axis(values, index[..., None], axis = -1)[..., 0]
+    return (1.0 - fraction) * take(low) + fraction * take(high)
+
+def skylevel(values, annulus, nsigma = 3.0):
+    """ Returns the sky (clipped median), the sky rms and the number of
+        sky pixels of the cutouts values (..., size, size) in the annulus
+        mask. The annulus pixels of each cutout are sorted once, the
+        median and the robust standard deviation (interquartile range /
+        1.349) are read from the sorted values, pixels further than
+        nsigma robust standard deviations from the median are removed.
+    """
+    shape = values.shape[:-2]
+    sky = numpy.where(annulus, values, numpy.nan).reshape(shape + (-1,))
+    sky.sort(axis = -1) # NaN at the end
+    count = numpy.isfinite(sky).sum(axis = -1)
+    median = sortedquantile(sky, 0, count, 0.5)
+    spread = (sortedquantile(sky, 0, count, 0.75) - sortedquantile(sky, 0, count, 0.25)) / 1.349
+    with numpy.errstate(invalid = 'ignore'):
+        low = (sky < (median - nsigma * spread)[..., None]).sum(axis = -1)
+        high = (sky <= (median + nsigma * spread)[..., None]).sum(axis = -1)
+    # The clipped values are the sorted values low ... high - 1
+    n = high - low
+    level = sortedquantile(sky, low, n, 0.5)
+    index = numpy.arange(sky.shape[-1])
+    inside = (index >= low[..., None]) & (index < high[..., None])
+    clipped = numpy.where(inside, sky, 0.0)
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        mean = clipped.sum(axis = -1) / n
+        rms = numpy.sqrt(numpy.maximum((clipped ** 2).sum(axis = -1) / n - mean ** 2, 0.0))
+    return level, rms, n
+
+def photometry(values, dx, dy, radius, annulus, gain = 0.0, subpix = 5):
+    """ Returns flux, fluxerr, sky, skyrms and flags of the cutouts values
+        (frames, targets, size, size) with offsets dx, dy. radius, the
+        annulus radii [inner, outer] and the gain (counts per data unit,
+        0 for no source noise) are numbers or arrays (frames,).
+    """
+    perframe = lambda v: numpy.asarray(v, dtype = numpy.float64).reshape((-1, 1, 1, 1))
+    radius = perframe(radius)
+    inner = perframe(numpy.asarray(annulus, dtype = numpy.float64)[..., 0])
+    outer = perframe(numpy.asarray(annulus, dtype = numpy.float64)[..., 1])
+    dist2 = dx ** 2 + dy ** 2
+    weights = apertureweights(dx, dy, radius, subpix)
+    sky, skyrms, nsky = skylevel(values, (dist2 >= inner ** 2) & (dist2 < outer ** 2))
+    flags = numpy.zeros(sky.shape, dtype = numpy.int16)
+    flags[nsky == 0] |= FLAGNOSKY
+    sky = numpy.where(nsky > 0, sky, 0.0)
+    skyrms = numpy.where(nsky > 0, skyrms, 0.0)
+    # Aperture sums, invalid pixels count as sky
+    bad = ~numpy.isfinite(values) & (weights > 0)
+    flags[bad.any(axis = (-2, -1))] |= FLAGEDGE
+    # (all() with where needs numpy >= 1.20)
+    flags[bad.sum(axis = (-2, -1)) == (weights > 0).sum(axis = (-2, -1))] |= FLAGOUTSIDE
+    area = weights.sum(axis = (-2, -1), dtype = numpy.float64)
+    flux = numpy.nansum(weights * (values - sky[..., None, None]), axis = (-2, -1), dtype = numpy.float64)
+    gain = numpy.asarray(gain, dtype = numpy.float64).reshape((-1, 1))
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        source = numpy.where(gain > 0, numpy.maximum(flux, 0.0) / gain, 0.0)
+        variance = area * skyrms ** 2 * (1.0 + area / numpy.maximum(nsky, 1)) + source
+    fluxerr = numpy.sqrt(variance)
+    flux[flags & FLAGOUTSIDE > 0] = numpy.nan
+    fluxerr[flags & FLAGOUTSIDE > 0] = numpy.nan
+    return flux, fluxerr, sky, skyrms, flags
+
+def measure(images, x, y, radius, annulus, gain = 0.0, subpix = 5, maxvalues = 20000000):
+    """ Returns flux, fluxerr, sky, skyrms and flags (frames, targets) of
+        the targets at pixel positions x, y (frames, targets) on the
+        images (list of 2D arrays, one per frame). radius, annulus
+        [inner, outer] and gain are numbers or per frame arrays (see
+        photometry()). The frames are measured in chunks of about
+        maxvalues cutout pixels.
+    """
+    nframes = len(images)
+    x = numpy.asarray(x, dtype = numpy.float64).reshape(nframes, -1)
+    y = numpy.asarray(y, dtype = numpy.float64).reshape(nframes, -1)
+    ntargets = x.shape[1]
+    broadcast = lambda v, n: numpy.broadcast_to(numpy.asarray(v, dtype = numpy.float64),
+                                                (nframes,) + n)
+    radius = broadcast(radius, ())
+    annulus = broadcast(annulus, (2,))
+    gain = broadcast(gain, ())
+    half = int(numpy.ceil(max(numpy.max(radius), numpy.max(annulus)))) + 1
+    size = 2 * half + 1
+    chunk = max(1, maxvalues // max(1, ntargets * size * size))
+    # Targets far outside the image are put on the corner (flagged)
+    finite = numpy.isfinite(x) & numpy.isfinite(y)
+    x = numpy.where(finite, x, -10.0 * size)
+    y = numpy.where(finite, y, -10.0 * size)
+    results = [numpy.empty((nframes, ntargets)) for i in range(4)]
+    results.append(numpy.empty((nframes, ntargets), dtype = numpy.int16))
+    for first in range(0, nframes, chunk):
+        last = min(first + chunk, nframes)
+        pieces = [cutouts(images[f], numpy.clip(x[f], -2 * size, images[f].shape[1] + 2 * size),
+                          numpy.clip(y[f], -2 * size, images[f].shape[0] + 2 * size), half)
+                  for f in range(first, last)]
+        values, dx, dy = (numpy.stack(p) for p in zip(*pieces))
+        chunkresult = photometry(values, dx, dy, radius[first:last], annulus[first:last],
+                                 gain[first:last], subpix)
+        for result, part in zip(results, chunkresult):
+            result[first:last] = part
+    results[-1][~finite] |= FLAGOUTSIDE
+    for result in results[:2]:
+        result[~finite] = numpy.nan
+    return tuple(results)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+""" FRAME STATISTICS - Version 1.0.0
+
+    This module provides quick statistics of an image frame, for pipe
+    steps which need an estimate of the frame content before running
+    expensive programs (for example to choose astrometry options).
+
+    The statistics are computed on a subsampled copy of the image:
+    - background: median pixel value
+    - noise: robust standard deviation (from the median absolute deviation)
+    - nstars: number of connected groups of pixels above
+              background + nsigma * noise (an estimate of the star count)
+    - density: nstars per million pixels of the full frame
+    findstars() returns the positions and fluxes of the brightest stars.
+    framequality() adds the saturated pixel fraction and a rough FWHM and
+    elongation of the brightest stars (second moments), computed on a
+    binned copy of the image, for the frame triage (StepTriage).
+"""
+
+import numpy # numpy library
+from scipy import ndimage # image labeling
+
+def framestats(image, nsigma = 5.0, step = 2, minpix = 2):
+    """ Returns a dictionary with the statistics of image (see above).
+        - nsigma: detection threshold in units of the noise
+        - step: subsampling factor (every step-th pixel in x and y is used)
+        - minpix: minimal number of subsampled pixels for a star
+    """
+    img = numpy.asarray(image)[::step, ::step]
+    good = numpy.isfinite(img)
+    if not good.any():
+        return {'background': 0.0, 'noise': 0.0, 'nstars': 0, 'density': 0.0}
+    values = img[good].astype(numpy.float64)
+    background = numpy.median(values)
+    noise = 1.4826 * numpy.median(numpy.abs(values - background))
+    if noise <= 0:
+        noise = numpy.std(values)
+    # Label the pixels above the threshold
+    mask = good & (img > background + nsigma * noise)
+    labels, nlabels = ndimage.label(mask)
+    if nlabels:
+        sizes = numpy.bincount(labels.ravel())[1:]
+        nstars = int(numpy.sum(sizes >= minpix))
+    else:
+        nstars = 0
+    # Star density per million pixels of the full image
+    density = 1e6 * nstars / float(numpy.asarray(image).size)
+    return {'background': float(background), 'noise': float(noise),
+            'nstars': nstars, 'density': density}
+
+def findstars(image, nsigma = 5.0, maxstars = 50, minpix = 3):
+    """ Returns the positions and fluxes of the brightest stars in image
+        as arrays x, y, flux (pixel positions start at 0, x is the column).
+        Stars are connected groups of at least minpix pixels above
+        background + nsigma * noise (see framestats), the position is the
+        flux weighted center. At most maxstars stars are returned, sorted
+        by flux (brightest first).
+    """
+    img = numpy.asarray(image)
+    stats = framestats(img, nsigma = nsigma)
+    data = img.astype(numpy.float64) - stats['background']
+    mask = numpy.isfinite(data) & (data > nsigma * stats['noise'])
+    labels, nlabels = ndimage.label(mask)
+    if nlabels == 0:
+        return numpy.zeros(0), numpy.zeros(0), numpy.zeros(0)
+    sizes = numpy.bincount(labels.ravel())[1:]
+    index = numpy.arange(1, nlabels + 1)[sizes >= minpix]
+    if len(index) == 0:
+        return numpy.zeros(0), numpy.zeros(0), numpy.zeros(0)
+    data[~mask] = 0.0
+    flux = numpy.array(ndimage.sum(data, labels, index))
+    order = numpy.argsort(flux)[::-1][:maxstars]
+    index = index[order]
+    centers = numpy.array(ndimage.center_of_mass(data, labels, index))
+    return centers[:,1], centers[:,0], flux[order]
+
+def binimage(image, binning = 2):
+    """ Returns the image binned by binning x binning pixels (mean, the
+        last rows / columns which do not fill a bin are left out)
+    """
+    img = numpy.asarray(image, dtype = numpy.float32)
+    if binning <= 1:
+        return img
+    height = img.shape[0] // binning * binning
+    width = img.shape[1] // binning * binning
+    return img[:height, :width].reshape(height // binning, binning,
+                                        width // binning, binning).mean(axis = (1, 3))
+
+def framequality(image, binning = 2, nsigma = 5.0, saturation = 0.0, maxstars = 30, minpix = 3):
+    """ Returns a dictionary with the framestats() of the image binned by
+        binning (nstars and density for the full image) and
+        - saturated: fraction of pixels at or above saturation (0 if
+                     saturation is 0), from every binning-th pixel
+        - fwhm: median FWHM of the maxstars brightest stars (full image
+                pixels, 0 if there are no stars), from the second moments
+                of the star pixels above the threshold
+        - elongation: median ratio of the major to the minor axis of
+                      these stars (trailed frames have large values)
+    """
+    img = numpy.asarray(image)
+    binned = binimage(img, binning)
+    stats = framestats(binned, nsigma = nsigma, step = 1, minpix = minpix)
+    stats['density'] = 1e6 * stats['nstars'] / float(img.size)
+    stats['saturated'] = 0.0
+    if saturation > 0:
+        stats['saturated'] = float(numpy.mean(img[::binning, ::binning] >= saturation))
+    stats['fwhm'] = 0.0
+    stats['elongation'] = 0.0
+    # Second moments of the brightest stars
+    data = binned.astype(numpy.float64) - stats['background']
+    mask = numpy.isfinite(data) & (data > nsigma * stats['noise'])
+    labels, nlabels = ndimage.label(mask)
+    if nlabels == 0:
+        return stats
+    # Sums over the star pixels only
+    y, x = numpy.nonzero(mask)
+    label = labels[y, x]
+    values = data[y, x]
+    moment = lambda weights: numpy.bincount(label, weights = weights, minlength = nlabels + 1)
+    sizes = numpy.bincount(label, minlength = nlabels + 1)
+    total = moment(values)
+    index = numpy.nonzero(sizes >= minpix)[0]
+    index = index[index > 0]
+    if len(index) == 0:
+        return stats
+    index = index[numpy.argsort(total[index])[::-1][:maxstars]]
+    total = total[index]
+    xc = moment(values * x)[index] / total
+    yc = moment(values * y)[index] / total
+    xx = moment(values * x * x)[index] / total - xc ** 2
+    yy = moment(values * y * y)[index] / total - yc ** 2
+    xy = moment(values * x * y)[index] / total - xc * yc
+    # Axes of the moment ellipse, corrected for the pixel size (1/12 pixel^2)
+    mean = 0.5 * (xx + yy)
+    diff = numpy.sqrt(0.25 * (xx - yy) ** 2 + xy ** 2)
+    major = numpy.maximum(mean + diff - 1.0 / 12.0, 1e-6)
+    minor = numpy.maximum(mean - diff - 1.0 / 12.0, 1e-6)
+    stats['fwhm'] = float(numpy.median(2.3548 * numpy.sqrt(0.5 * (major + minor)))) * binning
+    stats['elongation'] = float(numpy.median(numpy.sqrt(major / minor)))
+    return stats
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+""" GUIDE STAR CATALOG - Version 1.0.0
+
+    This module queries the StSci Guide Star Catalog (GSC 2.4.1) web
+    service for the stars around a sky position. It is used by
+    StepFluxCalSex (photometric reference) and StepAstroRefine (WCS
+    reference).
+
+    Query results can be kept in a cache folder: the query position is
+    rounded to 'roundto' degrees and the result is stored as CSV file
+    named after the position and radius. Frames of the same field then
+    use the stored result instead of querying the web service again.
+"""
+
+import os # os library
+import logging # logging library
+import requests # http request library
+import astropy.io.ascii # to read the query result
+
+# URL of the guide star catalog web service
+GSCURL = 'http://gsss.stsci.edu/webservices/vo/CatalogSearch.aspx?'
+
+log = logging.getLogger('pipe.gsccatalog')
+
+def gsccachename(ra, dec, radius, cachefolder, roundto = 0.01):
+    """ Returns the cache file name of a query (position rounded to
+        roundto degrees) and the rounded position
+    """
+    ra = round(ra / roundto) * roundto
+    dec = round(dec / roundto) * roundto
+    cachename = os.path.join(os.path.expandvars(cachefolder),
+                             'gsc_%.4f_%+.4f_%.3f.csv' % (ra, dec, radius))
+    return cachename, ra, dec
+
+def querygsc(ra, dec, radius = 0.5, cachefolder = '', roundto = 0.01, timeout = 60):
+    """ Returns the guide star catalog entries within radius (degrees)
+        of ra, dec (degrees) as astropy table. The result is read from /
+        stored in cachefolder (no cache if cachefolder is empty), the
+        position is rounded to roundto degrees for cached queries.
+    """
+    cachename = ''
+    if len(cachefolder):
+        cachename, ra, dec = gsccachename(ra, dec, radius, cachefolder, roundto)
+        cachefolder = os.path.dirname(cachename)
+        if os.path.exists(cachename):
+            log.debug('Reading cached catalog %s' % cachename)
+            with open(cachename) as f:
+                return astropy.io.ascii.read(f.read())
+    query = GSCURL + 'RA=' + str(ra)
+    query += '&DEC=' + str(dec)
+    query += '&DSN=+&FORMAT=CSV&CAT=GSC241&SR=' + str(radius) + '&'
+    log.debug('Running URL = %s' % query)
+    result = requests.get(query, timeout = timeout)
+    result.raise_for_status()
+    table = astropy.io.ascii.read(result.text)
+    if len(cachename):
+        if not os.path.exists(cachefolder):
+            os.makedirs(cachefolder)
+        tmpname = cachename + '.tmp'
+        with open(tmpname, 'w') as f:
+            f.write(result.text)
+        os.replace(tmpname, cachename)
+    return table
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+""" ASTROMETRY INDEX MAP - Version 1.0.0
+
+    solve-field opens and considers every index file in its backend
+    configuration, even if the search is limited with --ra, --dec and
+    --radius. This module keeps a map of the sky region and the quad
+    scale range covered by each astrometry.net index file, so
+    StepAstrometry can write a backend configuration for each frame with
+    only the index files which cover the frame position and pixel scale.
+
+    The map is a JSON file made from the index file headers:
+    - HEALPIX, HPNSIDE: HEALPix tile covered by the index (astrometry.net
+      'xy' numbering, converted to the nested scheme)
+    - ALLSKY: flag for index files which cover the whole sky
+    - SCALE_L, SCALE_U: range of the quad sizes (arcsec)
+    The center and radius of each tile are stored in the map (computed
+    with astropy_healpix), with a margin of the largest quad size. Make
+    the map (again when index files are added) with:
+        python indexmap.py INDEXDIR MAPFILE
+"""
+
+import os # os library
+import sys # sys library
+import json # to store the map
+import glob # to find the index files
+import numpy # numpy library
+from astropy.io import fits # to read the index headers
+
+def xytonested(hp, nside):
+    """ Converts an astrometry.net 'xy' healpix number to the nested
+        scheme: the bits of x and y in the base tile are interleaved.
+    """
+    bighp, rest = divmod(hp, nside * nside)
+    x, y = divmod(rest, nside)
+    index = 0
+    bit = 0
+    while x or y:
+        index |= ((x & 1) | ((y & 1) << 1)) << (2 * bit)
+        x >>= 1
+        y >>= 1
+        bit += 1
+    return bighp * nside * nside + index
+
+def distance(ra1, dec1, ra2, dec2):
+    """ Returns the angular distance (degrees) between two positions
+        (degrees)
+    """
+    ra1, dec1, ra2, dec2 = [numpy.radians(a) for a in (ra1, dec1, ra2, dec2)]
+    cosd = ( numpy.sin(dec1) * numpy.sin(dec2) +
+             numpy.cos(dec1) * numpy.cos(dec2) * numpy.cos(ra1 - ra2) )
+    return numpy.degrees(numpy.arccos(numpy.clip(cosd, -1.0, 1.0)))
+
+class IndexMap(object):
+    """ Map of index files in a JSON file:
+        [{'file': index file path, 'allsky': flag, 'ra', 'dec': center,
+          'radius': radius (degrees), 'scalelow', 'scalehigh': quad size
+          range (arcsec)}, ...]
+    """
+
+    def __init__(self, filename):
+        """ Constructor: set the file name
+        """
+        self.filename = os.path.expandvars(filename)
+        self.entries = None
+
+    def build(self, indexfiles):
+        """ Makes the map for the index files and writes it
+        """
+        # Import here, astropy_healpix is only needed to make the map
+        from astropy_healpix import HEALPix
+        import astropy.units as u
+        entries = []
+        for indexfile in indexfiles:
+            header = fits.getheader(indexfile)
+            entry = {'file': os.path.abspath(indexfile),
+                     'scalelow': float(header.get('SCALE_L', 0.0)),
+                     'scalehigh': float(header.get('SCALE_U', 0.0)),
+                     'allsky': bool(header.get('ALLSKY', False)) or 'HEALPIX' not in header,
+                     'ra': 0.0, 'dec': 0.0, 'radius': 180.0}
+            if not entry['allsky']:
+                nside = int(header.get('HPNSIDE', 1))
+                hp = HEALPix(nside = nside, order = 'nested')
+                index = xytonested(int(header['HEALPIX']), nside)
+                ra, dec = hp.healpix_to_lonlat([index])
+                cornerra, cornerdec = hp.boundaries_lonlat([index], step = 4)
+                ra = ra.to(u.deg).value[0]
+                dec = dec.to(u.deg).value[0]
+                radius = numpy.max(distance(ra, dec, cornerra.to(u.deg).value[0],
+                                            cornerdec.to(u.deg).value[0]))
+                entry.update({'ra': float(ra), 'dec': float(dec),
+                              'radius': float(radius) + entry['scalehigh'] / 3600.0})
+            entries.append(entry)
+        self.entries = entries
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(entries, f, indent = 1)
+        os.replace(tmpname, self.filename)
+
+    def read(self):
+        """ Returns the map entries (read once)
+        """
+        if self.entries is None:
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+        return self.entries
+
+    def select(self, ra, dec, radius, width, height, scalelow, scalehigh):
+        """ Returns the index files which cover the position ra, dec
+            within radius (degrees) and have quads fitting an image of
+            width x height pixels with a pixel scale between scalelow and
+            scalehigh (arcsec/pixel). As in solve-field, quads from 10% of
+            the smaller image side up to the image diagonal are used.
+        """
+        quadlow = 0.1 * min(width, height) * scalelow
+        quadhigh = numpy.hypot(width, height) * scalehigh
+        selected = []
+        for entry in self.read():
+            if entry['scalehigh'] < quadlow or entry['scalelow'] > quadhigh:
+                continue
+            if ( not entry['allsky'] and
+                 distance(ra, dec, entry['ra'], entry['dec']) > entry['radius'] + radius ):
+                continue
+            selected.append(entry['file'])
+        return selected
+
+if __name__ == '__main__':
+    """ Makes the map: python indexmap.py INDEXDIR MAPFILE
+    """
+    if len(sys.argv) < 3:
+        print('Usage: python indexmap.py INDEXDIR MAPFILE')
+        sys.exit(1)
+    indexfiles = sorted(glob.glob(os.path.join(os.path.expandvars(sys.argv[1]), 'index-*.fits')))
+    indexmap = IndexMap(sys.argv[2])
+    indexmap.build(indexfiles)
+    print('Map of %d index files written to %s' % (len(indexfiles), indexmap.filename))
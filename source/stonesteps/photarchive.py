@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+""" PHOTOMETRY ARCHIVE - Version 1.0.0
+
+    Archive of the calibrated sources of all nights (Sources tables of the
+    FCAL files from StepFluxCalSex and StepFluxCalJoint), for cone
+    searches and light curves without reading the FITS files again.
+
+    The archive is split like the catalog store (catalogstore.py) into
+    HEALPix tiles (nested scheme, nside 64: about 0.9 degrees) and, in
+    each tile, into nights: one numpy .npz file with columns for each
+    tile and night
+        ARCHIVE/nside64/tile_0012345/2026-10-18.npz
+    Columns of the sources: ra, dec (degrees), mag, magerr, frame (index
+    into the frame columns) and hpx, the nested HEALPix index at nside
+    FINENSIDE (about 26 arcsec). The sources are sorted by hpx, so a cone
+    search reads the hpx column, finds the fine pixels of the cone with
+    searchsorted and loads the other columns only if there are sources in
+    the cone. Frame columns: framename, framemjd (mid exposure),
+    framefilter, frameexptime and framezperr.
+
+    Ingesting the files of a night replaces the sources of these files in
+    the partitions (files can be ingested again after a new reduction).
+    The night of a frame is the date of DATE-OBS - 12 hours.
+
+    Ingest the FCAL files of folders (and subfolders), get a light curve:
+        python photarchive.py ingest ARCHIVEDIR FOLDER [FOLDER ...]
+        python photarchive.py lightcurve ARCHIVEDIR RA DEC [RADIUS]
+    (RA, DEC in degrees or sexagesimal hours / degrees, RADIUS in arcsec)
+"""
+
+import os # os library
+import sys # sys library
+import glob # to find the FITS files
+import logging # logging library
+import datetime # to get the night of a frame
+import numpy # numpy library
+from astropy.io import fits # to read the FITS files
+from astropy.table import Table # query results
+from astropy.time import Time # to convert DATE-OBS
+from astropy.coordinates import Angle
+import astropy.units as u
+from astropy_healpix import HEALPix # sky tiles
+from stonesteps.indexmap import distance # angular distance
+
+# Fine HEALPix resolution of the spatial index in the partitions
+FINENSIDE = 8192
+
+# Source and frame columns of the partitions
+SOURCECOLUMNS = ['hpx', 'ra', 'dec', 'mag', 'magerr', 'frame']
+FRAMECOLUMNS = ['framename', 'framemjd', 'framefilter', 'frameexptime', 'framezperr']
+
+log = logging.getLogger('pipe.photarchive')
+
+def night(dateobs):
+    """ Returns the night (YYYY-MM-DD) of an observation at DATE-OBS
+    """
+    date = Time(dateobs, format = 'isot', scale = 'utc').datetime
+    return (date - datetime.timedelta(hours = 12)).strftime('%Y-%m-%d')
+
+def readframe(filename):
+    """ Returns the sources of a calibrated FITS file: dictionary with the
+        frame information (framename, framemjd, framefilter, frameexptime,
+        framezperr, night) and the source columns ra, dec, mag, magerr.
+        Returns None if the file has no Sources table.
+    """
+    with fits.open(filename) as hdus:
+        header = hdus[0].header
+        names = [hdu.name.upper() for hdu in hdus]
+        if 'SOURCES' not in names:
+            return None
+        sources = hdus[names.index('SOURCES')].data
+        exptime = float(header.get('EXPTIME', 0.0))
+        mjd = Time(header['DATE-OBS'], format = 'isot', scale = 'utc').mjd + exptime / 2.0 / 86400.
+        return {'framename': os.path.split(filename)[1],
+                'framemjd': mjd,
+                'framefilter': str(header.get('FILTER', '')).strip(),
+                'frameexptime': exptime,
+                'framezperr': float(header.get('PTZRAWER', numpy.nan)),
+                'night': night(header['DATE-OBS']),
+                'ra': numpy.array(sources['RA'], dtype = numpy.float64),
+                'dec': numpy.array(sources['Dec'], dtype = numpy.float64),
+                'mag': numpy.array(sources['Magnitude'], dtype = numpy.float32),
+                'magerr': numpy.array(sources['Magnitude_Err'], dtype = numpy.float32)}
+
+class PhotArchive(object):
+    """ Archive of calibrated sources in HEALPix tiles and nights
+    """
+
+    def __init__(self, folder, nside = 64):
+        """ Constructor: set the archive folder and the tile size
+        """
+        self.folder = os.path.expandvars(folder)
+        self.healpix = HEALPix(nside = nside, order = 'nested')
+        self.fine = HEALPix(nside = FINENSIDE, order = 'nested')
+
+    def tilefolder(self, tile):
+        """ Returns the folder of a tile
+        """
+        return os.path.join(self.folder, 'nside%d' % self.healpix.nside, 'tile_%07d' % tile)
+
+    def partition(self, tile, nightname):
+        """ Returns the file name of the partition of a tile and night
+        """
+        return os.path.join(self.tilefolder(tile), '%s.npz' % nightname)
+
+    def read(self, tile, nightname):
+        """ Returns the columns of a partition (empty dictionary if there
+            is none)
+        """
+        filename = self.partition(tile, nightname)
+        if not os.path.exists(filename):
+            return {}
+        with numpy.load(filename) as content:
+            return {name: content[name] for name in SOURCECOLUMNS + FRAMECOLUMNS}
+
+    def write(self, tile, nightname, columns):
+        """ Writes the columns of a partition (sources sorted by hpx)
+        """
+        order = numpy.argsort(columns['hpx'], kind = 'stable')
+        for name in SOURCECOLUMNS:
+            columns[name] = columns[name][order]
+        filename = self.partition(tile, nightname)
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename), exist_ok = True)
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'wb') as f:
+            numpy.savez(f, **columns)
+        os.replace(tmpname, filename)
+
+    def ingest(self, frames):
+        """ Adds the sources of frames (list of readframe() results) to the
+            archive, replacing earlier sources of the same files in all
+            partitions of the night. Returns the number of written (or
+            removed) partitions.
+        """
+        written = 0
+        for nightname in sorted(set(frame['night'] for frame in frames)):
+            nightframes = [frame for frame in frames if frame['night'] == nightname]
+            # All sources of the night with their frame index and tiles
+            ra = numpy.concatenate([frame['ra'] for frame in nightframes])
+            dec = numpy.concatenate([frame['dec'] for frame in nightframes])
+            good = numpy.isfinite(ra) & numpy.isfinite(dec)
+            sources = {'ra': ra[good], 'dec': dec[good],
+                       'mag': numpy.concatenate([frame['mag'] for frame in nightframes])[good],
+                       'magerr': numpy.concatenate([frame['magerr'] for frame in nightframes])[good],
+                       'frame': numpy.concatenate([numpy.full(len(frame['ra']), i, dtype = numpy.int32)
+                                                   for i, frame in enumerate(nightframes)])[good]}
+            lon, lat = sources['ra'] * u.deg, sources['dec'] * u.deg
+            sources['hpx'] = self.fine.lonlat_to_healpix(lon, lat)
+            tiles = self.healpix.lonlat_to_healpix(lon, lat)
+            names = numpy.array([frame['framename'] for frame in nightframes])
+            # Tiles with new sources and tiles with earlier sources of the night
+            for tile in sorted(set(numpy.unique(tiles)) | set(self.nighttiles(nightname))):
+                intile = tiles == tile
+                old = self.read(tile, nightname)
+                # Frames of the partition which are not ingested again
+                keepframe = ~numpy.isin(old['framename'], names) if len(old) else None
+                if not intile.any():
+                    if keepframe.all():
+                        continue
+                    if not keepframe.any():
+                        os.remove(self.partition(tile, nightname))
+                        written += 1
+                        continue
+                # Frames with sources in this tile
+                used, frameindex = numpy.unique(sources['frame'][intile], return_inverse = True)
+                new = {name: sources[name][intile] for name in SOURCECOLUMNS if name != 'frame'}
+                new['frame'] = frameindex.astype(numpy.int32)
+                new['framename'] = names[used].astype('U')
+                for name in FRAMECOLUMNS[1:]:
+                    new[name] = numpy.array([nightframes[i][name] for i in used])
+                # Keep the sources of other files of the partition
+                if len(old):
+                    keep = keepframe[old['frame']]
+                    remap = numpy.cumsum(keepframe) - 1 + len(used)
+                    for name in SOURCECOLUMNS:
+                        oldvalues = remap[old['frame'][keep]] if name == 'frame' else old[name][keep]
+                        new[name] = numpy.concatenate((new[name], oldvalues.astype(new[name].dtype)))
+                    for name in FRAMECOLUMNS:
+                        values = numpy.asarray(new[name])
+                        if not len(values):
+                            values = values.astype(old[name].dtype)
+                        new[name] = numpy.concatenate((values, old[name][keepframe]))
+                self.write(tile, nightname, new)
+                written += 1
+            log.debug('Ingested %d frames of night %s' % (len(nightframes), nightname))
+        return written
+
+    def nighttiles(self, nightname):
+        """ Returns the tiles with a partition for a night
+        """
+        pattern = os.path.join(self.folder, 'nside%d' % self.healpix.nside, 'tile_*',
+                               '%s.npz' % nightname)
+        return [int(os.path.basename(os.path.dirname(filename))[5:])
+                for filename in glob.glob(pattern)]
+
+    def nights(self, tile, first = None, last = None):
+        """ Returns the nights in the archive for a tile (between first and
+            last, YYYY-MM-DD, if set)
+        """
+        folder = self.tilefolder(tile)
+        if not os.path.isdir(folder):
+            return []
+        names = sorted(name[:-4] for name in os.listdir(folder) if name.endswith('.npz'))
+        return [name for name in names if (first is None or name >= first) and
+                (last is None or name <= last)]
+
+    def cone(self, ra, dec, radius, first = None, last = None, filtername = None):
+        """ Returns the sources within radius (degrees) of ra, dec
+            (degrees) as astropy table (columns ra, dec, mag, magerr, mjd,
+            filter, exptime, zperr, filename, separation in degrees) of the
+            nights first to last (all if not set) and with filter
+            filtername (all if not set), sorted by mjd
+        """
+        finepix = numpy.unique(self.fine.cone_search_lonlat(ra * u.deg, dec * u.deg,
+                                                            radius * u.deg))
+        parts = []
+        for tile in self.healpix.cone_search_lonlat(ra * u.deg, dec * u.deg, radius * u.deg):
+            for nightname in self.nights(tile, first, last):
+                with numpy.load(self.partition(tile, nightname)) as content:
+                    hpx = content['hpx']
+                    start = numpy.searchsorted(hpx, finepix, side = 'left')
+                    stop = numpy.searchsorted(hpx, finepix, side = 'right')
+                    if not numpy.any(stop > start):
+                        continue
+                    rows = numpy.concatenate([numpy.arange(i, j) for i, j in zip(start, stop) if j > i])
+                    part = {name: content[name][rows] for name in SOURCECOLUMNS}
+                    frames = {name: content[name][part['frame']] for name in FRAMECOLUMNS}
+                sep = distance(ra, dec, part['ra'], part['dec'])
+                inside = sep <= radius
+                if filtername is not None:
+                    inside &= frames['framefilter'] == filtername
+                parts.append({'ra': part['ra'][inside], 'dec': part['dec'][inside],
+                              'mag': part['mag'][inside], 'magerr': part['magerr'][inside],
+                              'mjd': frames['framemjd'][inside],
+                              'filter': frames['framefilter'][inside],
+                              'exptime': frames['frameexptime'][inside],
+                              'zperr': frames['framezperr'][inside],
+                              'filename': frames['framename'][inside],
+                              'separation': sep[inside]})
+        names = ['ra', 'dec', 'mag', 'magerr', 'mjd', 'filter', 'exptime', 'zperr',
+                 'filename', 'separation']
+        if not len(parts):
+            return Table(names = names, dtype = [float, float, numpy.float32, numpy.float32,
+                                                 float, 'U16', float, float, 'U64', float])
+        columns = {name: numpy.concatenate([part[name] for part in parts]) for name in names}
+        order = numpy.argsort(columns['mjd'], kind = 'stable')
+        return Table({name: columns[name][order] for name in names}, names = names)
+
+    def lightcurve(self, ra, dec, radius = 1.5 / 3600., first = None, last = None,
+                   filtername = None):
+        """ Returns the light curve of the source at ra, dec (degrees): the
+            closest source within radius (degrees) of each frame, as table
+            like cone(), sorted by mjd
+        """
+        table = self.cone(ra, dec, radius, first, last, filtername)
+        if not len(table):
+            return table
+        # Closest source of each frame
+        order = numpy.lexsort((numpy.asarray(table['separation']), numpy.asarray(table['filename'])))
+        filenames = numpy.asarray(table['filename'])[order]
+        firstrow = numpy.ones(len(order), dtype = bool)
+        firstrow[1:] = filenames[1:] != filenames[:-1]
+        return table[numpy.sort(order[firstrow])]
+
+def fcalfiles(folders):
+    """ Returns the FCAL files in the folders and their subfolders
+    """
+    result = []
+    for folder in folders:
+        result += glob.glob(os.path.join(folder, '**', '*FCAL.fits'), recursive = True)
+    return sorted(result)
+
+if __name__ == '__main__':
+    """ Ingests files or prints a light curve:
+            python photarchive.py ingest ARCHIVEDIR FOLDER [FOLDER ...]
+            python photarchive.py lightcurve ARCHIVEDIR RA DEC [RADIUS]
+    """
+    if len(sys.argv) < 4 or sys.argv[1] not in ['ingest', 'lightcurve'] or \
+       (sys.argv[1] == 'lightcurve' and len(sys.argv) < 5):
+        print('Usage: python photarchive.py ingest ARCHIVEDIR FOLDER [FOLDER ...]')
+        print('       python photarchive.py lightcurve ARCHIVEDIR RA DEC [RADIUS]')
+        sys.exit(1)
+    logging.basicConfig(level = logging.INFO)
+    archive = PhotArchive(sys.argv[2])
+    if sys.argv[1] == 'ingest':
+        frames = []
+        filenames = fcalfiles([os.path.expandvars(folder) for folder in sys.argv[3:]])
+        for filename in filenames:
+            try:
+                frame = readframe(filename)
+            except Exception as error:
+                log.warning('Reading %s failed: %s' % (filename, str(error)))
+                continue
+            if frame is not None:
+                frames.append(frame)
+        written = archive.ingest(frames)
+        print('%d files, %d with sources, %d partitions written, archive %s' %
+              (len(filenames), len(frames), written, archive.folder))
+    else:
+        rastring, decstring = sys.argv[3], sys.argv[4]
+        ra = Angle(rastring, unit = u.hour if ':' in rastring else u.deg).degree
+        dec = Angle(decstring, unit = u.deg).degree
+        radius = float(sys.argv[5]) / 3600. if len(sys.argv) > 5 else 1.5 / 3600.
+        archive.lightcurve(ra, dec, radius).write(sys.stdout, format = 'ascii.csv')
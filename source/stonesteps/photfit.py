@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+""" PHOTOMETRIC FIT - Version 1.0.0
+
+    Closed form fits of the photometric calibration line
+        instrumental magnitude = offset + slope * catalog magnitude
+    for StepFluxCalSex. The weighted least squares solution (weights
+    1 / error^2) is computed from weighted sums, outliers are removed by
+    iterative sigma clipping (nsigma times the robust standard deviation
+    of the residuals) and the uncertainty of the zeropoint is estimated
+    by bootstrap resampling of the stars. The result does not depend on
+    a starting guess and the bootstrap uses a fixed random seed, so fits
+    are deterministic.
+
+    All functions take a group index for each star, so the stars of many
+    frames (for example all frames of a night) are fit at once: the sums
+    of all groups are made with numpy.bincount. The zeropoint is the
+    offset of the line at the median catalog magnitude of the group:
+        zeropoint = offset + (slope - 1) * pivot
+
+    jointfit() fits the frames of a field together (StepFluxCalJoint):
+        instrumental magnitude = offset[frame] + catalog magnitude
+                                 + colorterm * (color - color pivot)
+    one offset (zeropoint and extinction) per frame and one color term
+    for all frames, as one sparse weighted least squares problem.
+"""
+
+import numpy # numpy library
+from scipy import sparse # design matrix of the joint fit
+from scipy.sparse.linalg import lsqr # sparse least squares solver
+
+def groupsizes(group, ngroups = None):
+    """ Returns the group index array (zeros for group = None) and the
+        number of groups
+    """
+    if group is None:
+        return None, 1
+    group = numpy.asarray(group, dtype = numpy.intp)
+    if ngroups is None:
+        ngroups = int(group.max()) + 1 if len(group) else 0
+    return group, ngroups
+
+def groupmedian(values, group, ngroups):
+    """ Returns the median of values for each group (NaN for empty groups)
+    """
+    values = numpy.asarray(values, dtype = numpy.float64)
+    if group is None:
+        return numpy.array([numpy.median(values) if len(values) else numpy.nan])
+    order = numpy.lexsort((values, group))
+    counts = numpy.bincount(group, minlength = ngroups)
+    starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    low = numpy.minimum(starts + (counts - 1) // 2, len(values) - 1)
+    high = numpy.minimum(starts + counts // 2, len(values) - 1)
+    median = 0.5 * (values[order[numpy.maximum(low, 0)]] + values[order[numpy.maximum(high, 0)]])
+    median[counts == 0] = numpy.nan
+    return median
+
+def groupsum(values, group, ngroups):
+    """ Returns the sums of values for each group
+    """
+    if group is None:
+        return numpy.array([numpy.sum(values)])
+    return numpy.bincount(group, weights = values, minlength = ngroups)
+
+def linefit(x, y, weight, group = None, ngroups = None):
+    """ Returns the slope and offset of the weighted least squares line
+        y = offset + slope * x for each group. Groups where the slope is
+        undefined (one star or one catalog magnitude) get slope 1 and the
+        weighted mean difference as offset.
+    """
+    group, ngroups = groupsizes(group, ngroups)
+    x = numpy.asarray(x, dtype = numpy.float64)
+    y = numpy.asarray(y, dtype = numpy.float64)
+    weight = numpy.asarray(weight, dtype = numpy.float64)
+    s = groupsum(weight, group, ngroups)
+    sx = groupsum(weight * x, group, ngroups)
+    sy = groupsum(weight * y, group, ngroups)
+    sxx = groupsum(weight * x * x, group, ngroups)
+    sxy = groupsum(weight * x * y, group, ngroups)
+    det = s * sxx - sx * sx
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        slope = (s * sxy - sx * sy) / det
+        offset = (sxx * sy - sx * sxy) / det
+        flat = ~(numpy.abs(det) > 1e-12 * numpy.maximum(s * sxx, 1e-300))
+        slope[flat] = 1.0
+        offset[flat] = (sy[flat] - sx[flat]) / s[flat]
+    return slope, offset
+
+def clippedfit(x, y, error, group = None, ngroups = None, nsigma = 3.0, maxiter = 5):
+    """ Fits the line y = offset + slope * x with weights 1 / error^2 and
+        removes stars with residuals above nsigma times the robust
+        standard deviation (1.4826 median absolute deviation) of the
+        residuals of their group, until no more stars are removed.
+        Returns slope, offset and scatter (robust standard deviation of
+        the residuals) for each group and the mask of the used stars.
+    """
+    group, ngroups = groupsizes(group, ngroups)
+    x = numpy.asarray(x, dtype = numpy.float64)
+    y = numpy.asarray(y, dtype = numpy.float64)
+    weight = 1.0 / numpy.maximum(numpy.asarray(error, dtype = numpy.float64), 1e-6) ** 2
+    keep = numpy.isfinite(x) & numpy.isfinite(y) & numpy.isfinite(weight)
+    index = numpy.zeros(len(x), dtype = numpy.intp) if group is None else group
+    for iteration in range(maxiter + 1):
+        sub = None if group is None else group[keep]
+        slope, offset = linefit(x[keep], y[keep], weight[keep], sub, ngroups)
+        residual = y - offset[index] - slope[index] * x
+        scatter = 1.4826 * groupmedian(numpy.abs(residual[keep]), sub, ngroups)
+        if iteration == maxiter or nsigma <= 0:
+            break
+        newkeep = keep & (numpy.abs(residual) <= nsigma * numpy.maximum(scatter[index], 1e-6))
+        # Keep at least 2 stars per group
+        short = groupsum(newkeep.astype(float), group, ngroups) < 2
+        newkeep |= keep & short[index]
+        if numpy.array_equal(newkeep, keep):
+            break
+        keep = newkeep
+    return slope, offset, scatter, keep
+
+def zeropoint(slope, offset, pivot):
+    """ Returns the zeropoint: the offset of the line at the pivot
+        magnitude, corrected for a slope different from 1
+    """
+    return offset + (slope - 1.0) * pivot
+
+def bootstrap(x, y, error, group = None, ngroups = None, nboot = 200, seed = 1, chunk = 20):
+    """ Returns the bootstrap standard deviation of the zeropoint of each
+        group: the stars of each group are resampled with replacement
+        nboot times (chunk resamples at once, fixed random seed), each
+        resample is fit with linefit (without clipping) and the zeropoint
+        at the median catalog magnitude of the group is computed
+    """
+    group, ngroups = groupsizes(group, ngroups)
+    x = numpy.asarray(x, dtype = numpy.float64)
+    y = numpy.asarray(y, dtype = numpy.float64)
+    weight = 1.0 / numpy.maximum(numpy.asarray(error, dtype = numpy.float64), 1e-6) ** 2
+    index = numpy.zeros(len(x), dtype = numpy.intp) if group is None else group
+    pivot = groupmedian(x, group, ngroups)
+    counts = numpy.bincount(index, minlength = ngroups)
+    if nboot < 2 or not len(x):
+        return numpy.zeros(ngroups)
+    # Stars sorted by group: a resample of star j is a random star of its group
+    order = numpy.argsort(index, kind = 'stable')
+    starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    slotstart = starts[index[order]]
+    slotcount = counts[index[order]]
+    rng = numpy.random.default_rng(seed)
+    points = []
+    for first in range(0, nboot, chunk):
+        n = min(chunk, nboot - first)
+        pick = order[slotstart + (rng.random((n, len(x))) * slotcount).astype(numpy.intp)]
+        # Each resample is a set of groups: group b * ngroups + g
+        bootgroup = (numpy.arange(n)[:, None] * ngroups + index[order][None, :]).ravel()
+        slope, offset = linefit(x[pick].ravel(), y[pick].ravel(), weight[pick].ravel(),
+                                bootgroup, n * ngroups)
+        points.append(zeropoint(slope, offset, numpy.tile(pivot, n)).reshape(n, ngroups))
+    points = numpy.concatenate(points)
+    error = numpy.std(points, axis = 0, ddof = 1)
+    error[counts < 2] = numpy.nan
+    return error
+
+def jointfit(frame, catmag, color, instmag, error, nframes, nsigma = 3.0, maxiter = 5):
+    """ Fits instmag = offset[frame] + catmag + colorterm * (color - pivot)
+        for all stars of all frames at once (weights 1 / error^2, sparse
+        design matrix solved with lsqr). The color pivot is the median
+        color of the stars. Stars with residuals above nsigma times the
+        robust standard deviation of the residuals of their frame are
+        removed until no more stars are removed. The uncertainties are
+        from the covariance matrix, scaled with the reduced chi square.
+        Returns offsets, offset errors and scatter (robust standard
+        deviation of the residuals) for each frame (NaN for frames with
+        less than 2 stars), the color term and its error, the color pivot
+        and the mask of the used stars.
+    """
+    frame = numpy.asarray(frame, dtype = numpy.intp)
+    delta = numpy.asarray(instmag, dtype = numpy.float64) - numpy.asarray(catmag, dtype = numpy.float64)
+    color = numpy.asarray(color, dtype = numpy.float64)
+    weight = 1.0 / numpy.maximum(numpy.asarray(error, dtype = numpy.float64), 1e-6) ** 2
+    keep = numpy.isfinite(delta) & numpy.isfinite(color) & numpy.isfinite(weight)
+    pivot = numpy.median(color[keep]) if keep.any() else 0.0
+    color = color - pivot
+    for iteration in range(maxiter + 1):
+        # Frames with less than 2 stars are not fit
+        counts = numpy.bincount(frame[keep], minlength = nframes)
+        used = keep & (counts[frame] >= 2)
+        sqw = numpy.sqrt(weight[used])
+        n = int(used.sum())
+        # Design matrix: one column per frame offset, one for the color term
+        design = sparse.csr_matrix(
+            (numpy.concatenate((sqw, sqw * color[used])),
+             (numpy.concatenate((numpy.arange(n), numpy.arange(n))),
+              numpy.concatenate((frame[used], numpy.full(n, nframes))))),
+            shape = (n, nframes + 1))
+        solution = lsqr(design, sqw * delta[used], atol = 1e-12, btol = 1e-12)[0]
+        offset = solution[:nframes]
+        colorterm = solution[nframes]
+        residual = delta - offset[frame] - colorterm * color
+        scatter = 1.4826 * groupmedian(numpy.abs(residual[used]), frame[used], nframes)
+        if iteration == maxiter or nsigma <= 0:
+            break
+        newkeep = keep & (numpy.abs(residual) <= nsigma * numpy.maximum(scatter[frame], 1e-6))
+        if numpy.array_equal(newkeep, keep):
+            break
+        keep = newkeep
+    # Covariance from the normal matrix (small: frames + 1)
+    normal = (design.T @ design).toarray()
+    fitted = counts >= 2
+    params = numpy.append(fitted, True)
+    cov = numpy.zeros_like(normal)
+    cov[numpy.ix_(params, params)] = numpy.linalg.pinv(normal[numpy.ix_(params, params)])
+    dof = max(n - int(params.sum()), 1)
+    chi2 = numpy.sum(weight[used] * residual[used] ** 2) / dof
+    errors = numpy.sqrt(numpy.diag(cov) * chi2)
+    offset = numpy.where(fitted, offset, numpy.nan)
+    offseterr = numpy.where(fitted, errors[:nframes], numpy.nan)
+    return offset, offseterr, scatter, colorterm, errors[nframes], pivot, used
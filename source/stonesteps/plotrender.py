@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+""" PLOT RENDER - Version 1.0.0
+
+    Deferred rendering of diagnostic plots. Pipe steps do not draw plots
+    while they reduce a frame, they only save the few arrays a plot needs
+    with saveplotdata() as small numpy .npz file (ex. *FCALplot.npz from
+    StepFluxCalSex). The PNG files are rendered later in batch:
+        python plotrender.py [-p PROCESSES] [-f] FOLDER [FOLDER ...]
+    or with PipeExecuteAutoDay.py --render-plots after the night.
+
+    The plots are drawn with the matplotlib Agg canvas directly (no
+    pyplot), each worker process reuses one figure for all its plots.
+    The plot files are split between the processes of a process pool.
+    Plots are only rendered if the PNG file is missing or older than the
+    plot data (use -f to render all).
+
+    Each plot data file has a 'plotkind' entry which selects the drawing
+    function in RENDERERS.
+"""
+
+import os # os library
+import glob # to find the plot data files
+import logging # logging library
+import argparse # command line arguments
+import multiprocessing # process pool
+import numpy # numpy library
+
+log = logging.getLogger('pipe.plotrender')
+
+# Suffix of plot data files
+PLOTSUFFIX = 'plot.npz'
+
+def saveplotdata(filename, plotkind, **arrays):
+    """ Saves the arrays of a plot (plotkind selects the renderer) in
+        filename (should end with PLOTSUFFIX, the PNG file gets the same
+        name with .png)
+    """
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as f:
+        numpy.savez(f, plotkind = plotkind, **arrays)
+    os.replace(tmpname, filename)
+
+def drawfluxcal(figure, data):
+    """ Draws the calibration fit of StepFluxCalSex: catalog against
+        extracted magnitudes, fitted line and guess range
+    """
+    axes = figure.add_subplot(1, 1, 1)
+    catmag, starmag, starerr = data['catmag'], data['starmag'], data['starerr']
+    guess, guessrange = float(data['guessoffset']), float(data['guessrange'])
+    slope, offset = float(data['slope']), float(data['offset'])
+    # Guess range
+    gmin, gmax = numpy.min(catmag), numpy.max(catmag)
+    axes.fill([gmin, gmin, gmax, gmax], [gmin + guess - guessrange, gmin + guess + guessrange,
+                                         gmax + guess + guessrange, gmax + guess - guessrange], 'c',
+              label = 'GuessDistMed Range')
+    # Fits
+    axes.plot(catmag, slope * catmag + offset, label = 'Fit')
+    axes.plot(catmag, catmag + guess, label = 'Fit-Guess')
+    # Data points: all matched stars and fitted stars
+    axes.errorbar(data['matchcatmag'], data['matchstarmag'], yerr = data['matchstarerr'],
+                  fmt = 'o', linestyle = 'none', label = 'd<distval Data')
+    axes.errorbar(catmag, starmag, yerr = starerr, fmt = 'o', linestyle = 'none',
+                  label = 'Good Data')
+    axes.legend()
+    axes.set_ylabel('Source extrator magnitude')
+    axes.set_xlabel('Star catalog magnitude')
+    axes.set_title(str(data['title']))
+
+# Drawing functions for each plot kind
+RENDERERS = {'fluxcal': drawfluxcal}
+
+def pngname(filename):
+    """ Returns the PNG file name of a plot data file
+    """
+    return filename[:-len('.npz')] + '.png'
+
+def render(filenames):
+    """ Renders the plot data files with one reused figure, returns the
+        number of rendered plots
+    """
+    # Import here: matplotlib is only needed to render
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    figure = Figure(figsize = (10, 7))
+    canvas = FigureCanvasAgg(figure)
+    rendered = 0
+    for filename in filenames:
+        try:
+            with numpy.load(filename) as content:
+                data = {name: content[name] for name in content.files}
+            figure.clear()
+            RENDERERS[str(data['plotkind'])](figure, data)
+            canvas.print_png(pngname(filename))
+            rendered += 1
+        except Exception as error:
+            log.warning('Rendering %s failed: %s' % (filename, str(error)))
+    return rendered
+
+def outdated(filename):
+    """ Returns True if the PNG of a plot data file is missing or older
+    """
+    png = pngname(filename)
+    return not os.path.exists(png) or os.path.getmtime(png) < os.path.getmtime(filename)
+
+def findplots(folders, force = False):
+    """ Returns the plot data files in the folders and their subfolders
+        (only those with missing or older PNG files if force is False)
+    """
+    filenames = []
+    for folder in folders:
+        filenames += glob.glob(os.path.join(folder, '**', '*' + PLOTSUFFIX), recursive = True)
+    return sorted(filename for filename in filenames if force or outdated(filename))
+
+def renderall(filenames, processes = None):
+    """ Renders the plot data files with a pool of processes (default:
+        number of CPUs), returns the number of rendered plots
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(filenames)))
+    if processes <= 1:
+        return render(filenames)
+    # One chunk of files per process: each process makes one figure
+    chunks = [filenames[i::processes] for i in range(processes)]
+    with multiprocessing.Pool(processes) as pool:
+        return sum(pool.map(render, chunks))
+
+if __name__ == '__main__':
+    """ Renders the plots of folders:
+            python plotrender.py [-p PROCESSES] [-f] FOLDER [FOLDER ...]
+    """
+    parser = argparse.ArgumentParser(description = 'Render deferred pipeline plots')
+    parser.add_argument('folders', nargs = '+', help = 'folders with plot data files')
+    parser.add_argument('-p', '--processes', type = int, default = None,
+                        help = 'number of processes (default: number of CPUs)')
+    parser.add_argument('-f', '--force', action = 'store_true',
+                        help = 'render all plots (also if the PNG file is up to date)')
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO)
+    filenames = findplots([os.path.expandvars(folder) for folder in args.folders], args.force)
+    rendered = renderall(filenames, args.processes)
+    print('%d plots rendered (%d plot data files)' % (rendered, len(filenames)))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+""" SEP SOURCE EXTRACTION - Version 1.0.0
+
+    This module extracts sources from an image with the sep library
+    (Source Extractor as a python library, see
+    Developments/stepwebastrometry/stepsep.py) and writes them as an
+    astrometry.net xylist. solve-field can then be run on the xylist
+    (with --width and --height) instead of running its own detection on
+    the image for every attempt.
+
+    sexcatalog() emulates a SExtractor run in memory for StepFluxCalSex:
+    the settings are read from the SExtractor configuration and filter
+    files, the catalog has the SExtractor columns (FLUX_AUTO,
+    FLUXERR_AUTO, FLUX_APER, ALPHA_J2000, DELTA_J2000, ...) and the
+    background model (see bkgmodel.py, same mesh estimate as SExtractor)
+    is returned instead of a BACKGROUND check image.
+"""
+
+import numpy # numpy library
+from astropy.io import fits # to write the xylist
+from astropy.table import Table # catalog table
+from astropy import wcs # to get ALPHA / DELTA
+from stonesteps.bkgmodel import BkgModel # background mesh model
+
+# SExtractor defaults of the settings used by sexcatalog
+SEXDEFAULTS = {'DETECT_MINAREA': '5', 'DETECT_THRESH': '1.5', 'FILTER': 'Y',
+               'DEBLEND_NTHRESH': '32', 'DEBLEND_MINCONT': '0.005',
+               'CLEAN': 'Y', 'CLEAN_PARAM': '1.0', 'PHOT_APERTURES': '5',
+               'PHOT_AUTOPARAMS': '2.5, 3.5', 'BACK_SIZE': '64',
+               'BACK_FILTERSIZE': '3', 'GAIN': '0.0', 'MEMORY_PIXSTACK': '300000'}
+
+def extract(image, thresh = 1.5, maxsources = 0):
+    """ Returns the sources in image as sep object array, sorted by
+        flux (brightest first). The background is subtracted before
+        extraction, thresh is the detection threshold in units of the
+        background rms. If maxsources > 0 only the brightest maxsources
+        sources are returned.
+    """
+    import sep # source extraction library (only needed here)
+    # sep needs native byte order and C-contiguous data
+    data = numpy.ascontiguousarray(image, dtype = numpy.float32)
+    bkg = sep.Background(data)
+    data = data - bkg.back()
+    objects = sep.extract(data, thresh, err = bkg.globalrms)
+    objects = objects[numpy.argsort(objects['flux'])[::-1]]
+    if maxsources > 0:
+        objects = objects[:maxsources]
+    return objects
+
+def writexylist(filename, objects, width, height):
+    """ Writes the sources as xylist FITS table with columns X, Y (in
+        FITS pixel coordinates, starting at 1) and FLUX. The image size
+        is stored in IMAGEW and IMAGEH.
+    """
+    cols = [fits.Column(name = 'X', format = 'D', array = objects['x'] + 1.0),
+            fits.Column(name = 'Y', format = 'D', array = objects['y'] + 1.0),
+            fits.Column(name = 'FLUX', format = 'D', array = objects['flux'])]
+    table = fits.BinTableHDU.from_columns(cols)
+    table.header['IMAGEW'] = (width, 'Image width (pixels)')
+    table.header['IMAGEH'] = (height, 'Image height (pixels)')
+    fits.HDUList([fits.PrimaryHDU(), table]).writeto(filename, overwrite = True)
+
+def readsexconfig(filename):
+    """ Returns the settings of a SExtractor configuration file as
+        dictionary of strings (SEXDEFAULTS for missing settings)
+    """
+    config = dict(SEXDEFAULTS)
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#')[0].split()
+            if len(line) > 1:
+                config[line[0].upper()] = ' '.join(line[1:])
+    return config
+
+def readsexfilter(filename):
+    """ Returns the convolution kernel of a SExtractor filter file
+    """
+    rows = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) and line[0] not in '#C':
+                rows.append([float(v) for v in line.split()])
+    return numpy.array(rows, dtype = numpy.float32)
+
+def sexcatalog(image, header, config, kernel = None, model = None):
+    """ Extracts the sources of image like SExtractor with the settings
+        in config (see readsexconfig) and the filter kernel. Returns the
+        catalog (astropy table with the columns NUMBER, X_IMAGE, Y_IMAGE,
+        FLUX_APER, FLUX_AUTO, FLUXERR_AUTO, ALPHA_J2000, DELTA_J2000) and
+        the background model (BkgModel). ALPHA / DELTA are computed with
+        the WCS in header. A background model of the image (with the mesh
+        size BACK_SIZE) can be given instead of estimating it again.
+    """
+    import sep # source extraction library (only needed here)
+    values = lambda key: [float(v) for v in config[key].replace(',', ' ').split()]
+    # sep needs native byte order and C-contiguous data
+    data = numpy.ascontiguousarray(image, dtype = numpy.float32)
+    backsize = values('BACK_SIZE')
+    backfilter = values('BACK_FILTERSIZE')
+    if model is None:
+        model = BkgModel.fromimage(data, [int(backsize[0]), int(backsize[-1])],
+                                   [int(backfilter[0]), int(backfilter[-1])])
+    rms = model.rmsimage()
+    data = data - model.background()
+    # Detection
+    sep.set_extract_pixstack(int(values('MEMORY_PIXSTACK')[0]))
+    if config['FILTER'].upper()[:1] != 'Y':
+        kernel = None
+    elif kernel is None:
+        kernel = numpy.array([[1, 2, 1], [2, 4, 2], [1, 2, 1]], dtype = numpy.float32)
+    objects = sep.extract(data, values('DETECT_THRESH')[0], err = rms,
+                          minarea = int(values('DETECT_MINAREA')[0]),
+                          filter_kernel = kernel,
+                          deblend_nthresh = int(values('DEBLEND_NTHRESH')[0]),
+                          deblend_cont = values('DEBLEND_MINCONT')[0],
+                          clean = config['CLEAN'].upper()[:1] == 'Y',
+                          clean_param = values('CLEAN_PARAM')[0])
+    gain = values('GAIN')[0]
+    gain = gain if gain > 0 else None
+    x = objects['x']
+    y = objects['y']
+    # Kron (AUTO) flux, a circle of the minimal radius for small Kron radii
+    kronfact, minradius = values('PHOT_AUTOPARAMS')[:2]
+    theta = numpy.clip(objects['theta'], -numpy.pi / 2, numpy.pi / 2)
+    kronrad, kronflag = sep.kron_radius(data, x, y, objects['a'], objects['b'], theta, 6.0)
+    kronrad = numpy.nan_to_num(kronrad)
+    flux, fluxerr, flag = sep.sum_ellipse(data, x, y, objects['a'], objects['b'], theta,
+                                          kronfact * kronrad, err = rms, gain = gain, subpix = 1)
+    small = kronfact * kronrad * numpy.sqrt(objects['a'] * objects['b']) < minradius
+    if small.any():
+        cflux, cfluxerr, cflag = sep.sum_circle(data, x[small], y[small], minradius,
+                                                err = rms, gain = gain, subpix = 1)
+        flux[small] = cflux
+        fluxerr[small] = cfluxerr
+    # Aperture flux (PHOT_APERTURES is the diameter)
+    aperflux, apererr, aperflag = sep.sum_circle(data, x, y, values('PHOT_APERTURES')[0] / 2.0,
+                                                 err = rms, gain = gain, subpix = 5)
+    # Sky positions (sep positions start at 0, SExtractor positions at 1)
+    alpha, delta = wcs.WCS(header).all_pix2world(x, y, 0)
+    catalog = Table()
+    catalog['NUMBER'] = numpy.arange(1, len(objects) + 1, dtype = numpy.int32)
+    catalog['X_IMAGE'] = x + 1.0
+    catalog['Y_IMAGE'] = y + 1.0
+    catalog['FLUX_APER'] = aperflux
+    catalog['FLUX_AUTO'] = flux
+    catalog['FLUXERR_AUTO'] = fluxerr
+    catalog['ALPHA_J2000'] = alpha
+    catalog['DELTA_J2000'] = delta
+    for name in ['X_IMAGE', 'Y_IMAGE']:
+        catalog[name].unit = 'pix'
+    for name in ['FLUX_APER', 'FLUX_AUTO', 'FLUXERR_AUTO']:
+        catalog[name].unit = 'ct'
+    for name in ['ALPHA_J2000', 'DELTA_J2000']:
+        catalog[name].unit = 'deg'
+    return catalog, model
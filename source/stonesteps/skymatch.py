@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+""" SKY MATCH - Version 1.0.0
+
+    Cross-matching of sky catalogs with a KD-tree. The RA / Dec of the
+    catalog are converted to unit vectors once and put into a
+    scipy.spatial.cKDTree. Angular radii are converted to chord lengths
+    between the unit vectors, so all searches are euclidean tree queries.
+    A SkyMatcher made for one catalog can be used for many matches (for
+    example the same reference catalog for the frames of a night).
+
+    Matches (all positions and radii in degrees):
+    - nearest(ra, dec): the nearest catalog source for each position,
+      like SkyCoord.match_to_catalog_sky
+    - match(ra, dec, radius): pairs of positions and their nearest
+      catalog source within radius
+    - within(ra, dec, radius): all pairs closer than radius
+    - onetoone(ra, dec, radius): pairs within radius where each position
+      and each catalog source is used at most once (closest pairs first)
+    The pairs are returned as compact index arrays (index of the position,
+    index in the catalog) and their separations. Positions are queried in
+    spatial order (coarse grid cells), which keeps the tree nodes of
+    consecutive queries in the CPU cache for large catalogs.
+"""
+
+import numpy # numpy library
+from scipy.spatial import cKDTree # to match the unit vectors
+
+def unitvectors(ra, dec):
+    """ Returns the unit vectors (n, 3) of positions ra, dec (degrees)
+    """
+    ra = numpy.radians(numpy.asarray(ra, dtype = numpy.float64))
+    dec = numpy.radians(numpy.asarray(dec, dtype = numpy.float64))
+    cosdec = numpy.cos(dec)
+    return numpy.column_stack((cosdec * numpy.cos(ra), cosdec * numpy.sin(ra), numpy.sin(dec)))
+
+def spatialorder(vectors, persource = 16):
+    """ Returns the order of unit vectors by coarse grid cells (about
+        persource vectors per cell) along the two directions of the
+        largest extent, rows of cells in alternating direction
+    """
+    if len(vectors) < 2:
+        return numpy.arange(len(vectors))
+    low = vectors.min(axis = 0)
+    span = vectors.max(axis = 0) - low
+    dims = numpy.argsort(span)[::-1][:2]
+    cells = max(1, int(numpy.sqrt(len(vectors) / persource)))
+    cell = ((vectors[:, dims] - low[dims]) / numpy.maximum(span[dims], 1e-12) * cells).astype(int)
+    cell = numpy.minimum(cell, cells - 1)
+    column = numpy.where(cell[:, 0] % 2, cells - 1 - cell[:, 1], cell[:, 1])
+    return numpy.argsort(cell[:, 0] * cells + column, kind = 'stable')
+
+def firstof(keys):
+    """ Returns a mask of the first occurrence of each value in keys
+    """
+    order = numpy.argsort(keys, kind = 'stable')
+    start = numpy.ones(len(keys), dtype = bool)
+    start[1:] = keys[order[1:]] != keys[order[:-1]]
+    mask = numpy.zeros(len(keys), dtype = bool)
+    mask[order[start]] = True
+    return mask
+
+def chord(angle):
+    """ Returns the chord length between unit vectors separated by angle
+        (degrees)
+    """
+    return 2.0 * numpy.sin(numpy.radians(numpy.minimum(angle, 180.0)) / 2.0)
+
+def angle(chord):
+    """ Returns the angle (degrees) between unit vectors with a chord
+        length chord
+    """
+    return numpy.degrees(2.0 * numpy.arcsin(numpy.clip(chord / 2.0, 0.0, 1.0)))
+
+class SkyMatcher(object):
+    """ KD-tree of a catalog for cross-matching
+    """
+
+    def __init__(self, ra, dec):
+        """ Constructor: make the tree of the catalog positions ra, dec
+            (degrees)
+        """
+        self.vectors = unitvectors(ra, dec)
+        self.tree = cKDTree(self.vectors, balanced_tree = False)
+
+    def __len__(self):
+        """ Returns the number of catalog sources
+        """
+        return len(self.vectors)
+
+    def query(self, vectors, radius = None):
+        """ Returns the chord distances and indices of the nearest catalog
+            sources of the vectors (index len(self) and infinite distance
+            if there is none within radius in degrees)
+        """
+        order = spatialorder(vectors)
+        bound = numpy.inf if radius is None else chord(radius)
+        dist = numpy.empty(len(vectors))
+        ind = numpy.empty(len(vectors), dtype = numpy.intp)
+        dist[order], ind[order] = self.tree.query(vectors[order], distance_upper_bound = bound)
+        return dist, ind
+
+    def nearest(self, ra, dec):
+        """ Returns the index of the nearest catalog source for each
+            position and the separations (degrees)
+        """
+        vectors = unitvectors(ra, dec)
+        if not len(self) or not len(vectors):
+            return numpy.zeros(len(vectors), dtype = numpy.intp), numpy.full(len(vectors), numpy.inf)
+        dist, ind = self.query(vectors)
+        return ind, angle(dist)
+
+    def match(self, ra, dec, radius):
+        """ Returns the pairs of positions and their nearest catalog
+            source within radius (degrees): position indices, catalog
+            indices and separations (degrees)
+        """
+        vectors = unitvectors(ra, dec)
+        if not len(self) or not len(vectors):
+            return numpy.zeros(0, numpy.intp), numpy.zeros(0, numpy.intp), numpy.zeros(0)
+        dist, ind = self.query(vectors, radius)
+        found = numpy.nonzero(ind < len(self))[0]
+        return found, ind[found], angle(dist[found])
+
+    def within(self, ra, dec, radius):
+        """ Returns all pairs of positions and catalog sources closer than
+            radius (degrees): position indices, catalog indices and
+            separations (degrees), sorted by position index
+        """
+        vectors = unitvectors(ra, dec)
+        if not len(self) or not len(vectors):
+            return numpy.zeros(0, numpy.intp), numpy.zeros(0, numpy.intp), numpy.zeros(0)
+        pairs = cKDTree(vectors).sparse_distance_matrix(self.tree, chord(radius),
+                                                         output_type = 'ndarray')
+        order = numpy.lexsort((pairs['v'], pairs['i']))
+        pairs = pairs[order]
+        return pairs['i'].astype(numpy.intp), pairs['j'].astype(numpy.intp), angle(pairs['v'])
+
+    def onetoone(self, ra, dec, radius):
+        """ Returns the one to one pairs of positions and catalog sources
+            within radius (degrees): position indices, catalog indices and
+            separations (degrees), sorted by position index. Pairs which
+            are the closest pair of both their position and catalog source
+            are taken first, then the remaining pairs are searched again
+            (same result as taking the closest pairs one by one).
+        """
+        first, second, sep = self.within(ra, dec, radius)
+        # Pairs by separation, then the closest pair of each position and
+        # of each catalog source is the first pair with its index
+        order = numpy.argsort(sep, kind = 'stable')
+        first, second, sep = first[order], second[order], sep[order]
+        keep = numpy.zeros(len(sep), dtype = bool)
+        usedfirst = numpy.zeros(first.max() + 1 if len(first) else 0, dtype = bool)
+        usedsecond = numpy.zeros(len(self), dtype = bool)
+        todo = numpy.arange(len(sep))
+        while len(todo):
+            mutual = todo[firstof(first[todo]) & firstof(second[todo])]
+            keep[mutual] = True
+            # Remove the pairs of the used positions and catalog sources
+            usedfirst[first[mutual]] = True
+            usedsecond[second[mutual]] = True
+            todo = todo[~(usedfirst[first[todo]] | usedsecond[second[todo]])]
+        keep = numpy.nonzero(keep)[0]
+        keep = keep[numpy.argsort(first[keep], kind = 'stable')]
+        return first[keep], second[keep], sep[keep]
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+""" PIPE STEP ASTROMETRY GROUP - Version 1.0.0
+
+    This multi-input pipe step adds WCS information to a sequence of
+    frames of the same field (an object folder usually holds several
+    frames taken minutes apart). Instead of solving each frame:
+    - the frames are grouped by binning, image size and pointing
+    - the frame with the most stars of each group (the reference) is
+      solved with the solver step (StepAstroRefine or StepAstrometry,
+      configured in its own section)
+    - the stars of the other frames are matched with the stars of the
+      reference (see wcsmatch.registerstars), their WCS is derived from
+      the reference WCS and the fitted transform
+    Frames which can not be registered (too few matched stars or large
+    residuals) are solved with the solver step. If the reference can not
+    be solved, the next frame of the group is tried, the frames tried
+    before are registered to the new reference. Frames which the solver
+    step leaves without WCS (ASTRSTAT set, see StepAstrometry) and which
+    can not be registered are passed on like with StepAstrometry. Frames
+    for which the solver step fails are removed from the output.
+
+    The step can replace StepAstroRefine or StepAstrometry in the
+    stepslist, it uses the same file name identifier (WCS).
+"""
+
+import logging # logging object library
+import os # library for operating system calls
+from astropy import wcs # WCS object
+from astropy.coordinates import Angle
+import astropy.units as u
+from darepype.drp import StepMOParent # pipe step parent object
+from stonesteps.stepastrometry import StepAstrometry # astrometry solver
+from stonesteps.stepastrorefine import StepAstroRefine # catalog WCS solver
+from stonesteps.sepextract import extract # source extraction
+from stonesteps.indexmap import distance # angular distance
+from stonesteps.wcsmatch import registerstars, transformwcs, setwcs # WCS matching
+
+# Solver steps for the reference frames
+SOLVERS = {'StepAstroRefine': StepAstroRefine, 'StepAstrometry': StepAstrometry}
+
+class StepAstroGroup(StepMOParent):
+    """ Pipeline Step Object to add WCS to groups of frames of the same field
+    """
+    stepver = '0.1' # pipe step version
+
+    def __init__(self):
+        """ Constructor: Initialize data objects and variables
+        """
+        # call superclass constructor (calls setup)
+        super(StepAstroGroup,self).__init__()
+        # set configuration
+        self.log.debug('Init: done')
+
+    def setup(self):
+        """ ### Names and Parameters need to be Set Here ###
+            Sets the internal names for the function and for saved files.
+            Defines the input parameters for the current pipe step.
+            Setup() is called at the end of __init__
+            The parameters are stored in a list containing the following
+            information:
+            - name: The name for the parameter. This name is used when
+                    calling the pipe step from command line or python shell.
+                    It is also used to identify the parameter in the pipeline
+                    configuration file.
+            - default: A default value for the parameter. If nothing, set
+                       '' for strings, 0 for integers and 0.0 for floats
+            - help: A short description of the parameter.
+        """
+        ### Set Names
+        # Name of the pipeline reduction step
+        self.name='astrogroup'
+        # Shortcut for pipeline reduction step and identifier for
+        # saved file names.
+        self.procname = 'WCS'
+        # Set Logger for this pipe step
+        self.log = logging.getLogger('pipe.step.%s' % self.name)
+        ### Set Parameter list
+        # Clear Parameter list
+        self.paramlist = []
+        # Append parameters
+        self.paramlist.append(['solver', 'StepAstroRefine',
+                               'Pipe step to solve the reference frames ' +
+                               '(StepAstroRefine or StepAstrometry)'])
+        self.paramlist.append(['groupradius', 0.05,
+                               'Maximal pointing difference of frames in a group (degrees)'])
+        self.paramlist.append(['sourcethresh', 5.0,
+                               'Star detection threshold (in background rms)'])
+        self.paramlist.append(['sourcecount', 300,
+                               'Maximal number of stars (brightest) to match'])
+        self.paramlist.append(['triangles', 20,
+                               'Number of brightest stars used for triangle matching'])
+        self.paramlist.append(['matchradius', 2.0,
+                               'Maximal distance of matched stars (pixels)'])
+        self.paramlist.append(['minmatch', 10,
+                               'Minimal number of matched stars'])
+        self.paramlist.append(['maxrms', 0.5,
+                               'Maximal rms registration residual (pixels), the solver ' +
+                               'is run for frames with larger residuals'])
+        self.paramlist.append(['sipdegree', 2,
+                               'Degree of the SIP distortion terms (0 for none)'])
+        # confirm end of setup
+        self.log.debug('Setup: done')
+
+    def run(self):
+        """ Runs the data reduction algorithm. The self.datain is run
+            through the code, the result is in self.dataout.
+        """
+        solver = self.getarg('solver')
+        if solver not in SOLVERS:
+            raise ValueError('Unknown solver step %s' % solver)
+        self.solver = SOLVERS[solver]()
+        # Get the stars of all frames
+        self.stars = []
+        for data in self.datain:
+            try:
+                self.stars.append(extract(data.image, self.getarg('sourcethresh'),
+                                          self.getarg('sourcecount')))
+            except Exception as error:
+                self.log.warning('Source extraction failed for %s: %s' %
+                                 (os.path.split(data.filename)[1], str(error)))
+                self.stars.append(None)
+        # Solve each group, results are stored by input index
+        results = [None] * len(self.datain)
+        for group in self.groups():
+            self.solvegroup(group, results)
+        self.dataout = [result for result in results if result is not None]
+        if not len(self.dataout):
+            raise RuntimeError('No frame could be solved')
+        self.log.debug('Run: Done')
+
+    def groups(self):
+        """ Returns the groups of frames (lists of input indices). Frames
+            are in a group if they have the same binning and image size
+            and their pointing is within groupradius of the first frame
+            of the group.
+        """
+        groups = []
+        keys = []
+        for i, data in enumerate(self.datain):
+            try:
+                ra = Angle(data.getheadval('RA'), unit=u.hour).degree
+                dec = Angle(data.getheadval('DEC'), unit=u.deg).degree
+            except Exception:
+                # No pointing: the frame is solved alone
+                groups.append([i])
+                keys.append(None)
+                continue
+            key = (data.getheadval('XBIN', errmsg = False), data.image.shape, ra, dec)
+            for group, groupkey in zip(groups, keys):
+                if ( groupkey is not None and groupkey[:2] == key[:2] and
+                     distance(ra, dec, groupkey[2], groupkey[3]) < self.getarg('groupradius') ):
+                    group.append(i)
+                    break
+            else:
+                groups.append([i])
+                keys.append(key)
+        return groups
+
+    def solvegroup(self, group, results):
+        """ Solves the reference frame of the group and registers the
+            other frames to it. The results are stored in results.
+        """
+        # Try the frames with the most stars first as reference
+        order = sorted(group, key = lambda i: -len(self.stars[i]) if self.stars[i] is not None else 0)
+        reference = None
+        attempts = {}
+        for i in order:
+            attempts[i] = self.solve(i)
+            if self.solved(attempts[i]):
+                reference = i
+                break
+        if reference is None:
+            # No WCS in the group: frames are passed on as the solver left them
+            for i in attempts:
+                results[i] = attempts[i]
+            return
+        results[reference] = attempts[reference]
+        refname = os.path.split(self.datain[reference].filename)[1]
+        refwcs = wcs.WCS(results[reference].header)
+        refstars = self.stars[reference]
+        for i in group:
+            if i == reference:
+                continue
+            data = self.datain[i]
+            filename = os.path.split(data.filename)[1]
+            matrix, nmatch, rms = None, 0, 0.0
+            if self.stars[i] is not None and refstars is not None:
+                try:
+                    matrix, nmatch, rms = registerstars(self.stars[i]['x'], self.stars[i]['y'],
+                                                        refstars['x'], refstars['y'],
+                                                        self.getarg('triangles'),
+                                                        self.getarg('matchradius'))
+                except Exception as error:
+                    self.log.warning('Registration failed for %s: %s' % (filename, str(error)))
+            if matrix is None or nmatch < self.getarg('minmatch') or rms > self.getarg('maxrms'):
+                if i in attempts:
+                    # Solver already tried as reference: keep its unsolved output
+                    self.log.info('Registration of %s to %s failed (%d stars, rms %.2f pixels)' %
+                                  (filename, refname, nmatch, rms))
+                    results[i] = attempts[i]
+                else:
+                    self.log.info('Registration of %s to %s failed (%d stars, rms %.2f pixels)' %
+                                  (filename, refname, nmatch, rms) + ' - running solver')
+                    results[i] = self.solve(i)
+                continue
+            height, width = data.image.shape
+            w = transformwcs(refwcs, matrix, width, height, self.getarg('sipdegree'))
+            dataout = data.copy()
+            setwcs(dataout.header, w)
+            histmsg = 'AstroGroup: registered to %s, %d stars, rms %.2f pixels' % (refname, nmatch, rms)
+            dataout.setheadval('HISTORY', histmsg)
+            # Set RA/Dec of the image center
+            ra, dec = w.all_pix2world((width - 1) / 2.0, (height - 1) / 2.0, 0)
+            dataout.header['RA'] = Angle(float(ra), u.deg).to_string(unit=u.hour, sep=':')
+            dataout.header['Dec'] = Angle(float(dec), u.deg).to_string(sep=':')
+            self.log.info('Registered %s to %s: %d stars, rms %.2f pixels' %
+                          (filename, refname, nmatch, rms))
+            results[i] = dataout
+
+    def solve(self, i):
+        """ Solves input frame i with the solver step. Returns the solver
+            output or None if the solver fails.
+        """
+        data = self.datain[i]
+        try:
+            self.solver.datain = data
+            self.solver.runstart(data, {})
+            self.solver.run()
+            return self.solver.dataout
+        except Exception as error:
+            self.log.warning('Solver %s failed for %s: %s - removing file' %
+                             (self.solver.name, os.path.split(data.filename)[1], str(error)))
+            return None
+
+    def solved(self, data):
+        """ Returns True if the solver output data has a WCS (StepAstrometry
+            sets ASTRSTAT for frames it does not solve)
+        """
+        return data is not None and 'ASTRSTAT' not in data.header
+
+if __name__ == '__main__':
+    """ Main function to run the pipe step from command line on a file.
+        Command:
+          python stepparent.py input.fits -arg1 -arg2 . . .
+        Standard arguments:
+          --config=ConfigFilePathName.txt : name of the configuration file
+          -t, --test : runs the functionality test i.e. pipestep.test()
+          --loglevel=LEVEL : configures the logging output for a particular level
+          -h, --help : Returns a list of
+    """
+    StepAstroGroup().execute()
+
+""" === History ===
+2026-10-18 First version
+"""
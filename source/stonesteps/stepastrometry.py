@@ -18,14 +18,29 @@ import tempfile # temporary file library
 import os # library for operating system calls
 import time # library to manage delay and timeout
 import string # library to join text
+import shutil # library to remove temporary folders
+import signal # library to stop astrometry processes
 import subprocess # library to run subprocesses
+import datetime # to find the night of a frame
+import numpy # numpy library
+from astropy.io import fits # to make WCS headers
 from astropy import wcs # to get WCS coordinates
+from astropy.wcs.utils import proj_plane_pixel_scales # pixel scale of a WCS
 from astropy.coordinates import Angle
 import astropy.units as u
 from darepype.drp import DataFits
 from darepype.drp import StepParent
+from stonesteps.stepcache import StepCache # pipestep result cache
+from stonesteps.stepcheckpoint import StepCheckpoint # pipestep checkpoints
+from stonesteps.framestats import framestats, findstars # star density and positions
+from stonesteps.wcscache import WCSCache, matchoffset # cache of WCS solutions
+from stonesteps.astrostats import AstroStats, FailRecord, statskey # astrometry statistics
+from stonesteps.astroserver import serverhealthy, submitjob, waitresult # solver server
+from stonesteps.indexmap import IndexMap # sky regions of the index files
+from stonesteps.wcsmatch import iswcskey, setwcs # WCS keywords
+from stonesteps.steptriage import qualityskip, qualitytext # triage quality flags
 
-class StepAstrometry(StepParent):
+class StepAstrometry(StepCheckpoint, StepCache, StepParent):
     """ HAWC Pipeline Step Parent Object
         The object is callable. It requires a valid configuration input
         (file or object) when it runs.
@@ -73,12 +88,78 @@ class StepAstrometry(StepParent):
                                'Parameter groups to run if the command fails'])
         self.paramlist.append(['timeout', 300,
                                'Timeout for running astrometry (seconds)'])
+        self.paramlist.append(['framebudget', 0,
+                               'Total time for all astrometry attempts on a frame (seconds, ' +
+                               '0 for no limit), the frame is left unsolved after that'])
+        self.paramlist.append(['minstars', 0,
+                               'Minimal number of stars (see framestats.py) to solve a frame'])
+        self.paramlist.append(['maxbackground', 0.0,
+                               'Maximal background level to solve a frame (0 for no limit)'])
+        self.paramlist.append(['saturation', 0.0,
+                               'Saturation level (0 to not check saturation)'])
+        self.paramlist.append(['maxsaturated', 0.05,
+                               'Maximal fraction of saturated pixels to solve a frame'])
+        self.paramlist.append(['skipquality', 0,
+                               'Frames with any of these triage quality flag bits are not ' +
+                               'solved (see steptriage.py, 0 to solve all frames)'])
+        self.paramlist.append(['failfile', '',
+                               'File to record fields which failed to solve in each night ' +
+                               '(empty to not use it)'])
+        self.paramlist.append(['failbudget', 60,
+                               'Time budget (seconds) for fields which failed before in the night'])
+        self.paramlist.append(['maxfieldfails', 2,
+                               'Number of failures in a night after which a field is skipped'])
+        self.paramlist.append(['racecount', 1,
+                               'Number of downsample/paramoptions combinations to run at ' +
+                               'the same time, the first success is used'])
+        self.paramlist.append(['cpubudget', 0,
+                               'Maximal number of astrometry processes running at the same ' +
+                               'time (0 for number of CPUs)'])
+        self.paramlist.append(['statsfile', '',
+                               'File to record successful options, used to try the best ' +
+                               'options first (empty to not use statistics)'])
+        self.paramlist.append(['sourcelist', False,
+                               'Flag to extract the sources once with sep and run ' +
+                               'astrometry on the source list instead of the image'])
+        self.paramlist.append(['sourcethresh', 1.5,
+                               'Source detection threshold (in background rms) for sourcelist'])
+        self.paramlist.append(['sourcecount', 500,
+                               'Maximal number of sources (brightest) in the source list'])
+        self.paramlist.append(['serverdir', '',
+                               'Job folder of a running astrometry server (see astroserver.py), ' +
+                               'astrocmd is run if no server is running (empty to not use a server)'])
+        self.paramlist.append(['serverscale', [0.5, 2.0],
+                               'Pixel scale range (arcsec/pixel) for the astrometry server'])
+        self.paramlist.append(['indexmap', '',
+                               'Map of the index files (see indexmap.py) to run astrometry ' +
+                               'only with the index files for the frame (empty to use all)'])
+        self.paramlist.append(['backendconfig', '',
+                               'Astrometry backend configuration used as template for the ' +
+                               'frame configuration (index entries are replaced)'])
+        self.paramlist.append(['pixscale', 0.0,
+                               'Pixel scale for XBIN = 1 (arcsec/pixel) to select index files ' +
+                               '(0 to not select by scale)'])
+        self.paramlist.append(['pixscaletol', 0.2,
+                               'Relative tolerance of pixscale'])
+        self.paramlist.append(['wcscachefile', '',
+                               'File to store WCS solutions of recurring targets ' +
+                               '(empty to not use the WCS cache)'])
+        self.paramlist.append(['wcscacheround', 0.1,
+                               'Rounding of the pointing RA/DEC for the WCS cache (degrees)'])
+        self.paramlist.append(['wcscacheradius', 0.25,
+                               'Maximal distance of a cached pointing (degrees)'])
+        self.paramlist.append(['wcscachematch', 8,
+                               'Minimal number of matched stars to use a cached WCS'])
+        self.paramlist.append(['wcscachestars', 50,
+                               'Number of bright stars stored with a cached WCS'])
         self.paramlist.append(['ra', '',
                                'Option to manually set image center RA'])
         self.paramlist.append(['dec', '',
                                'Option to manually set image center DEC'])
         self.paramlist.append(['searchradius', 5,
                                'Only search in indexes within "searchradius" (degrees) of the field center given by --ra and --dec (degrees)'])
+        # Get parameters for StepCache
+        self.cachesetup()
         # confirm end of setup
         self.log.debug('Setup: done')
 
@@ -86,6 +167,16 @@ class StepAstrometry(StepParent):
         """ Runs the data reduction algorithm. The self.datain is run
             through the code, the result is in self.dataout.
         """
+        ### Skip frames flagged by the triage (see steptriage.py)
+        self.deadline = None
+        self.solveaborted = False
+        self.failskipped = False
+        skipflag = qualityskip(self.datain, self.getarg('skipquality'))
+        if skipflag:
+            self.unsolved('skipped', 'Astrometry: skipped - quality flag %d (%s)' %
+                          (skipflag, qualitytext(skipflag)))
+            return
+
         ### Preparation
         # construct a temp file name that astrometry will output
         fp = tempfile.NamedTemporaryFile(suffix=".fits",dir=os.getcwd())
@@ -93,15 +184,9 @@ class StepAstrometry(StepParent):
         # crash sometimes
         outname = os.path.split(fp.name)[1]
         fp.close()
-        # Add input file path to ouput file and make new name
-        outpath = os.path.split(self.datain.filename)[0]
-        outnewname = os.path.join(outpath, outname.replace('.fits','.new') )
-        outwcsname = os.path.join(outpath, outname.replace('.fits','.wcs') )
         # Make sure input data exists as file
         if not os.path.exists(self.datain.filename) :
             self.datain.save()
-        # Make command string
-        rawcommand = self.getarg('astrocmd') % (self.datain.filename, outname)
 
         # get estimated RA and DEC center values from the config file or input FITS header
         raopt = self.getarg('ra')
@@ -123,83 +208,526 @@ class StepAstrometry(StepParent):
 
         if (ra != '') and (dec != ''):
         # update command parameters to use these values
-            rawcommand = rawcommand + ' --ra %f --dec %f --radius %f' % (ra, dec, self.getarg('searchradius'))         
+            searchopts = ' --ra %f --dec %f --radius %f' % (ra, dec, self.getarg('searchradius'))
         else:
+            searchopts = ''
             self.log.debug('FITS header missing RA/DEC -> searching entire sky')
 
+        ### Skip frames which can not be solved
+        skipmsg = self.precheck()
+        if len(skipmsg):
+            self.unsolved('skipped', 'Astrometry: skipped - ' + skipmsg)
+            return
+
+        ### Use a cached solution if the frame matches
+        header = None
+        wcscachefile = self.getarg('wcscachefile')
+        if len(wcscachefile):
+            wcscache = WCSCache(wcscachefile, self.getarg('wcscacheround'))
+            cacheid = self.wcscacheid()
+            if (ra != '') and (dec != ''):
+                header = self.wcsfromcache(wcscache, cacheid, ra, dec)
+            else:
+                self.log.debug('FITS header missing RA/DEC -> WCS cache not used')
+        if header is not None:
+            self.dataout = self.datain.copy()
+            setwcs(self.dataout.header, header[0])
+            histmsg = 'Astrometry: WCS from cache, %d stars matched, rms %.2f pixels' % header[1:]
+            self.dataout.setheadval('HISTORY', histmsg)
+            job = None
+        else:
+            # Set the time budget, skip fields which failed in this night
+            failfile = self.getarg('failfile')
+            if len(failfile):
+                failrecord = FailRecord(failfile)
+                night, field = self.nightfield(ra, dec)
+                failures = failrecord.count(night, field)
+            else:
+                failures = 0
+            budget = self.getarg('framebudget')
+            budgetmsg = ''
+            if failures >= self.getarg('maxfieldfails'):
+                self.failskipped = True
+                self.unsolved('skipped', 'Astrometry: skipped - field failed %d times in this night'
+                              % failures)
+                return
+            elif failures > 0:
+                budget = self.getarg('failbudget')
+                budgetmsg = 'Astrometry: field failed %d times in this night - budget %d seconds' % (failures, budget)
+                self.log.info(budgetmsg)
+            if budget > 0:
+                self.deadline = time.time() + budget
+            job = None
+            try:
+                if not self.serversolve(ra, dec):
+                    job = self.runsolve(searchopts, outname, ra, dec)
+            except RuntimeError:
+                if len(failfile):
+                    failrecord.add(night, field)
+                raise
+            if self.solveaborted:
+                if len(failfile):
+                    failrecord.add(night, field)
+                self.unsolved('aborted', 'Astrometry: aborted - no solution within %d seconds'
+                              % budget)
+                return
+            if len(budgetmsg):
+                self.dataout.setheadval('HISTORY', budgetmsg)
+            # Store the solution
+            if len(wcscachefile) and (ra != '') and (dec != ''):
+                self.wcstocache(wcscache, cacheid, ra, dec)
+
+        ### Post processing
+        # Add RA from astrometry
+        w = wcs.WCS(self.dataout.header)
+        n1 = float( self.dataout.header['NAXIS1']/2 )
+        n2 = float( self.dataout.header['NAXIS2']/2 )
+        ra, dec = w.all_pix2world(n1, n2, 1)
+        self.dataout.header['CRPIX1']=n1
+        self.dataout.header['CRPIX2']=n2
+        self.dataout.header['CRVAL1']=float(ra)
+        self.dataout.header['CRVAL2']=float(dec)
+        self.dataout.header['RA'] = Angle(ra,  u.deg).to_string(unit=u.hour, sep=':')
+        self.dataout.header['Dec']= Angle(dec, u.deg).to_string(sep=':')
+        # Delete temporary files
+        if job is not None and self.getarg('delete_temp'):
+            shutil.rmtree(job['dir'], ignore_errors = True)
+        self.log.debug('Run: Done')
+
+    def runsolve(self, searchopts, outname, ra = '', dec = ''):
+        """ Runs astrometry (see solve()) and loads the result into
+            self.dataout. searchopts are the options for the search
+            region, ra and dec the frame position (degrees, '' if
+            unknown). Returns the job dictionary of the successful
+            astrometry process.
+        """
         ### Run Astrometry:
         #   This loop tries the downsample and param options until the fit is successful
         #    need either --scale-low 0.5 --scale-high 2.0 --sort-column FLUX
         #             or --guess-scale
         downsamples = self.getarg('downsample')
         paramoptions = self.getarg('paramoptions')
-        for option in range(len(downsamples)*len(paramoptions)):
-        #for downsample in self.getarg('downsample'):
-            downsample = downsamples[option%len(downsamples)]
-            paramoption = paramoptions[option//len(downsamples)]
-            # Add options to command
-            command = rawcommand + ' --downsample %d' % downsample + ' ' + paramoption
-            optionstring = "Downsample=%s Paramopts=%s" % (downsample, paramoption[:10])
-            # Run the process - see note at the top of the file if using cron
-            process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
-                                       stderr=subprocess.STDOUT)
-            self.log.debug('running command = %s' % command)
-            # Wait for the process to be finished or timeout to be reached
-            timeout = time.time() + self.getarg('timeout')
-            while time.time() < timeout and process.poll() == None:
-                time.sleep(1)
-            poll = process.poll()
-            if poll == None:
-                process.kill()
-                time.sleep(1)
-            poll = process.poll()
-            self.log.debug('command returns %d' % poll)
-            if poll == 0 and os.path.exists(outnewname):
-                self.log.debug('output file valid -> astrometry successful')
-                break
-            else:             
-                self.log.debug('output file missing -> astrometry failed')
+        combinations = []
+        if self.getarg('sourcelist'):
+            # Extract the sources once, all attempts use the same list
+            # (downsample does not apply to a source list)
+            # Import here, sep is only needed for this option
+            from stonesteps.sepextract import extract, writexylist
+            outpath = os.path.split(self.datain.filename)[0]
+            xylsname = os.path.join(outpath, outname.replace('.fits','.xyls'))
+            objects = extract(self.datain.image, self.getarg('sourcethresh'),
+                              self.getarg('sourcecount'))
+            height, width = self.datain.image.shape
+            writexylist(xylsname, objects, width, height)
+            self.log.debug('Wrote %d sources to %s' % (len(objects), xylsname))
+            rawcommand = self.getarg('astrocmd') % (xylsname, outname)
+            rawcommand += ' --width %d --height %d' % (width, height)
+            for paramoption in paramoptions:
+                combinations.append((0, paramoption))
+            outext = '.wcs'
+        else:
+            rawcommand = self.getarg('astrocmd') % (self.datain.filename, outname)
+            for option in range(len(downsamples)*len(paramoptions)):
+                combinations.append((downsamples[option%len(downsamples)],
+                                     paramoptions[option//len(downsamples)]))
+            outext = '.new'
+        rawcommand += searchopts
+        # Only use the index files for the frame position and scale
+        configname = self.indexconfig(ra, dec, outname)
+        if configname is not None:
+            rawcommand += ' --config %s' % configname
+        # Try the options first which solved similar frames fastest
+        statsfile = self.getarg('statsfile')
+        if len(statsfile):
+            stats = AstroStats(statsfile)
+            groupkey = self.statsgroup()
+            combinations = stats.order(groupkey, combinations)
+            self.log.debug('Option order for %s: %s' % (groupkey, repr(combinations)))
+        job = self.solve(rawcommand, combinations, outname, outext)
+        if self.getarg('sourcelist') and self.getarg('delete_temp'):
+            os.remove(xylsname)
+        if configname is not None and self.getarg('delete_temp'):
+            os.remove(configname)
+        if len(statsfile):
+            firsthit = ( job is not None and
+                         (job['downsample'], job['paramoption']) == combinations[0] )
+            stats.record(groupkey, self.solveresults, firsthit)
+        if job is None and self.solveaborted:
+            return None
+        if job is None:
+            self.log.error('Astrometry failed for all downsample/paramoptions combinations')
+            raise RuntimeError('Astrometry failed for %s' % os.path.split(self.datain.filename)[1])
+        downsample = job['downsample']
+        optionstring = "Downsample=%s Paramopts=%s" % (downsample, job['paramoption'][:10])
+        outnewname = os.path.join(job['dir'], outname.replace('.fits', outext))
         # Print the output from astrometry (cut if necessary)
         if self.getarg('verbose'):
-            output = process.stdout.read().decode()
+            with open(job['logname']) as f:
+                output = f.read()
             if len(output) > 1000:
                 outlines = output.split('\n')
                 output = outlines[:10]+['...','...']+outlines[-7:]
                 output = '\n'.join(output)
             self.log.debug(output)
-
-        ### Post processing
         # Read output file
-        self.dataout = DataFits(config=self.config)
         self.log.debug('Opening astrometry.net output file %s' % outnewname)
-        try:
-            self.dataout.load(outnewname)
-            self.dataout.filename = self.datain.filename
-        except Exception as error:
-            self.log.error("Unable to open astrometry. output file = %s"
-                           % outname)
-            raise error
+        if outext == '.wcs':
+            # Copy the WCS into the input header
+            self.dataout = self.datain.copy()
+            try:
+                wcsheader = fits.getheader(outnewname)
+            except Exception as error:
+                self.log.error("Unable to open astrometry. output file = %s"
+                               % outname)
+                raise error
+            setwcs(self.dataout.header, wcs.WCS(wcsheader))
+            histmsg = 'Astrometry.Net: On %d extracted sources, search took %d seconds' % (len(objects), job['time'])
+        else:
+            self.dataout = DataFits(config=self.config)
+            try:
+                self.dataout.load(outnewname)
+                self.dataout.filename = self.datain.filename
+            except Exception as error:
+                self.log.error("Unable to open astrometry. output file = %s"
+                               % outname)
+                raise error
+            histmsg = 'Astrometry.Net: At downsample = %d, search took %d seconds' % (downsample, job['time'])
         self.log.debug('Successful parameter options = %s' % optionstring)
         # Add history message
-        histmsg = 'Astrometry.Net: At downsample = %d, search took %d seconds' % (downsample, time.time() - timeout + 300)
         self.dataout.setheadval('HISTORY', histmsg)
-        # Add RA from astrometry
-        w = wcs.WCS(self.dataout.header)
-        n1 = float( self.dataout.header['NAXIS1']/2 )
-        n2 = float( self.dataout.header['NAXIS2']/2 )
-        ra, dec = w.all_pix2world(n1, n2, 1)
-        self.dataout.header['CRPIX1']=n1
-        self.dataout.header['CRPIX2']=n2
-        self.dataout.header['CRVAL1']=float(ra)
-        self.dataout.header['CRVAL2']=float(dec)
-        self.dataout.header['RA'] = Angle(ra,  u.deg).to_string(unit=u.hour, sep=':')
-        self.dataout.header['Dec']= Angle(dec, u.deg).to_string(sep=':')
         self.dataout.setheadval('HISTORY', 'Astrometry: Paramopts = ' + optionstring)
-        # Delete temporary files
-        if self.getarg('delete_temp'):
-            os.remove(outnewname)
-            os.remove(outwcsname)
-        self.log.debug('Run: Done')
+        return job
+
+    def cacheable(self):
+        """ Results of frames aborted by the time budget or skipped for
+            the failures in the failure record are not cached
+        """
+        return not (self.solveaborted or self.failskipped)
+
+    def checkpointable(self):
+        """ Frames aborted by the time budget or skipped for the failures
+            in the failure record are solved again next time
+        """
+        return not (self.solveaborted or self.failskipped)
+
+    def precheck(self):
+        """ Returns the reason why the input frame can not be solved or ''
+            if it can be tried: too few stars, too high background or too
+            many saturated pixels.
+        """
+        if not ( self.getarg('minstars') > 0 or self.getarg('maxbackground') > 0 or
+                 self.getarg('saturation') > 0 ):
+            return ''
+        stats = framestats(self.datain.image)
+        if stats['nstars'] < self.getarg('minstars'):
+            return 'only %d stars found (minstars = %d)' % (stats['nstars'], self.getarg('minstars'))
+        if self.getarg('maxbackground') > 0 and stats['background'] > self.getarg('maxbackground'):
+            return 'background %.0f is above %.0f' % (stats['background'], self.getarg('maxbackground'))
+        if self.getarg('saturation') > 0:
+            saturated = numpy.mean(self.datain.image[::2,::2] >= self.getarg('saturation'))
+            if saturated > self.getarg('maxsaturated'):
+                return '%.1f%% of the pixels are saturated' % (100.0 * saturated)
+        return ''
+
+    def nightfield(self, ra, dec):
+        """ Returns the night (date at the start of the night, from
+            DATE-OBS) and the field (OBJECT and pointing rounded to
+            wcscacheround) of the input frame for the failure record
+        """
+        try:
+            dateobs = datetime.datetime.strptime(self.datain.getheadval('DATE-OBS', errmsg = False)[:19],
+                                                 '%Y-%m-%dT%H:%M:%S')
+        except (KeyError, TypeError, ValueError):
+            dateobs = datetime.datetime.utcnow()
+        night = (dateobs - datetime.timedelta(hours = 12)).strftime('%Y-%m-%d')
+        try:
+            obj = str(self.datain.getheadval('OBJECT', errmsg = False)).strip()
+        except KeyError:
+            obj = ''
+        roundto = self.getarg('wcscacheround')
+        if (ra != '') and (dec != ''):
+            field = '%s|%.4f|%.4f' % (obj, round(ra / roundto) * roundto,
+                                      round(dec / roundto) * roundto)
+        else:
+            field = obj
+        return night, field
+
+    def unsolved(self, status, histmsg):
+        """ Returns the input frame without solving it: the reason is
+            added to HISTORY and status to ASTRSTAT
+        """
+        self.log.warning(histmsg)
+        self.dataout = self.datain.copy()
+        self.dataout.setheadval('ASTRSTAT', status, 'Astrometry status')
+        self.dataout.setheadval('HISTORY', histmsg)
+
+    def indexconfig(self, ra, dec, outname):
+        """ Writes an astrometry backend configuration with the index
+            files which cover the frame position and pixel scale (see
+            indexmap.py) and returns its file name. Returns None if no
+            index map is used, the frame position is unknown or no index
+            file was selected (then the configured index files are used).
+        """
+        indexmapfile = os.path.expandvars(self.getarg('indexmap'))
+        if not len(indexmapfile) or ra == '' or dec == '':
+            return None
+        if not os.path.exists(indexmapfile):
+            self.log.warning('Index map %s not found -> using all index files' % indexmapfile)
+            return None
+        height, width = self.datain.image.shape
+        # Expected pixel scale from the binning
+        pixscale = self.getarg('pixscale')
+        radius = self.getarg('searchradius')
+        if pixscale > 0:
+            try:
+                xbin = float(self.datain.getheadval('XBIN', errmsg = False))
+            except (KeyError, TypeError, ValueError):
+                xbin = 1.0
+            tol = self.getarg('pixscaletol')
+            scalelow = pixscale * xbin * (1.0 - tol)
+            scalehigh = pixscale * xbin * (1.0 + tol)
+            # Add the half field diagonal to the search radius
+            radius += 0.5 * numpy.hypot(width, height) * scalehigh / 3600.0
+        else:
+            scalelow, scalehigh = 0.0, numpy.inf
+        indexfiles = IndexMap(indexmapfile).select(ra, dec, radius, width, height,
+                                                   scalelow, scalehigh)
+        if not len(indexfiles):
+            self.log.warning('No index file selected for the frame -> using all index files')
+            return None
+        # Copy the template without its index entries
+        lines = []
+        backendconfig = os.path.expandvars(self.getarg('backendconfig'))
+        if len(backendconfig):
+            with open(backendconfig) as f:
+                for line in f:
+                    if line.split()[:1] not in [['index'], ['autoindex'], ['add_path']]:
+                        lines.append(line.rstrip('\n'))
+        lines += ['index %s' % indexfile for indexfile in indexfiles]
+        outpath = os.path.split(self.datain.filename)[0]
+        configname = os.path.join(outpath, outname.replace('.fits', '.cfg'))
+        with open(configname, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        self.log.debug('Wrote backend configuration %s with %d index files' %
+                       (configname, len(indexfiles)))
+        return configname
+
+    def serversolve(self, ra, dec):
+        """ Solves the frame with the astrometry server in serverdir (see
+            astroserver.py) and loads the result into self.dataout.
+            Returns False if no server is used or running or if the server
+            did not solve the frame, then astrocmd has to be run.
+        """
+        serverdir = os.path.expandvars(self.getarg('serverdir'))
+        if not len(serverdir):
+            return False
+        if not serverhealthy(serverdir):
+            self.log.info('No astrometry server running in %s -> running astrocmd' % serverdir)
+            return False
+        # Import here, sep is only needed for this option
+        from stonesteps.sepextract import extract
+        objects = extract(self.datain.image, self.getarg('sourcethresh'),
+                          self.getarg('sourcecount'))
+        height, width = self.datain.image.shape
+        scalelow, scalehigh = self.getarg('serverscale')
+        if (ra != '') and (dec != ''):
+            jobid = submitjob(serverdir, zip(objects['x'], objects['y']), width, height,
+                              scalelow, scalehigh, ra, dec, self.getarg('searchradius'))
+        else:
+            jobid = submitjob(serverdir, zip(objects['x'], objects['y']), width, height,
+                              scalelow, scalehigh)
+        self.log.debug('Sent %d sources to astrometry server (job %s)' % (len(objects), jobid))
+        timeout = self.getarg('timeout')
+        if self.deadline is not None:
+            timeout = min(timeout, self.deadline - time.time())
+        result = waitresult(serverdir, jobid, timeout)
+        if result is None or not result['success']:
+            self.log.warning('Astrometry server did not solve the frame -> running astrocmd')
+            return False
+        # Copy the WCS into the input header
+        self.dataout = self.datain.copy()
+        wcsheader = fits.Header()
+        for key, (value, comment) in result['wcs'].items():
+            wcsheader[key] = (value, comment)
+        setwcs(self.dataout.header, wcs.WCS(wcsheader))
+        histmsg = 'Astrometry server: On %d extracted sources, search took %d seconds' % (len(objects), result['time'])
+        self.dataout.setheadval('HISTORY', histmsg)
+        self.log.debug('Astrometry server solved the frame with %s' % result.get('index', ''))
+        return True
+
+    def wcscacheid(self):
+        """ Returns OBJECT, XBIN and DETECTOR (camera) of the input frame,
+            used to identify solutions in the WCS cache
+        """
+        values = []
+        for key in ['OBJECT', 'XBIN', 'DETECTOR']:
+            try:
+                values.append(str(self.datain.getheadval(key, errmsg = False)).strip())
+            except KeyError:
+                values.append('')
+        return values
+
+    def wcsfromcache(self, wcscache, cacheid, ra, dec):
+        """ Looks for a cached solution for the input frame and checks it
+            by matching the cached stars with the stars in the frame.
+            Returns the WCS for the frame, the number of matched stars
+            and the rms distance of the matches (pixels). Returns None if
+            there is no solution or the check failed.
+        """
+        obj, xbin, camera = cacheid
+        entry = wcscache.lookup(obj, ra, dec, xbin, camera, self.getarg('wcscacheradius'))
+        if entry is None or list(entry['shape']) != list(self.datain.image.shape):
+            self.log.debug('No cached WCS for %s' % repr(cacheid))
+            return None
+        # Project the cached stars into the frame
+        header = fits.Header()
+        for key, value in entry['wcs'].items():
+            if iswcskey(key):
+                header[key] = value
+        w = wcs.WCS(header)
+        stars = numpy.array(entry['stars'])
+        refx, refy = w.all_world2pix(stars[:,0], stars[:,1], 0)
+        # Match them with the stars in the frame
+        x, y, flux = findstars(self.datain.image, maxstars = len(stars))
+        pixscale = numpy.mean(proj_plane_pixel_scales(w))
+        searchradius = self.getarg('wcscacheradius') / pixscale
+        dx, dy, nmatch, rms = matchoffset(x, y, refx, refy, searchradius)
+        if nmatch < self.getarg('wcscachematch'):
+            self.log.info('Cached WCS check failed (%d stars matched) -> full search' % nmatch)
+            return None
+        self.log.info('Using cached WCS: %d stars matched, offset %.1f/%.1f pixels, rms %.2f pixels' %
+                      (nmatch, dx, dy, rms))
+        # Shift the solution by the offset
+        header['CRPIX1'] += dx
+        header['CRPIX2'] += dy
+        return wcs.WCS(header), nmatch, rms
+
+    def wcstocache(self, wcscache, cacheid, ra, dec):
+        """ Stores the solution in self.dataout in the WCS cache, with the
+            positions of the brightest stars in the frame
+        """
+        obj, xbin, camera = cacheid
+        w = wcs.WCS(self.dataout.header)
+        x, y, flux = findstars(self.datain.image, maxstars = self.getarg('wcscachestars'))
+        if len(x) < self.getarg('wcscachematch'):
+            self.log.debug('Too few stars to store WCS in cache')
+            return
+        starra, stardec = w.all_pix2world(x, y, 0)
+        wcsheader = w.to_header(relax = True)
+        wcsheader = dict((key, wcsheader[key]) for key in wcsheader if iswcskey(key))
+        stars = [[float(r), float(d)] for r, d in zip(starra, stardec)]
+        wcscache.store(obj, ra, dec, xbin, camera, self.datain.image.shape, wcsheader, stars)
+        self.log.debug('Stored WCS in cache for %s' % repr(cacheid))
+
+    def solve(self, rawcommand, combinations, outname, outext = '.new'):
+        """ Runs astrometry for the (downsample, paramoption) combinations.
+            A process is successful if it returns 0 and writes the output
+            file with extension outext. downsample 0 means no --downsample
+            option (for source lists).
+            Up to racecount processes (limited by cpubudget) are run at the
+            same time, each in its own temporary folder. When a process
+            returns a valid output, the other processes are stopped.
+            Returns a dictionary for the successful process with the keys
+            downsample, paramoption, dir (temporary folder with the
+            output files), logname (astrometry output) and time (seconds).
+            Returns None if all combinations failed. If the frame budget
+            (self.deadline) is reached, all processes are stopped and
+            self.solveaborted is set.
+            The results of all processes which have finished are in
+            self.solveresults as (downsample, paramoption, success, time).
+        """
+        cpubudget = self.getarg('cpubudget')
+        if cpubudget < 1:
+            cpubudget = os.cpu_count() or 1
+        racecount = max(1, min(self.getarg('racecount'), cpubudget))
+        outpath = os.path.split(self.datain.filename)[0]
+        waiting = list(combinations)
+        running = []
+        winner = None
+        self.solveresults = []
+        while winner is None and (len(waiting) or len(running)):
+            # Stop if the frame budget is used up
+            if self.deadline is not None and time.time() > self.deadline:
+                self.log.warning('Frame budget used up - stopping astrometry')
+                self.solveaborted = True
+                break
+            # Start processes until racecount are running
+            while len(waiting) and len(running) < racecount:
+                downsample, paramoption = waiting.pop(0)
+                tempdir = tempfile.mkdtemp(prefix = 'astrometry_', dir = outpath)
+                command = rawcommand
+                if downsample > 0:
+                    command += ' --downsample %d' % downsample
+                command += ' ' + paramoption
+                command += ' --dir %s' % tempdir
+                logname = os.path.join(tempdir, 'astrometry.log')
+                logfile = open(logname, 'w')
+                # Run the process - see note at the top of the file if using cron
+                # (new session so the process and its children can be stopped)
+                process = subprocess.Popen(command, shell=True, stdout=logfile,
+                                           stderr=subprocess.STDOUT,
+                                           start_new_session=True)
+                self.log.debug('running command = %s' % command)
+                running.append({'downsample': downsample, 'paramoption': paramoption,
+                                'dir': tempdir, 'logname': logname, 'logfile': logfile,
+                                'process': process, 'start': time.time()})
+            # Wait for processes to be finished or timeouts to be reached
+            time.sleep(0.5)
+            for job in list(running):
+                poll = job['process'].poll()
+                if poll == None:
+                    overbudget = self.deadline is not None and time.time() > self.deadline
+                    if overbudget or time.time() - job['start'] > self.getarg('timeout'):
+                        self.stopprocess(job['process'])
+                        poll = job['process'].poll()
+                    if overbudget:
+                        self.solveaborted = True
+                if poll == None:
+                    continue
+                running.remove(job)
+                job['logfile'].close()
+                job['time'] = time.time() - job['start']
+                self.log.debug('command returns %s (Downsample=%d Paramopts=%s)' %
+                               (poll, job['downsample'], job['paramoption'][:10]))
+                if ( poll == 0 and winner is None and
+                     os.path.exists(os.path.join(job['dir'], outname.replace('.fits', outext))) ):
+                    self.log.debug('output file valid -> astrometry successful')
+                    winner = job
+                else:
+                    self.log.debug('output file missing -> astrometry failed')
+                    shutil.rmtree(job['dir'], ignore_errors = True)
+                self.solveresults.append((job['downsample'], job['paramoption'],
+                                          job is winner, job['time']))
+        # Stop the remaining processes
+        for job in running:
+            self.stopprocess(job['process'])
+            job['logfile'].close()
+            shutil.rmtree(job['dir'], ignore_errors = True)
+        if len(running):
+            self.log.debug('stopped %d remaining astrometry processes' % len(running))
+        return winner
+
+    def statsgroup(self):
+        """ Returns the statistics group of the input frame (binning,
+            filter, exposure time and star density)
+        """
+        values = []
+        for key in ['XBIN', 'FILTER', 'EXPTIME']:
+            try:
+                values.append(self.datain.getheadval(key, errmsg = False))
+            except KeyError:
+                values.append('')
+        density = framestats(self.datain.image)['density']
+        return statskey(values[0], values[1], values[2], density)
+
+    def stopprocess(self, process):
+        """ Stops an astrometry process with all its child processes
+        """
+        try:
+            os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+        except OSError:
+            process.kill()
+        process.wait()
     
 if __name__ == '__main__':
     """ Main function to run the pipe step from command line on a file.
@@ -214,6 +742,24 @@ if __name__ == '__main__':
     StepAstrometry().execute()
 
 """ === History ===
+2026-10-18 Frames with triage quality flags in skipquality are skipped
+2026-10-18 Total time budget for a frame (framebudget), frames with too few
+           stars, high background or saturation are skipped, fields which
+           failed in the same night get less time (failfile)
+2026-10-18 Astrometry only uses the index files for the frame position and
+           pixel scale (indexmap, see indexmap.py)
+2026-10-18 Frames can be solved by a running astrometry server which keeps
+           the index files loaded (serverdir, see astroserver.py)
+2026-10-18 Option to extract sources once with sep and run astrometry on the
+           source list (sourcelist)
+2026-10-18 Solutions are cached for recurring targets (wcscachefile, see
+           wcscache.py), a cached WCS is used if the frame stars match
+2026-10-18 Options are tried in the order of past success for similar
+           frames (statsfile, see astrostats.py)
+2026-10-18 Downsample/paramoptions combinations can be run at the same time
+           (racecount, cpubudget), each process runs in its own folder
+2026-10-18 Added checkpoint and resume (StepCheckpoint)
+2026-10-18 Added step result cache (StepCache)
 2018-10-12 MGB: - Add code to try different --downsample factors
                 - Add timeout for running astrometry.net
                 - Renamed StepAstrometry from StepAstrometrica
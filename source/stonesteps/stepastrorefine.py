@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+""" PIPE STEP ASTROMETRY REFINE - Version 1.0.0
+
+    This pipe step adds WCS information to the data without a blind
+    astrometry search. The telescope pointing (RA/DEC in the header) is
+    usually good to a few arcminutes and the pixel scale is known for
+    each binning, so a first guess WCS is made from them and refined by
+    matching the stars in the frame with guide star catalog stars (see
+    wcsmatch.py and gsccatalog.py). A TAN WCS with SIP distortion is
+    fitted to the matched stars.
+
+    If too few stars match or the fit residuals are too large, the frame
+    is solved with StepAstrometry (configured in the [astrometry]
+    section) instead. The step can replace StepAstrometry in the
+    stepslist, it uses the same file name identifier (WCS).
+"""
+
+import logging # logging object library
+import os # library for operating system calls
+import numpy # numpy library
+from astropy.coordinates import Angle
+import astropy.units as u
+from darepype.drp import StepParent
+from stonesteps.stepcache import StepCache # pipestep result cache
+from stonesteps.stepcheckpoint import StepCheckpoint # pipestep checkpoints
+from stonesteps.stepastrometry import StepAstrometry # fallback astrometry
+from stonesteps.sepextract import extract # source extraction
+from stonesteps.gsccatalog import querygsc # guide star catalog
+from stonesteps.catalogstore import CatalogStore # local catalog tiles
+from stonesteps.wcsmatch import initialwcs, refinewcs, setwcs # WCS matching
+from stonesteps.steptriage import qualityskip, qualitytext # triage quality flags
+
+class StepAstroRefine(StepCheckpoint, StepCache, StepParent):
+    """ Pipeline Step Object to add WCS from the pointing and a catalog
+    """
+    stepver = '0.1' # pipe step version
+
+    def setup(self):
+        """ ### Names and Parameters need to be Set Here ###
+            Sets the internal names for the function and for saved files.
+            Defines the input parameters for the current pipe step.
+            Setup() is called at the end of __init__
+            The parameters are stored in a list containing the following
+            information:
+            - name: The name for the parameter. This name is used when
+                    calling the pipe step from command line or python shell.
+                    It is also used to identify the parameter in the pipeline
+                    configuration file.
+            - default: A default value for the parameter. If nothing, set
+                       '' for strings, 0 for integers and 0.0 for floats
+            - help: A short description of the parameter.
+        """
+        ### Set Names
+        # Name of the pipeline reduction step
+        self.name='astrorefine'
+        # Shortcut for pipeline reduction step and identifier for
+        # saved file names.
+        self.procname = 'WCS'
+        # Set Logger for this pipe step
+        self.log = logging.getLogger('pipe.step.%s' % self.name)
+        ### Set Parameter list
+        # Clear Parameter list
+        self.paramlist = []
+        # Append parameters
+        self.paramlist.append(['pixscale', 0.47,
+                               'Pixel scale for XBIN = 1 (arcsec/pixel)'])
+        self.paramlist.append(['rotation', 0.0,
+                               'Angle of north from the +y axis towards east (degrees)'])
+        self.paramlist.append(['parity', 1,
+                               'Image parity: 1 for east left of north, -1 for flipped images'])
+        self.paramlist.append(['sourcethresh', 5.0,
+                               'Star detection threshold (in background rms)'])
+        self.paramlist.append(['sourcecount', 300,
+                               'Maximal number of stars (brightest) to match'])
+        self.paramlist.append(['triangles', 20,
+                               'Number of brightest stars used for triangle matching'])
+        self.paramlist.append(['catradius', 0.5,
+                               'Radius of the guide star catalog query (degrees)'])
+        self.paramlist.append(['catmag', 'SDSSrMag',
+                               'Catalog magnitude column to select the brightest stars'])
+        self.paramlist.append(['gsccache', '',
+                               'Folder to keep guide star catalog query results ' +
+                               '(empty to always query the catalog)'])
+        self.paramlist.append(['catstore', '',
+                               'Folder of the local catalog store (see catalogstore.py, ' +
+                               'empty to query the guide star catalog)'])
+        self.paramlist.append(['catfetch', True,
+                               'Flag to query catalog tiles missing in the store'])
+        self.paramlist.append(['pointerror', 5.0,
+                               'Maximal pointing error (arcmin)'])
+        self.paramlist.append(['matchradius', 2.0,
+                               'Maximal distance of matched stars (pixels)'])
+        self.paramlist.append(['minmatch', 10,
+                               'Minimal number of matched stars'])
+        self.paramlist.append(['maxrms', 0.5,
+                               'Maximal rms fit residual (pixels), astrometry is run ' +
+                               'for frames with larger residuals'])
+        self.paramlist.append(['sipdegree', 2,
+                               'Degree of the SIP distortion terms (0 for none)'])
+        self.paramlist.append(['fallback', True,
+                               'Flag to run astrometry (StepAstrometry) if the refinement fails'])
+        self.paramlist.append(['skipquality', 0,
+                               'Frames with any of these triage quality flag bits are not ' +
+                               'solved (see steptriage.py, 0 to solve all frames)'])
+        # Get parameters for StepCache
+        self.cachesetup()
+        # confirm end of setup
+        self.log.debug('Setup: done')
+
+    def run(self):
+        """ Runs the data reduction algorithm. The self.datain is run
+            through the code, the result is in self.dataout.
+        """
+        skipflag = qualityskip(self.datain, self.getarg('skipquality'))
+        if skipflag:
+            histmsg = 'AstroRefine: skipped - quality flag %d (%s)' % (skipflag, qualitytext(skipflag))
+            self.log.warning(histmsg)
+            self.dataout = self.datain.copy()
+            self.dataout.setheadval('ASTRSTAT', 'skipped', 'Astrometry status')
+            self.dataout.setheadval('HISTORY', histmsg)
+            return
+        result = None
+        try:
+            result = self.refine()
+        except Exception as error:
+            self.log.warning('WCS refinement failed: %s' % str(error))
+        if result is None:
+            if not self.getarg('fallback'):
+                raise RuntimeError('WCS refinement failed for %s' %
+                                   os.path.split(self.datain.filename)[1])
+            self.log.info('Running astrometry')
+            self.fallback()
+        else:
+            w, nmatch, rms = result
+            self.dataout = self.datain.copy()
+            setwcs(self.dataout.header, w)
+            histmsg = 'AstroRefine: WCS fit to %d catalog stars, rms %.2f pixels' % (nmatch, rms)
+            self.dataout.setheadval('HISTORY', histmsg)
+            # Set RA/Dec of the image center
+            height, width = self.dataout.image.shape
+            ra, dec = w.all_pix2world((width - 1) / 2.0, (height - 1) / 2.0, 0)
+            self.dataout.header['RA'] = Angle(float(ra), u.deg).to_string(unit=u.hour, sep=':')
+            self.dataout.header['Dec'] = Angle(float(dec), u.deg).to_string(sep=':')
+        self.log.debug('Run: Done')
+
+    def refine(self):
+        """ Fits the WCS of the input frame. Returns the WCS, the number
+            of matched stars and the rms residual (pixels). Returns None
+            if the fit is not good enough.
+        """
+        ### Make the first guess WCS
+        ra = Angle(self.datain.getheadval('RA'), unit=u.hour).degree
+        dec = Angle(self.datain.getheadval('DEC'), unit=u.deg).degree
+        try:
+            xbin = float(self.datain.getheadval('XBIN', errmsg = False))
+        except (KeyError, TypeError, ValueError):
+            xbin = 1.0
+        pixscale = self.getarg('pixscale') * xbin
+        height, width = self.datain.image.shape
+        guess = initialwcs(ra, dec, pixscale, width, height,
+                           self.getarg('rotation'), self.getarg('parity'))
+        ### Get the stars in the frame and in the catalog
+        objects = extract(self.datain.image, self.getarg('sourcethresh'),
+                          self.getarg('sourcecount'))
+        if len(self.getarg('catstore')):
+            store = CatalogStore(self.getarg('catstore'))
+            catalog = store.cone(ra, dec, self.getarg('catradius'), self.getarg('catfetch'))
+        else:
+            catalog = querygsc(ra, dec, self.getarg('catradius'), self.getarg('gsccache'))
+        mags = numpy.array(catalog[self.getarg('catmag')], dtype = float)
+        catalog = catalog[numpy.isfinite(mags) & (mags > 0)]
+        catalog = catalog[numpy.argsort(numpy.array(catalog[self.getarg('catmag')]))]
+        # Keep the catalog stars which can be in the frame
+        refx, refy = guess.all_world2pix(catalog['ra'], catalog['dec'], 0)
+        margin = 60.0 * self.getarg('pointerror') / pixscale
+        inside = ( (refx > -margin) & (refx < width + margin) &
+                   (refy > -margin) & (refy < height + margin) )
+        catalog = catalog[inside]
+        self.log.debug('Matching %d stars with %d catalog stars' % (len(objects), len(catalog)))
+        ### Match and fit
+        w, nmatch, rms = refinewcs(objects['x'], objects['y'],
+                                   numpy.array(catalog['ra']), numpy.array(catalog['dec']),
+                                   guess, self.getarg('triangles'), self.getarg('matchradius'),
+                                   self.getarg('sipdegree'), self.getarg('minmatch'))
+        if w is None:
+            self.log.info('WCS refinement: only %d stars matched' % nmatch)
+            return None
+        if rms > self.getarg('maxrms'):
+            self.log.info('WCS refinement: rms residual %.2f pixels is too large' % rms)
+            return None
+        self.log.info('WCS refinement: %d stars matched, rms %.2f pixels' % (nmatch, rms))
+        return w, nmatch, rms
+
+    def fallback(self):
+        """ Solves the frame with StepAstrometry, the result is in
+            self.dataout
+        """
+        step = StepAstrometry()
+        step.datain = self.datain
+        step.runstart(self.datain, {})
+        step.run()
+        self.dataout = step.dataout
+
+if __name__ == '__main__':
+    """ Main function to run the pipe step from command line on a file.
+        Command:
+          python stepparent.py input.fits -arg1 -arg2 . . .
+        Standard arguments:
+          --config=ConfigFilePathName.txt : name of the configuration file
+          -t, --test : runs the functionality test i.e. pipestep.test()
+          --loglevel=LEVEL : configures the logging output for a particular level
+          -h, --help : Returns a list of
+    """
+    StepAstroRefine().execute()
+
+""" === History ===
+2026-10-18 Frames with triage quality flags in skipquality are skipped
+2026-10-18 Catalog stars can be read from the local catalog store (catstore)
+2026-10-18 First version
+"""
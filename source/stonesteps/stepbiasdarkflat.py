@@ -15,14 +15,46 @@ import sys # sys library
 import numpy # numpy library
 import logging # logging object library
 import shutil # library to provide operations on collections of files
+import threading # lock for the master cache
+from collections import OrderedDict # master cache with load order
 from astropy import units as u
 import ccdproc # package for reducing optical CCD telescope data 
 from astropy.io import fits #package to recognize FITS files
 from darepype.drp import DataFits # pipeline data object
 from darepype.drp import StepParent # pipestep stepparent object
 from darepype.tools.steploadaux import StepLoadAux # pipestep steploadaux object
+from stonesteps.stepcache import StepCache # pipestep result cache
+from stonesteps.stepcheckpoint import StepCheckpoint # pipestep checkpoints
+from stonesteps.workdtype import workdtype, asworkdtype # working data type
 
-class StepBiasDarkFlat(StepLoadAux, StepParent):
+# Cache of loaded master frames: {(filename, mtime, dtype): CCDData}
+# Shared between the pipe step and the prefetch thread (see dataprefetch.py)
+mastercache = OrderedDict()
+mastercachelock = threading.Lock()
+mastercachesize = 12 # maximal number of master frames kept in memory
+
+def readmaster(filename, dtype = None):
+    """ Returns the master frame in filename as CCDData object. Masters
+        are cached by filename and modification time, so a master is only
+        read again from disk if the file has changed. If dtype is given
+        the master data is converted to that data type.
+    """
+    key = (filename, os.path.getmtime(filename), str(dtype))
+    with mastercachelock:
+        if key in mastercache:
+            mastercache.move_to_end(key)
+            return mastercache[key]
+    master = ccdproc.CCDData.read(filename, unit='adu', relax=True)
+    if dtype is not None:
+        master.data = master.data.astype(dtype, copy = False)
+    with mastercachelock:
+        mastercache[key] = master
+        # Remove oldest entries
+        while len(mastercache) > mastercachesize:
+            mastercache.popitem(last = False)
+    return master
+
+class StepBiasDarkFlat(StepCheckpoint, StepCache, StepLoadAux, StepParent):
     """ Pipeline Step Object to calibrate Bias/Dark/Flat files
     """
     
@@ -94,9 +126,21 @@ class StepBiasDarkFlat(StepLoadAux, StepParent):
         self.loadauxsetup('dark')
         # Get parameters for StepLoadAux, replace auxfile with flatfile
         self.loadauxsetup('flat')
+        # Get parameters for StepCache
+        self.cachesetup()
         # confirm end of setup
         self.log.debug('Setup: done')
     
+    def cacheextra(self):
+        """ Returns the names and dates of the bias, dark and flat files
+            for the current input (used for the step cache key)
+        """
+        extra = []
+        for auxpar in ['bias', 'dark', 'flat']:
+            name = self.loadauxname(auxpar, multi = False)
+            extra.append((name, os.path.getmtime(name)))
+        return extra
+
     '''# Looking for similar exptime
     def closestExp(self):
         input_exptime = self.datain.getheadval('EXPTIME')
@@ -137,18 +181,20 @@ class StepBiasDarkFlat(StepLoadAux, StepParent):
                 if self.flatkeyvalues[keyind] != self.datain.getheadval(self.flatfitkeys[keyind]):
                     self.log.warn('New data has different FITS key value for keyword %s' %
                                   self.flatfitkeys[keyind])
-        #convert self.datain to CCD Data object
-        image = ccdproc.CCDData(self.datain.image, unit='adu')
+        #convert self.datain to CCD Data object (in the working data type)
+        image = ccdproc.CCDData(asworkdtype(self.datain.image, self.config), unit='adu')
         image.header = self.datain.header
         #subtract bias from image    
         image = ccdproc.subtract_bias(image, self.bias, add_keyword=False)
         #subtract dark from image
         image = ccdproc.subtract_dark(image, self.dark, scale=True, exposure_time='EXPTIME', exposure_unit=u.second, add_keyword=False)
         #apply flat correction to image
-        image = ccdproc.flat_correct(image, self.flat, add_keyword=False)
+        #(the flat mean is computed in float64)
+        image = ccdproc.flat_correct(image, self.flat, add_keyword=False,
+                                     norm_value=numpy.mean(self.flat.data, dtype=numpy.float64))
         # copy calibrated image into self.dataout - make sure self.dataout is a pipedata object
         self.dataout = DataFits(config=self.datain.config)
-        self.dataout.image = image.data
+        self.dataout.image = asworkdtype(image.data, self.config)
         self.dataout.header = image.header
         self.dataout.filename = self.datain.filename
         ### Finish - cleanup
@@ -176,7 +222,7 @@ class StepBiasDarkFlat(StepLoadAux, StepParent):
             raise RuntimeError('No bias file loaded')
         self.log.debug('Creating master bias frame...')
         #if there is just one, use it as biasfile or else combine all to make a master bias
-        self.bias = ccdproc.CCDData.read(namelist, unit='adu', relax=True)
+        self.bias = readmaster(namelist, workdtype(self.config))
         # Finish up
         self.biasloaded = True
         self.biasname = namelist
@@ -215,7 +261,7 @@ class StepBiasDarkFlat(StepLoadAux, StepParent):
         #         darks = name
         self.log.debug('Creating master dark frame...')
         #if there is just one, use it as darkfile or else combine all to make a master dark
-        self.dark = ccdproc.CCDData.read(namelist, unit='adu', relax=True)
+        self.dark = readmaster(namelist, workdtype(self.config))
         #bias correct, if necessary
         # if(not dark_is_bias_corrected):
         #     #Subtracting master bias frame from master dark frame
@@ -300,7 +346,7 @@ class StepBiasDarkFlat(StepLoadAux, StepParent):
         #     self.log.info("Average exposure time for flats is %f"%flat_ave_exptime)
         self.log.debug('Creating master flat frame...')
         #if there is just one, use it as flatfile or else combine all to make a master flat
-        self.flat = ccdproc.CCDData.read(namelist, unit='adu', relax=True)    
+        self.flat = readmaster(namelist, workdtype(self.config))    
         # Finish up
         self.flatloaded = True  
         self.flatname = namelist 
@@ -331,6 +377,12 @@ if __name__ == '__main__':
     StepBiasDarkFlat().execute()
     
 '''HISTORY:
+2026-10-18 - Images and masters are processed in the working data type
+             (workdtype in [data], float32 by default)
+2026-10-18 - Added checkpoint and resume (StepCheckpoint)
+2026-10-18 - Added step result cache (StepCache)
+2026-10-18 - Master frames are cached by filename and date (readmaster), they
+             can be preloaded by the prefetch thread
 2018-08-02 - Bias/Dark correction of darks/flats moved to stepmasterbias/dark/flat - Matt Merz
 07/28/2017 - Script created by Atreyo Pal
 '''
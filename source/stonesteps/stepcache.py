@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+""" PIPE STEP CACHE - Version 1.0.0
+
+    This module provides a result cache for pipe steps. The output of a
+    step is stored under a key which is a hash of:
+    - the identity of the input data (the key of the step that made the
+      input data, or a hash of the data and header if the input was
+      changed by a step without cache)
+    - the values of all step parameters
+    - the step name and version (stepver)
+    - additional inputs given by the step (see cacheextra())
+    If a step is called with the same key again, the stored result is
+    returned instead of running the step. The key is stored in the
+    CACHEKEY header keyword of the output, so the following steps
+    include it in their keys: a pipeline run resumes with the first step
+    for which something has changed.
+
+    The cache is configured in the [stepcache] section of the pipeline
+    configuration, it is off unless cachefolder is set:
+        [stepcache]
+            cachefolder = /path/to/cache # folder for stored results
+            maxsize = 20000 # maximal total size in MB
+            maxage = 30 # maximal age (since last use) in days
+
+    Pipe steps use the cache by inheriting from StepCache (before the
+    parent step object) and calling self.cachesetup() in setup().
+"""
+
+import os # os library
+import json # to store the cache index
+import time # time library
+import hashlib # to make cache keys
+import threading # lock for the cache index
+from darepype.drp import DataParent # Pipeline Data object
+from darepype.drp import StepParent # pipe step parent object
+from stonesteps.workdtype import workdtype # working data type
+
+# Header keywords that change with every run and are not used for the data hash
+VOLATILEKEYS = ['HISTORY', 'COMMENT', 'DATE', 'FILENAME', 'PIPEVERS', 'CACHEKEY', 'CACHESTP']
+
+# Lock for reading / writing the cache index
+cachelock = threading.Lock()
+
+def datahash(data):
+    """ Returns a hash (hex string) of the images, tables and headers in a
+        pipe data object. Keywords in VOLATILEKEYS are ignored.
+    """
+    sha = hashlib.sha1()
+    for head in getattr(data, 'imgheads', []) + getattr(data, 'tabheads', []):
+        for card in head.cards:
+            if card.keyword not in VOLATILEKEYS:
+                sha.update(str(card).encode('ascii', 'replace'))
+    for arr in getattr(data, 'imgdata', []) + getattr(data, 'tabdata', []):
+        if arr is not None:
+            sha.update(str(arr.dtype).encode() + str(arr.shape).encode())
+            sha.update(arr.tobytes())
+    return sha.hexdigest()
+
+class StepCache(StepParent):
+    """ Pipe step cache object: to be inherited by pipe steps
+    """
+
+    def cachesetup(self):
+        """ Adds the cache parameters to the step. This function should
+            be called in the setup function of the child step after
+            self.paramlist has been initiated.
+        """
+        self.paramlist.append(['usecache', True,
+                               'Flag to use the step cache (if enabled in [stepcache])'])
+
+    def cacheconf(self, name, default):
+        """ Returns a value from the [stepcache] configuration section
+        """
+        try:
+            value = self.config['stepcache'][name]
+        except (KeyError, TypeError):
+            return default
+        if isinstance(default, str):
+            return os.path.expandvars(value)
+        return type(default)(value)
+
+    def cacheextra(self):
+        """ Returns a list of additional values that identify the step
+            inputs (for example names and dates of auxiliary files).
+            Overwrite this function in the child step if needed.
+        """
+        return []
+
+    def cacheable(self):
+        """ Returns False if the current result should not be stored
+            (for example if it depends on a time limit).
+            Overwrite this function in the child step if needed.
+        """
+        return True
+
+    def cachekey(self):
+        """ Returns the cache key for the current input data and
+            parameters
+        """
+        sha = hashlib.sha1()
+        # Step name and version
+        sha.update(('%s %s %s' % (self.__class__.__name__, self.name, self.stepver)).encode())
+        # Input data identity: use the key of the step that made the data
+        # if the data has not been changed since
+        try:
+            upkey = self.datain.getheadval('CACHEKEY', errmsg = False)
+            upstep = self.datain.getheadval('CACHESTP', errmsg = False)
+            prodtype = self.datain.getheadval('PRODTYPE', errmsg = False)
+        except KeyError:
+            upkey = upstep = prodtype = ''
+        if len(upkey) and upstep == prodtype:
+            sha.update(('up %s' % upkey).encode())
+        else:
+            sha.update(('up %s data %s' % (upkey, datahash(self.datain))).encode())
+        # Parameter values
+        for par in self.paramlist:
+            if par[0] == 'usecache':
+                continue
+            sha.update(('%s=%r' % (par[0], self.getarg(par[0]))).encode())
+        # Working data type
+        sha.update(('dtype %s' % workdtype(self.config)).encode())
+        # Additional inputs
+        for extra in self.cacheextra():
+            sha.update(('extra %r' % (extra,)).encode())
+        return sha.hexdigest()
+
+    def __call__(self, datain, **arglist):
+        """ Object Call: returns reduced input data
+            The result is taken from the cache if available.
+        """
+        self.datain = datain
+        self.runstart(self.datain, arglist)
+        cachefolder = self.cacheconf('cachefolder', '')
+        key = None
+        if len(cachefolder) and self.getarg('usecache'):
+            key = self.cachekey()
+            dataout = self.cacheload(cachefolder, key)
+            if dataout is not None:
+                self.dataout = dataout
+                self.arglist = {}
+                self.log.info('Finished: Pipe Step %s on file %s (from cache)' %
+                              (self.name, os.path.split(self.dataout.filename)[1]))
+                return self.dataout
+        self.run()
+        self.runend(self.dataout)
+        if key is not None and self.cacheable():
+            self.cachestore(cachefolder, key)
+        return self.dataout
+
+    def cacheload(self, cachefolder, key):
+        """ Returns the stored result for key, None if there is none
+        """
+        indexname = os.path.join(cachefolder, 'cacheindex.json')
+        with cachelock:
+            index = self.cacheindex(indexname)
+            if key not in index:
+                return None
+            entry = index[key]
+            cachename = os.path.join(cachefolder, key + '.fits')
+            if not os.path.exists(cachename):
+                del index[key]
+                self.cachesave(indexname, index)
+                return None
+            entry['used'] = time.time()
+            self.cachesave(indexname, index)
+        try:
+            data = DataParent(config = self.config).load(cachename)
+        except Exception as error:
+            self.log.warning('CacheLoad: unable to load %s (%s)' % (cachename, str(error)))
+            return None
+        data.filename = entry['filename']
+        self.log.debug('CacheLoad: loaded result for key %s' % key)
+        return data
+
+    def cachestore(self, cachefolder, key):
+        """ Stores self.dataout under key, then removes old entries
+        """
+        if not os.path.exists(cachefolder):
+            os.makedirs(cachefolder)
+        self.dataout.setheadval('CACHEKEY', key, 'Step cache key')
+        self.dataout.setheadval('CACHESTP', self.name, 'Step which made CACHEKEY')
+        cachename = os.path.join(cachefolder, key + '.fits')
+        self.dataout.save(cachename)
+        indexname = os.path.join(cachefolder, 'cacheindex.json')
+        with cachelock:
+            index = self.cacheindex(indexname)
+            index[key] = {'filename': self.dataout.filename,
+                          'step': self.name,
+                          'size': os.path.getsize(cachename),
+                          'used': time.time()}
+            self.cacheevict(cachefolder, index)
+            self.cachesave(indexname, index)
+        self.log.debug('CacheStore: stored result for key %s' % key)
+
+    def cacheevict(self, cachefolder, index):
+        """ Removes entries which have not been used for maxage days,
+            then the least recently used entries until the total size is
+            below maxsize.
+        """
+        maxage = self.cacheconf('maxage', 30.0) * 86400.
+        maxsize = self.cacheconf('maxsize', 20000.0) * 1e6
+        now = time.time()
+        keys = sorted(index.keys(), key = lambda k: index[k]['used'])
+        total = sum(index[k]['size'] for k in keys)
+        for k in keys:
+            if now - index[k]['used'] < maxage and total <= maxsize:
+                break
+            total -= index[k]['size']
+            try:
+                os.remove(os.path.join(cachefolder, k + '.fits'))
+            except OSError:
+                pass
+            self.log.debug('CacheEvict: removed %s (%s)' % (k, index[k]['step']))
+            del index[k]
+
+    def cacheindex(self, indexname):
+        """ Reads the cache index file
+        """
+        if not os.path.exists(indexname):
+            return {}
+        try:
+            with open(indexname) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            self.log.warning('CacheIndex: unable to read %s - starting new index' % indexname)
+            return {}
+
+    def cachesave(self, indexname, index):
+        """ Writes the cache index file
+        """
+        tmpname = indexname + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmpname, indexname)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+""" PIPE STEP CHECKPOINT - Version 1.0.0
+
+    This module lets the pipeline resume a reduction where it stopped.
+    After a pipe step is done with a frame, its output is saved next to
+    the input file and the step is recorded in a checkpoint file in the
+    same folder. The checkpoint file holds, for each frame (identified by
+    the file name beginning, see data:filenamebegin), the ordered list of
+    completed steps with the name and date of the saved product.
+
+    When the pipeline is run again, a step that is already recorded for
+    the frame loads its saved product instead of running. As soon as one
+    step has to run, the records of all following steps for that frame
+    are dropped, so the reduction continues from the first incomplete
+    step. A record is also dropped if the saved product has been removed
+    or replaced by an older file, or if the step parameters have changed.
+    (The product may be saved again later by a 'save' entry in the
+    stepslist, so newer files are accepted.)
+
+    The checkpoints are configured in the [checkpoint] section of the
+    pipeline configuration:
+        [checkpoint]
+            enabled = True # flag to use checkpoints
+            filename = pipecheckpoint.json # checkpoint file in each folder
+            restartfrom = '' # step name (ex. astrometry or StepAstrometry)
+                             # from which all steps are run again
+    Pipe steps use checkpoints by inheriting from StepCheckpoint (before
+    the parent step object and before StepCache).
+"""
+
+import os # os library
+import json # to store the checkpoint file
+import hashlib # to identify parameter sets
+import threading # lock for the checkpoint files
+from darepype.drp import DataParent # Pipeline Data object
+from darepype.drp import StepParent # pipe step parent object
+from stonesteps.workdtype import workdtype # working data type
+
+# Lock for reading / writing checkpoint files
+checkpointlock = threading.Lock()
+
+class StepCheckpoint(StepParent):
+    """ Pipe step checkpoint object: to be inherited by pipe steps
+    """
+
+    # Frames for which restartfrom has been applied in this session:
+    # {(checkpoint file, frame)}. The restart is only done once per frame,
+    # the steps after the restart step find no records and run anyway.
+    restarted = set()
+
+    def checkpointconf(self, name, default):
+        """ Returns a value from the [checkpoint] configuration section
+        """
+        try:
+            value = self.config['checkpoint'][name]
+        except (KeyError, TypeError):
+            return default
+        if isinstance(default, bool):
+            return str(value).lower() in ['true', '1', 'yes']
+        return type(default)(value)
+
+    def checkpointparams(self):
+        """ Returns a hash (hex string) of the current parameter values
+            and the working data type
+        """
+        sha = hashlib.sha1()
+        sha.update(('dtype %s' % workdtype(self.config)).encode())
+        for par in self.paramlist:
+            sha.update(('%s=%r' % (par[0], self.getarg(par[0]))).encode())
+        return sha.hexdigest()
+
+    def checkpointable(self):
+        """ Returns False if the current result should not be recorded,
+            then the step runs again next time.
+            Overwrite this function in the child step if needed.
+        """
+        return True
+
+    def __call__(self, datain, **arglist):
+        """ Object Call: returns reduced input data
+            The saved product is returned if the step was already
+            completed for this frame.
+        """
+        self.config = datain.config
+        self.arglist = arglist
+        if not self.checkpointconf('enabled', False):
+            return super(StepCheckpoint, self).__call__(datain, **arglist)
+        folder = os.path.dirname(os.path.abspath(datain.filename))
+        filename = os.path.join(folder, self.checkpointconf('filename', 'pipecheckpoint.json'))
+        frame = os.path.split(datain.filenamebegin)[1]
+        params = self.checkpointparams()
+        # Look for a valid record of this step
+        dataout = self.checkpointload(filename, frame, params)
+        if dataout is not None:
+            self.dataout = dataout
+            self.arglist = {}
+            self.log.info('Finished: Pipe Step %s on file %s (from checkpoint)' %
+                          (self.name, os.path.split(self.dataout.filename)[1]))
+            return self.dataout
+        # Run the step, save the product and record it
+        dataout = super(StepCheckpoint, self).__call__(datain, **arglist)
+        if self.checkpointable():
+            self.checkpointstore(filename, frame, params, dataout)
+        return dataout
+
+    def checkpointload(self, filename, frame, params):
+        """ Returns the saved product of this step for frame. Returns None
+            if the step has to run: then the records of this step and all
+            following steps are removed.
+        """
+        with checkpointlock:
+            checkpoint = self.checkpointread(filename)
+            records = checkpoint.get(frame, [])
+            # Apply the restart option (once per frame)
+            restartfrom = self.checkpointconf('restartfrom', '').strip().lower()
+            if len(restartfrom) and (filename, frame) not in StepCheckpoint.restarted:
+                StepCheckpoint.restarted.add((filename, frame))
+                names = [r['step'] for r in records]
+                classes = [r['class'].lower() for r in records]
+                if restartfrom in names:
+                    records = records[:names.index(restartfrom)]
+                elif restartfrom in classes:
+                    records = records[:classes.index(restartfrom)]
+                else:
+                    self.log.warning('CheckpointLoad: step %s not found for %s - running all steps' %
+                                     (restartfrom, frame))
+                    records = []
+            # Find the record for this step
+            names = [r['step'] for r in records]
+            dataout = None
+            if self.name in names:
+                ind = names.index(self.name)
+                record = records[ind]
+                product = record['product']
+                if ( record['params'] == params and os.path.exists(product) and
+                     os.path.getmtime(product) >= record['mtime'] ):
+                    try:
+                        dataout = DataParent(config = self.config).load(product)
+                    except Exception as error:
+                        self.log.warning('CheckpointLoad: unable to load %s (%s)' %
+                                         (product, str(error)))
+                if dataout is None:
+                    self.log.debug('CheckpointLoad: record of %s for %s is invalid' %
+                                   (self.name, frame))
+                    records = records[:ind]
+            if records != checkpoint.get(frame, []):
+                checkpoint[frame] = records
+                self.checkpointwrite(filename, checkpoint)
+        return dataout
+
+    def checkpointstore(self, filename, frame, params, dataout):
+        """ Saves dataout and records it as the product of this step for
+            frame. Records of this step and all following steps are
+            replaced.
+        """
+        dataout.save()
+        product = os.path.abspath(dataout.filename)
+        with checkpointlock:
+            checkpoint = self.checkpointread(filename)
+            records = checkpoint.get(frame, [])
+            names = [r['step'] for r in records]
+            if self.name in names:
+                records = records[:names.index(self.name)]
+            records.append({'step': self.name,
+                            'class': self.__class__.__name__,
+                            'product': product,
+                            'mtime': os.path.getmtime(product),
+                            'params': params})
+            checkpoint[frame] = records
+            self.checkpointwrite(filename, checkpoint)
+        self.log.debug('CheckpointStore: %s done for %s' % (self.name, frame))
+
+    def checkpointread(self, filename):
+        """ Reads the checkpoint file
+        """
+        if not os.path.exists(filename):
+            return {}
+        try:
+            with open(filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            self.log.warning('CheckpointRead: unable to read %s - starting new file' % filename)
+            return {}
+
+    def checkpointwrite(self, filename, checkpoint):
+        """ Writes the checkpoint file
+        """
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(checkpoint, f, indent = 1)
+        os.replace(tmpname, filename)
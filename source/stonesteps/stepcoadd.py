@@ -15,6 +15,7 @@ from astropy import wcs as wcs
 from drizzle import drizzle as drz
 from darepype.drp import StepMIParent
 from darepype.drp import DataFits
+from stonesteps.workdtype import workdtype # working data type
 import math
 
 class StepCoadd(StepMIParent):
@@ -99,9 +100,10 @@ class StepCoadd(StepMIParent):
         py = []
         
         #in order to avoid NaN interactions, creating weight map
+        dtype = workdtype(self.config)
         weights=[]
         for f in self.datain:
-            weights.append((np.where(np.isnan(f.image) == True, 0, 1)))
+            weights.append((~np.isnan(f.image)).astype(dtype))
         
         for f in self.datain:
             px.extend(wcs.WCS(f.header).calc_footprint()[:,0])
@@ -179,8 +181,8 @@ class StepCoadd(StepMIParent):
             self.log.error('Fillvalue not recognized or missing, using default')
         
         #creates output fits file from drizzle output
-        self.dataout.imageset(np.where(driz.outsci == 10000, fillval, driz.outsci))
-        self.dataout.imageset(driz.outwht,'OutWeight', self.dataout.header)
+        self.dataout.imageset(np.where(driz.outsci == 10000, fillval, driz.outsci).astype(dtype))
+        self.dataout.imageset(driz.outwht.astype(dtype),'OutWeight', self.dataout.header)
         self.dataout.filename = self.datain[0].filename
 
         #add history
@@ -203,4 +205,5 @@ if __name__ == '__main__':
     2019-05-22 New step created for mosaicing and combining images - Matt Merz
     2019-05-24 Minor changes, notably no longer utilizing Grizli for making expanded WCS - Matt Merz
     2019-06-0 More changes - basic angle inplementation, disallowing frames too far away from the rest - Matt Merz
+    2026-10-18 Weights and outputs use the working data type (workdtype in [data])
 """
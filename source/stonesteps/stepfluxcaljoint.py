@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+""" PIPE STEP FLUX CALIBRATION JOINT - Version 1.0.0
+
+    This multi-input pipe step flux calibrates all frames of a night
+    together. StepFluxCalSex queries the star catalog and fits the
+    zeropoint for each frame on its own, but the frames of the same field
+    in the same filter share the reference stars. For each group of
+    frames with the same object and filter:
+    - the sources of each frame are extracted with sep (settings from the
+      SExtractor configuration and filter files, as StepFluxCalSex with
+      extractor = sep)
+    - the catalog (local catalog store or guide star catalog) is read
+      once for the whole group and put into a KD-tree (see skymatch.py)
+    - the sources of each frame are matched one to one with the catalog
+    - the zeropoints of all frames are fit jointly with one color term
+      for the group and one offset (zeropoint and extinction) per frame,
+      as one sparse least squares problem (see photfit.jointfit)
+    The frames are then scaled to Jy/pixel like with StepFluxCalSex and
+    get the same keywords (PHTZPRAW, PTZRAWER, PHOTZP, BUNIT) and tables
+    (Sources, Fit Data). Frames left without WCS by the astrometry
+    (ASTRSTAT), frames flagged by the triage (skipquality, see
+    steptriage.py) and frames which can not be calibrated (failed source
+    extraction or group fit, too few matched stars) are passed on without
+    calibration, with the reason in HISTORY.
+
+    The step can replace StepFluxCalSex in the stepslist, it uses the
+    same file name identifier (FCAL).
+"""
+
+import os # os library
+import logging # logging object library
+import numpy # numpy library
+from astropy.io import fits # to make the tables
+from astropy import wcs # WCS object
+from astropy.coordinates import Angle
+import astropy.units as u
+from darepype.drp import StepMOParent # pipe step parent object
+from stonesteps.workdtype import asworkdtype # working data type
+from stonesteps.gsccatalog import querygsc # guide star catalog
+from stonesteps.catalogstore import CatalogStore # local catalog tiles
+from stonesteps.sepextract import readsexconfig, readsexfilter, sexcatalog # sep extraction
+from stonesteps.bkgmodel import BkgModel # background mesh model
+from stonesteps.skymatch import SkyMatcher, unitvectors # catalog matching
+from stonesteps.photfit import jointfit # joint zeropoint fit
+from stonesteps.indexmap import distance # angular distance
+from stonesteps.steptriage import qualityskip, qualitytext # triage quality flags
+
+class StepFluxCalJoint(StepMOParent):
+    """ Pipeline Step Object to flux calibrate groups of frames jointly
+    """
+    stepver = '0.1' # pipe step version
+
+    def __init__(self):
+        """ Constructor: Initialize data objects and variables
+        """
+        # call superclass constructor (calls setup)
+        super(StepFluxCalJoint,self).__init__()
+        # set configuration
+        self.log.debug('Init: done')
+
+    def setup(self):
+        """ ### Names and Parameters need to be Set Here ###
+            Sets the internal names for the function and for saved files.
+            Defines the input parameters for the current pipe step.
+            Setup() is called at the end of __init__
+            The parameters are stored in a list containing the following
+            information:
+            - name: The name for the parameter. This name is used when
+                    calling the pipe step from command line or python shell.
+                    It is also used to identify the parameter in the pipeline
+                    configuration file.
+            - default: A default value for the parameter. If nothing, set
+                       '' for strings, 0 for integers and 0.0 for floats
+            - help: A short description of the parameter.
+        """
+        ### Set Names
+        # Name of the pipeline reduction step
+        self.name='fluxcaljoint'
+        # Shortcut for pipeline reduction step and identifier for
+        # saved file names.
+        self.procname = 'FCAL'
+        # Set Logger for this pipe step
+        self.log = logging.getLogger('pipe.step.%s' % self.name)
+        ### Set Parameter list
+        # Clear Parameter list
+        self.paramlist = []
+        # Append parameters
+        self.paramlist.append(['filtermap', 'g-band=g|r-band=r|i-band=i|z-band=z',
+                               'Mapping from telescope filter names to SDSS filter names ' +
+                               '(as in fluxcalsex)'])
+        self.paramlist.append(['colormap', 'g=g-r|r=g-r|i=r-i|z=i-z',
+                               'Catalog color used for the color term of each SDSS filter'])
+        self.paramlist.append(['sx_confilename', 'psf.sex',
+                               'Filepathname for SourceExtractor configuration file'])
+        self.paramlist.append(['sx_filterfilename', 'default.conv',
+                               'Filepathname for SourceExtractor filter file'])
+        self.paramlist.append(['matchradius', 1.0,
+                               'Maximal distance of matched stars (pixels)'])
+        self.paramlist.append(['maxmag', 22.0,
+                               'Faintest catalog magnitude used for the fit'])
+        self.paramlist.append(['minstars', 5,
+                               'Minimal number of fitted stars of a frame'])
+        self.paramlist.append(['fitclip', 3.0,
+                               'Sigma clipping of the joint fit in robust standard ' +
+                               'deviations of the residuals (0 for no clipping)'])
+        self.paramlist.append(['catradius', 0.5,
+                               'Catalog radius around the pointings of a group (degrees)'])
+        self.paramlist.append(['gsccache', '',
+                               'Folder to keep guide star catalog query results ' +
+                               '(empty to always query the catalog)'])
+        self.paramlist.append(['catstore', '',
+                               'Folder of the local catalog store (see catalogstore.py, ' +
+                               'empty to query the guide star catalog)'])
+        self.paramlist.append(['catfetch', True,
+                               'Flag to query catalog tiles missing in the store ' +
+                               '(False to run offline)'])
+        self.paramlist.append(['skipquality', 0,
+                               'Frames with any of these triage quality flag bits are not ' +
+                               'calibrated (see steptriage.py, 0 to calibrate all frames)'])
+        # confirm end of setup
+        self.log.debug('Setup: done')
+
+    def run(self):
+        """ Runs the data reduction algorithm. The self.datain is run
+            through the code, the result is in self.dataout.
+        """
+        self.sexconfig = readsexconfig(os.path.expandvars(self.getarg('sx_confilename')))
+        self.kernel = readsexfilter(os.path.expandvars(self.getarg('sx_filterfilename')))
+        # Calibrate each group, results are stored by input index
+        results = [None] * len(self.datain)
+        # Frames without astrometry or flagged by the triage are passed on
+        # without calibration
+        for i, data in enumerate(self.datain):
+            skipmsg = self.skipmessage(data)
+            if len(skipmsg):
+                self.uncalibrated(results, i, 'skipped - ' + skipmsg)
+        # Frames of groups which fail are passed on without calibration
+        for (obj, band), group in self.groups(results).items():
+            self.log.info('Calibrating %d frames of %s in %s' % (len(group), obj, band))
+            try:
+                self.calibrate(group, band, results)
+            except Exception as error:
+                for i in group:
+                    if results[i] is None:
+                        self.uncalibrated(results, i, 'not calibrated - group calibration ' +
+                                          'failed - %s' % str(error))
+        self.dataout = [result for result in results if result is not None]
+        if not len(self.dataout):
+            raise RuntimeError('No frame could be calibrated')
+        self.log.debug('Run: Done')
+
+    def skipmessage(self, data):
+        """ Returns the reason why a frame is not calibrated or '': frames
+            left without WCS by the astrometry (ASTRSTAT is set) and frames
+            with triage quality flags in skipquality
+        """
+        if 'ASTRSTAT' in data.header:
+            return 'no astrometry (ASTRSTAT = %s)' % data.getheadval('ASTRSTAT')
+        skipflag = qualityskip(data, self.getarg('skipquality'))
+        if skipflag:
+            return 'quality flag %d (%s)' % (skipflag, qualitytext(skipflag))
+        return ''
+
+    def uncalibrated(self, results, i, reason):
+        """ Stores a copy of input frame i without calibration in results,
+            with the reason in HISTORY (as 'FluxCalJoint: reason')
+        """
+        histmsg = 'FluxCalJoint: ' + reason
+        self.log.warning('%s: %s' % (os.path.split(self.datain[i].filename)[1], histmsg))
+        results[i] = self.datain[i].copy()
+        results[i].setheadval('HISTORY', histmsg)
+
+    def groups(self, results):
+        """ Returns the groups of frames {(object, SDSS band): list of
+            input indices}. The object is the OBJECT keyword or the first
+            part of the file name. Frames which already have a result
+            are left out.
+        """
+        filtermap = dict(entry.split('=') for entry in self.getarg('filtermap').split('|')
+                         if '=' in entry)
+        groups = {}
+        for i, data in enumerate(self.datain):
+            if results[i] is not None:
+                continue
+            obj = data.getheadval('OBJECT') if 'OBJECT' in data.header else ''
+            if not len(str(obj).strip()):
+                obj = os.path.split(data.filename)[1].split('_')[0]
+            filtername = data.getheadval('FILTER')
+            band = filtermap.get(filtername, filtername)
+            groups.setdefault((str(obj).strip(), band), []).append(i)
+        return groups
+
+    def sources(self, data):
+        """ Extracts the sources of a frame, returns the catalog, the
+            selected stars (S/N and shape as in StepFluxCalSex) and the
+            background model
+        """
+        backsize = [int(float(v)) for v in self.sexconfig['BACK_SIZE'].replace(',', ' ').split()]
+        bkgmodel = BkgModel.load(data, [backsize[0], backsize[-1]])
+        catalog, bkgmodel = sexcatalog(data.image, data.header, self.sexconfig, self.kernel,
+                                       bkgmodel)
+        flux = numpy.asarray(catalog['FLUX_AUTO'])
+        fluxerr = numpy.asarray(catalog['FLUXERR_AUTO'])
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            sn = flux / fluxerr
+        stars = (sn > 10) & (sn < 1000) & ((numpy.asarray(catalog['FLUX_APER']) - flux) < 250)
+        return catalog, stars, bkgmodel
+
+    def reference(self, group, band):
+        """ Returns the catalog stars for a group of frames: table, band
+            magnitudes, errors and colors (stars with magnitude and color)
+        """
+        # Center and radius of all pointings of the group
+        ra = numpy.array([Angle(self.datain[i].getheadval('RA'), unit = u.hour).degree
+                          for i in group])
+        dec = numpy.array([Angle(self.datain[i].getheadval('DEC'), unit = u.deg).degree
+                           for i in group])
+        center = unitvectors(ra, dec).mean(axis = 0)
+        rac = numpy.degrees(numpy.arctan2(center[1], center[0])) % 360.0
+        decc = numpy.degrees(numpy.arctan2(center[2], numpy.hypot(center[0], center[1])))
+        radius = self.getarg('catradius') + numpy.max(distance(rac, decc, ra, dec))
+        if len(self.getarg('catstore')):
+            store = CatalogStore(self.getarg('catstore'))
+            table = store.cone(rac, decc, radius, self.getarg('catfetch'))
+        else:
+            table = querygsc(rac, decc, round(radius, 3), self.getarg('gsccache'))
+        # Magnitudes and colors
+        colormap = dict(entry.split('=') for entry in self.getarg('colormap').split('|'))
+        column = lambda name: numpy.ma.filled(numpy.ma.asarray(table[name], dtype = float), numpy.nan)
+        mag = column('SDSS%sMag' % band)
+        magerr = column('SDSS%sMagErr' % band)
+        blue, red = colormap.get(band, 'g-r').split('-')
+        color = column('SDSS%sMag' % blue) - column('SDSS%sMag' % red)
+        good = (mag > 0) & (mag < self.getarg('maxmag')) & numpy.isfinite(color)
+        self.colorname = '%s-%s' % (blue, red)
+        self.log.debug('Received %d catalog stars, %d with %s magnitude and color' %
+                       (len(table), good.sum(), band))
+        return (numpy.asarray(table['ra'], float)[good], numpy.asarray(table['dec'], float)[good],
+                mag[good], magerr[good], color[good])
+
+    def calibrate(self, group, band, results):
+        """ Calibrates a group of frames, stores the calibrated data in
+            results (by input index)
+        """
+        catra, catdec, catmag, catmagerr, catcolor = self.reference(group, band)
+        matcher = SkyMatcher(catra, catdec)
+        # Extract and match the stars of each frame
+        frames = []
+        fit = {'frame': [], 'cat': [], 'source': [], 'sep': []}
+        for i in group:
+            data = self.datain[i]
+            try:
+                catalog, stars, bkgmodel = self.sources(data)
+            except Exception as error:
+                self.uncalibrated(results, i, 'not calibrated - source extraction ' +
+                                  'failed - %s' % str(error))
+                continue
+            scale = numpy.mean(wcs.utils.proj_plane_pixel_scales(wcs.WCS(data.header)))
+            index = numpy.nonzero(stars)[0]
+            first, second, sep = matcher.onetoone(numpy.asarray(catalog['ALPHA_J2000'])[index],
+                                                  numpy.asarray(catalog['DELTA_J2000'])[index],
+                                                  self.getarg('matchradius') * scale)
+            fit['frame'].append(numpy.full(len(first), len(frames)))
+            fit['source'].append(index[first])
+            fit['cat'].append(second)
+            fit['sep'].append(sep)
+            frames.append((i, catalog, stars, bkgmodel))
+        if not len(frames):
+            return
+        fit = {key: numpy.concatenate(values) for key, values in fit.items()}
+        # Instrumental magnitudes of the matched stars (all sources of all frames)
+        flux = numpy.concatenate([numpy.asarray(frame[1]['FLUX_AUTO']) for frame in frames])
+        fluxerr = numpy.concatenate([numpy.asarray(frame[1]['FLUXERR_AUTO']) for frame in frames])
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            instmag = -2.5 * numpy.log10(flux)
+            instmagerr = 2.5 / numpy.log(10) * fluxerr / flux
+        starts = numpy.cumsum([0] + [len(frame[1]) for frame in frames])[:-1]
+        source = starts[fit['frame']] + fit['source']
+        error = numpy.sqrt(catmagerr[fit['cat']] ** 2 + instmagerr[source] ** 2)
+        error[~numpy.isfinite(error)] = numpy.nanmedian(error) if numpy.isfinite(error).any() else 0.1
+        # Joint fit of all frames
+        offset, offseterr, scatter, colorterm, colorerr, pivot, used = jointfit(
+            fit['frame'], catmag[fit['cat']], catcolor[fit['cat']], instmag[source], error,
+            len(frames), self.getarg('fitclip'))
+        self.log.info('Joint fit of %d frames, %d stars: color term %.4f +- %.4f (%s)' %
+                      (len(frames), used.sum(), colorterm, colorerr, self.colorname))
+        for f, (i, catalog, stars, bkgmodel) in enumerate(frames):
+            data = self.datain[i]
+            filename = os.path.split(data.filename)[1]
+            inframe = used & (fit['frame'] == f)
+            if inframe.sum() < self.getarg('minstars') or not numpy.isfinite(offset[f]):
+                self.uncalibrated(results, i, 'not calibrated - only %d stars fitted' % inframe.sum())
+                continue
+            self.log.info('%s: offset %f +- %f mag, scatter %f mag (%d stars)' %
+                          (filename, offset[f], offseterr[f], scatter[f], inframe.sum()))
+            results[i] = self.scale(data, catalog, stars, bkgmodel, offset[f], offseterr[f],
+                                    colorterm, pivot, fit, inframe, catra, catdec,
+                                    catmag, error, instmag[source])
+
+    def scale(self, data, catalog, stars, bkgmodel, offset, offseterr, colorterm, pivot,
+              fit, inframe, catra, catdec, catmag, error, instmag):
+        """ Scales a frame to Jy/pixel with the fitted offset, adds the
+            keywords and the tables (as StepFluxCalSex), returns the
+            calibrated copy of the data
+        """
+        dataout = data.copy()
+        # Keywords
+        dataout.setheadval('PHTZPRAW', -offset, 'Photometric zeropoint for RAW data')
+        dataout.setheadval('PTZRAWER', offseterr, 'Uncertainty of the RAW photometric zeropoint')
+        dataout.setheadval('PHOTZP', 8.9, 'Photometric zeropoint MAG=-2.5*log(data)+PHOTZP')
+        dataout.setheadval('BUNIT', 'Jy/pixel', 'Units for the data')
+        dataout.setheadval('PHTCOLOR', self.colorname, 'Catalog color of the color term')
+        dataout.setheadval('PHTCOLTM', colorterm, 'Color term of the joint calibration fit')
+        dataout.setheadval('PHTCOLPV', pivot, 'Color of the zeropoint (color term pivot)')
+        # Scale the image
+        bscale = 3631. * 10 ** (offset/2.5)
+        dataout.image = asworkdtype(bscale * (dataout.image - bkgmodel.background()), self.config)
+        bkgmodel.scaled(bscale, bkgmodel).store(dataout)
+        # Sources table
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            mag = -2.5 * numpy.log10(numpy.asarray(catalog['FLUX_AUTO'])[stars])
+            magerr = (2.5 / numpy.log(10) * numpy.asarray(catalog['FLUXERR_AUTO'])[stars] /
+                      numpy.asarray(catalog['FLUX_AUTO'])[stars])
+        cols = [fits.Column(name='ID', format='D', array=numpy.arange(1, stars.sum() + 1)),
+                fits.Column(name='RA', format='D', unit='deg',
+                            array=numpy.asarray(catalog['ALPHA_J2000'])[stars]),
+                fits.Column(name='Dec', format='D', unit='deg',
+                            array=numpy.asarray(catalog['DELTA_J2000'])[stars]),
+                fits.Column(name='Magnitude', format='D', unit='magnitude', array=mag - offset),
+                fits.Column(name='Magnitude_Err', format='D', unit='magnitude', array=magerr)]
+        table = fits.BinTableHDU.from_columns(fits.ColDefs(cols))
+        dataout.tableset(table.data, 'Sources', table.header)
+        # Fit data table
+        cat = fit['cat'][inframe]
+        cols = [fits.Column(name='RA', format='D', unit='deg', array=catra[cat]),
+                fits.Column(name='Dec', format='D', unit='deg', array=catdec[cat]),
+                fits.Column(name='Diff_Deg', format='D', unit='deg', array=fit['sep'][inframe]),
+                fits.Column(name='GSC_Mag', format='D', unit='magnitude', array=catmag[cat]),
+                fits.Column(name='Img_Mag', format='D', unit='magnitude', array=instmag[inframe]),
+                fits.Column(name='Error', format='D', unit='magnitude', array=error[inframe])]
+        table = fits.BinTableHDU.from_columns(fits.ColDefs(cols))
+        dataout.tableset(table.data, 'Fit Data', table.header)
+        return dataout
+
+if __name__ == '__main__':
+    """ Main function to run the pipe step from command line on a file.
+        Command:
+          python stepparent.py input.fits -arg1 -arg2 . . .
+        Standard arguments:
+          --config=ConfigFilePathName.txt : name of the configuration file
+          -t, --test : runs the functionality test i.e. pipestep.test()
+          --loglevel=LEVEL : configures the logging output for a particular level
+          -h, --help : Returns a list of
+    """
+    StepFluxCalJoint().execute()
+
+""" === History ===
+2026-10-18 Frames which can not be calibrated are passed on instead of removed
+2026-10-18 Frames left without WCS by the astrometry (ASTRSTAT) are not calibrated
+2026-10-18 Frames with triage quality flags in skipquality are not calibrated
+2026-10-18 First version
+"""
@@ -8,7 +8,12 @@
 
     Requirements: This step requires the source extractor program see
         https://www.astromatic.net/software/sextractor
-      for details.
+      for details. With extractor = sep the sources are extracted in
+      memory with the sep library instead (see sepextract.sexcatalog).
+      The background is kept as mesh model (see bkgmodel.py): SExtractor
+      writes the small MINIBACKGROUND / MINIBACK_RMS check images, sep
+      uses the model of a previous step (StepHotpix) if there is one.
+      The model (scaled like the image) is stored in the output data.
 
     Author: Amanda Pagul / Marc Berthoud
 
@@ -22,19 +27,23 @@ import scipy # scipy library
 import string # string library
 import logging # logging object library
 import subprocess # running a subprocess library
-import requests # http request library
 import astropy.table # Read astropy tables
 from astropy.io import fits
 from astropy.io import ascii
 from astropy.coordinates import SkyCoord # To make RA/Dec as float
 from astropy import units as u # To help with SkyCoord
-import matplotlib # to make plots
-matplotlib.use('Agg') # Set pixel image
-import pylab as plt # pylab library for plotting
-from lmfit import minimize, Parameters # For brightness correction fit
 from darepype.drp import StepParent # pipestep stepparent object
+from stonesteps.stepcache import StepCache # pipestep result cache
+from stonesteps.stepcheckpoint import StepCheckpoint # pipestep checkpoints
+from stonesteps.workdtype import asworkdtype # working data type
+from stonesteps.gsccatalog import querygsc, gsccachename # guide star catalog
+from stonesteps.skymatch import SkyMatcher # catalog matching
+from stonesteps.photfit import clippedfit, zeropoint, bootstrap # zeropoint fit
+from stonesteps.bkgmodel import BkgModel # background mesh model
+from stonesteps.plotrender import saveplotdata # deferred fit plot
+from stonesteps.steptriage import qualityskip, qualitytext # triage quality flags
 
-class StepFluxCalSex(StepParent):
+class StepFluxCalSex(StepCheckpoint, StepCache, StepParent):
     """ Pipeline Step Object to calibrate Bias/Dark/Flat files
     """
 
@@ -71,6 +80,9 @@ class StepFluxCalSex(StepParent):
                                'Mapping from telescope filter names to SDSS filter names. ' +
                                'Data from multiple filters can be calibrated using the same band. ' +
                                'Example: "telg=g|telr=r|telclear=r"'])
+        self.paramlist.append(['extractor', 'sextractor',
+                               'Source extraction backend: sextractor (runs sx_cmd) or ' +
+                               'sep (in memory, uses sx_confilename and sx_filterfilename)'])
         self.paramlist.append(['sx_cmd', 'sex %s',
                                'Command to call source extractor, should contain ' +
                                '1 string placeholder for intput filepathname'])
@@ -91,14 +103,36 @@ class StepFluxCalSex(StepParent):
                                'source extractor'])
         self.paramlist.append(['zeropercent', 30.0,
                                'Percentile for BZERO value'])
+        self.paramlist.append(['fitclip', 3.0,
+                               'Sigma clipping of the zeropoint fit in robust standard ' +
+                               'deviations of the residuals (0 for no clipping)'])
+        self.paramlist.append(['bootstrap', 200,
+                               'Number of bootstrap resamples for the zeropoint ' +
+                               'uncertainty (PTZRAWER)'])
         self.paramlist.append(['fitplot',False,
-                               'Flag for making png plot of the fit'])
+                               'Flag for saving the plot data of the fit ' +
+                               '(png rendered later with plotrender.py)'])
         self.paramlist.append(['sourcetable',False,
                                'Flag for making txt table of all sources'])
         self.paramlist.append(['sourcetableformat','csv',
                                'txt table format (see astropy.io.ascii for options)'])
         self.paramlist.append(['savebackground',False,
-                               'Flag for saving a background image'])
+                               'Flag for saving a full size background image ' +
+                               '(interpolated from the background mesh)'])
+        self.paramlist.append(['gsccache','',
+                               'Folder to keep guide star catalog query results ' +
+                               '(empty to always query the catalog)'])
+        self.paramlist.append(['catstore','',
+                               'Folder of the local catalog store (see catalogstore.py, ' +
+                               'empty to query the guide star catalog)'])
+        self.paramlist.append(['catfetch',True,
+                               'Flag to query catalog tiles missing in the store ' +
+                               '(False to run offline)'])
+        self.paramlist.append(['skipquality', 0,
+                               'Frames with any of these triage quality flag bits are not ' +
+                               'calibrated (see steptriage.py, 0 to calibrate all frames)'])
+        # Get parameters for StepCache
+        self.cachesetup()
         # confirm end of setup
         self.log.debug('Setup: done')
 
@@ -106,42 +140,30 @@ class StepFluxCalSex(StepParent):
         """ Runs the calibrating algorithm. The calibrated data is
             returned in self.dataout
         """
+        ### Skip frames without astrometry or flagged by the triage (see steptriage.py)
+        skipmsg = self.skipmessage(self.datain)
+        if len(skipmsg):
+            histmsg = 'FluxCalSex: skipped - ' + skipmsg
+            self.log.warning(histmsg)
+            self.dataout = self.datain.copy()
+            self.dataout.setheadval('HISTORY', histmsg)
+            return
         ### Preparation
         binning = self.datain.getheadval('XBIN')
-        ### Run Source Extractor
-        # Make sure input data exists as file
-        if not os.path.exists(self.datain.filename) :
-            self.datain.save()
-        # Make catalog filename
-        catfilename = self.datain.filenamebegin
-        if catfilename[-1] in '._-': catfilename += 'sex_cat.fits'
-        else: catfilename += '.sex_cat.fits'
         # Make background filename (may not be used - see below)
         bkgdfilename = self.datain.filenamebegin
         if bkgdfilename[-1] in '._-': bkgdfilename += 'SxBkgd.fits'
         else: bkgdfilename += '_SxBkgd.fits'
-        self.log.debug('Sextractor catalog filename = %s' % catfilename)
-        # Make command string
-        command = self.getarg('sx_cmd') % (self.datain.filename)
-        command += ' ' + self.getarg('sx_options')
-        command += ' -c ' + os.path.expandvars(self.getarg('sx_confilename'))
-        command += ' -CATALOG_NAME ' + catfilename
-        command += ' -PARAMETERS_NAME ' + os.path.expandvars(self.getarg('sx_paramfilename'))
-        command += ' -FILTER_NAME ' + os.path.expandvars(self.getarg('sx_filterfilename'))
-        # Still make backgroundimage so you can subtract it below
-        command += ' -CHECKIMAGE_TYPE BACKGROUND'
-        command += ' -CHECKIMAGE_NAME ' + bkgdfilename
-        # Call process
-        self.log.debug('running command = %s' % command)
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-        output, error = process.communicate()
-        if self.getarg('verbose'):
-            self.log.debug(output)
-        #subprocess.check_call(command)
-        ### Extract catalog from source extractor and clean up dataset
-        # Use catalog from sourse extrator (test.cat)
-        seo_catalog = astropy.table.Table.read(catfilename, format="fits", hdu='LDAC_OBJECTS')
+        ### Extract sources
+        if self.getarg('extractor') == 'sep':
+            seo_catalog, bkgmodel = self.runsep()
+        else:
+            seo_catalog, bkgmodel = self.runsextractor()
+        # Full size background (for the scaling below)
+        image_background = bkgmodel.background()
+        if self.getarg('savebackground'):
+            fits.PrimaryHDU(image_background).writeto(bkgdfilename, overwrite = True)
+        ### Clean up dataset
         seo_Mag = -2.5*np.log10(seo_catalog['FLUX_AUTO'])
         seo_MagErr = (2.5/np.log(10)*seo_catalog['FLUXERR_AUTO']/seo_catalog['FLUX_AUTO'])
         # Select only the stars in the image: circular image and S/N > 10
@@ -149,24 +171,19 @@ class StepFluxCalSex(StepParent):
         seo_SN = ((seo_catalog['FLUX_AUTO']/seo_catalog['FLUXERR_AUTO'])>10)
         seo_SN = (seo_SN) & (elongation) & ((seo_catalog['FLUX_AUTO']/seo_catalog['FLUXERR_AUTO'])<1000)
         self.log.debug('Selected %d stars from Source Extrator catalog' % np.count_nonzero(seo_SN))
-        # Delete source extractor catalog is needed
-        if self.getarg('delete_cat'):
-            os.remove(catfilename)
         ### Query and extract data from Guide Star Catalog
         # Get RA / Dec
-        ra_center =  self.datain.getheadval('RA' ).split(':')
-        dec_center = self.datain.getheadval('DEC').split(':')
-        ra_cent =  ' '.join([str(s) for s in ra_center])
-        dec_cent = ' '.join([str(s) for s in dec_center])
-        center_coordinates = SkyCoord(ra_cent + ' ' + dec_cent, unit=(u.hourangle, u.deg) )
+        center_coordinates = self.center()
         self.log.debug('Using RA/Dec = %s / %s' % (center_coordinates.ra, center_coordinates.dec) )
-        # Querry guide star catalog2 with center coordinates
-        gsc2_query = 'http://gsss.stsci.edu/webservices/vo/CatalogSearch.aspx?'
-        gsc2_query += 'RA='+str(center_coordinates.ra.value)
-        gsc2_query += '&DEC='+str(center_coordinates.dec.value)
-        gsc2_query += '&DSN=+&FORMAT=CSV&CAT=GSC241&SR=0.5&'
-        self.log.debug('Running URL = %s' % gsc2_query)
-        gsc2_result = requests.get(gsc2_query)
+        # Get guide star catalog stars around the center coordinates
+        if len(self.getarg('catstore')):
+            from stonesteps.catalogstore import CatalogStore # local catalog tiles
+            store = CatalogStore(self.getarg('catstore'))
+            query_table = store.cone(center_coordinates.ra.value, center_coordinates.dec.value,
+                                     0.5, self.getarg('catfetch'))
+        else:
+            query_table = querygsc(center_coordinates.ra.value, center_coordinates.dec.value,
+                                   0.5, self.getarg('gsccache'))
         # Get data from result
         filter_map = self.getarg('filtermap').split('|')
         filter_name = filter_tel = self.datain.getheadval('FILTER')
@@ -178,7 +195,6 @@ class StepFluxCalSex(StepParent):
                 except:
                     self.log.error("Badly formatted filter mapping. No '=' after %s"
                                    % filter_tel)
-        query_table = astropy.io.ascii.read(gsc2_result.text)
         table_filter = 'SDSS'+filter_name+'Mag'
         table_filter_err = 'SDSS'+filter_name+'MagErr'
         GSC_RA = query_table['ra'][(query_table[table_filter]<22) & (query_table[table_filter]>0)]
@@ -188,43 +204,46 @@ class StepFluxCalSex(StepParent):
         self.log.debug('Received %d entries from Guide Star Catalog' % len(GSC_RA))
         ### Mach Guide Star Catalog data with data from Source Extractor
         # Do the matching
-        seo_radec = SkyCoord(ra=seo_catalog['ALPHA_J2000'], dec=seo_catalog['DELTA_J2000'])
-        GSC_radec = SkyCoord(ra=GSC_RA*u.deg, dec=GSC_DEC*u.deg)
-        idx, d2d, d3d = GSC_radec.match_to_catalog_sky(seo_radec[seo_SN])
+        # Nearest selected star for each catalog star (KD-tree, see skymatch.py)
+        matcher = SkyMatcher(seo_catalog['ALPHA_J2000'][seo_SN], seo_catalog['DELTA_J2000'][seo_SN])
+        idx, d2d = matcher.nearest(GSC_RA, GSC_DEC)
+        star_Mag = np.asarray(seo_Mag[seo_SN])[idx]
+        star_MagErr = np.asarray(seo_MagErr[seo_SN])[idx]
         # only select objects less than 0.025 away in distance, get distance value
         dist_value = 1*0.76*binning/3600. #Maximum distance is 1 pixel
-        mask = d2d.value<dist_value
+        mask = d2d<dist_value
         if(np.sum(mask) < 2):
             self.log.warn('Only %d sources match between image and guide star catalog, fit may not work' %
                           np.sum(mask) )
         self.log.debug('Distance_Value = %f, Min(distances) = %f, Mask length = %d' %
-                       ( dist_value, np.min(d2d.value), np.sum(mask) ) )
+                       ( dist_value, np.min(d2d), np.sum(mask) ) )
         ### Calculate the fit correction between the guide star and the extracted values
-        # Make lambda function to be minimized
         # The fit finds m_ml and b_ml where
         #     seo_Mag = b_ml + m_ml * GSC_Mag
-        nll = lambda *args: -residual(*args)
         # Get errors
-        eps_data = np.sqrt(GSC_MagErr**2+seo_MagErr[seo_SN][idx]**2)
+        eps_data = np.sqrt(GSC_MagErr**2+star_MagErr**2)
         # Make estimate for intercept to give as initial guess
-        b_ml0 = np.median(seo_Mag[seo_SN][idx][mask]-GSC_Mag[mask])
+        b_ml0 = np.median(star_Mag[mask]-GSC_Mag[mask])
         self.log.debug('Offset guess is %f mag' % b_ml0)
         # Calculate distance from that guess and get StdDev of distances
-        guessdistances = np.abs( b_ml0 - ( seo_Mag[seo_SN][idx] - GSC_Mag ) )
+        guessdistances = np.abs( b_ml0 - ( star_Mag - GSC_Mag ) )
         guessdistmed = np.median(guessdistances[mask])
         # Update mask to ignore values with large STDEVS
-        mask = np.logical_and( d2d.value < dist_value, guessdistances < 5 * guessdistmed )
+        mask = np.logical_and( d2d < dist_value, guessdistances < 5 * guessdistmed )
         self.log.debug('Median of distance to guess = %f, Mask length = %d' %
                        ( guessdistmed, np.sum(mask) ) )
-        # Solve linear equation
-        result = scipy.optimize.minimize(nll, [1, b_ml0],
-                                         args=(GSC_Mag[mask],
-                                               seo_Mag[seo_SN][idx][mask],
-                                               eps_data[mask]))
-        m_ml, b_ml = result["x"]
-        self.log.info('Fitted offset is %f mag, fitted slope is %f' % (b_ml, m_ml) )
-        b_ml_corr = b_ml + (m_ml-1) * np.median(GSC_Mag[mask])
-        self.log.info('Corrected offset is %f mag' % b_ml_corr)
+        # Solve weighted linear least squares with sigma clipping (see photfit.py)
+        slope, offset, scatter, keep = clippedfit(GSC_Mag[mask], star_Mag[mask], eps_data[mask],
+                                                  nsigma = self.getarg('fitclip'))
+        mask[mask] = keep
+        m_ml, b_ml = slope[0], offset[0]
+        self.log.info('Fitted offset is %f mag, fitted slope is %f, scatter %f mag (%d stars)' %
+                      (b_ml, m_ml, scatter[0], np.sum(mask)) )
+        b_ml_corr = zeropoint(m_ml, b_ml, np.median(GSC_Mag[mask]))
+        # Uncertainty from bootstrap resampling of the fitted stars
+        b_ml_err = bootstrap(GSC_Mag[mask], star_Mag[mask], eps_data[mask],
+                             nboot = self.getarg('bootstrap'))[0]
+        self.log.info('Corrected offset is %f +- %f mag' % (b_ml_corr, b_ml_err))
         ### Make table with all data from source extractor
         # Collect data columns
         cols = []
@@ -257,7 +276,7 @@ class StepFluxCalSex(StepParent):
         cols.append(fits.Column(name='GSC_Mag', format='D',
                                 array=GSC_Mag[mask], unit='magnitude'))
         cols.append(fits.Column(name='Img_Mag', format='D',
-                                array=seo_Mag[seo_SN][idx][mask],
+                                array=star_Mag[mask],
                                 unit='magnitude'))
         cols.append(fits.Column(name='Error', format='D', array=eps_data[mask],
                                 unit='magnitude'))
@@ -269,52 +288,35 @@ class StepFluxCalSex(StepParent):
         self.dataout = self.datain
         # Add Photometric Zero point magnitude
         self.dataout.setheadval('PHTZPRAW', -b_ml_corr, 'Photometric zeropoint for RAW data')
-        self.dataout.setheadval('PTZRAWER', 0.0, 'Uncertainty of the RAW photometric zeropoint')
+        self.dataout.setheadval('PTZRAWER', b_ml_err, 'Uncertainty of the RAW photometric zeropoint')
         self.dataout.setheadval('PHOTZP', 8.9,  'Photometric zeropoint MAG=-2.5*log(data)+PHOTZP')
         self.dataout.setheadval('BUNIT', 'Jy/pixel', 'Units for the data')
         # Scale the image using calculated b_ml_corr
-        image_background = fits.open(bkgdfilename)[0].data
         #bzero = np.nanpercentile(self.dataout.image,self.getarg('zeropercent'))
         bzero = image_background
         #-- Alternative bzero idea:
         #-mask = image_array < np.percentile(image,90)
         #-bzero = np.median(image_array[mask])
         bscale = 3631. * 10 ** (b_ml_corr/2.5)
-        self.dataout.image = bscale * (self.dataout.image - bzero)
+        self.dataout.image = asworkdtype(bscale * (self.dataout.image - bzero), self.config)
+        # Keep the background mesh of the scaled image
+        bkgmodel.scaled(bscale, bkgmodel).store(self.dataout)
         # Add sources and fitdata table
         self.dataout.tableset(sources_table.data,'Sources',sources_table.header)
         self.dataout.tableset(fitdata_table.data,'Fit Data',fitdata_table.header)
-        # Remove background file if it's not needed
-        if not self.getarg('savebackground'):
-            os.remove(bkgdfilename)
-        ### If requested make a plot of the fit and save as png
+        ### If requested save the plot data of the fit (the png is
+        ### rendered later by plotrender.py)
         if self.getarg('fitplot'):
-            # Set up plot
-            plt.figure(figsize=(10,7))
-            # Plot 5sigma error range
-            gmin = min(GSC_Mag[mask])
-            gmax = max(GSC_Mag[mask])
-            plt.fill([gmin,gmin,gmax,gmax],[gmin+b_ml0-guessdistmed, gmin+b_ml0+guessdistmed,
-                                            gmax+b_ml0+guessdistmed, gmax+b_ml0-guessdistmed],'c')
-            # Plot fits
-            plt.plot(GSC_Mag[mask],m_ml*GSC_Mag[mask]+b_ml)
-            plt.plot(GSC_Mag[mask],GSC_Mag[mask]+b_ml0)
-            # Plot the datapoints
-            plt.errorbar(GSC_Mag[d2d.value<dist_value],seo_Mag[seo_SN][idx][d2d.value<dist_value],
-                         yerr=np.sqrt(eps_data[d2d.value<dist_value]**2),fmt='o',linestyle='none')
-            plt.errorbar(GSC_Mag[mask],seo_Mag[seo_SN][idx][mask],
-                         yerr=np.sqrt(eps_data[mask]**2),fmt='o',linestyle='none')
-            #plt.plot(GSC_Mag[d2d.value<dist_value],m_ml*GSC_Mag[d2d.value<dist_value]+zeropoint_fit[1])
-            plt.legend(['LM-fit','Fit-Guess','GuessDistMed Range','d<distval Data','Good Data'])
-            plt.ylabel('Source extrator magnitude')
-            plt.xlabel('Star catalog magnitude')
-            plt.title('Calibration Fit for file\n' + os.path.split(self.dataout.filename)[1])
-            # Plot the fit
-            # Axis and labels
-            # Save the image
-            pngname = self.dataout.filenamebegin + 'FCALplot.png'
-            plt.savefig(pngname)
-            self.log.debug('Saved fit plot under %s' % pngname)
+            near = d2d < dist_value
+            plotname = self.dataout.filenamebegin + 'FCALplot.npz'
+            saveplotdata(plotname, 'fluxcal',
+                         catmag = GSC_Mag[mask], starmag = star_Mag[mask], starerr = eps_data[mask],
+                         matchcatmag = GSC_Mag[near], matchstarmag = star_Mag[near],
+                         matchstarerr = eps_data[near], slope = m_ml, offset = b_ml,
+                         guessoffset = b_ml0, guessrange = guessdistmed,
+                         title = 'Calibration Fit for file\n' +
+                                 os.path.split(self.dataout.filename)[1])
+            self.log.debug('Saved fit plot data under %s' % plotname)
         ### If requested make a text file with the sources list
         if self.getarg('sourcetable'):
 
@@ -333,15 +335,126 @@ class StepFluxCalSex(StepParent):
                         format = self.getarg('sourcetableformat'))
             self.log.debug('Saved sources table under %s' % txtname)
 
+    def center(self):
+        """ Returns the frame center (RA / DEC keywords) as SkyCoord
+        """
+        ra_center =  self.datain.getheadval('RA' ).split(':')
+        dec_center = self.datain.getheadval('DEC').split(':')
+        ra_cent =  ' '.join([str(s) for s in ra_center])
+        dec_cent = ' '.join([str(s) for s in dec_center])
+        return SkyCoord(ra_cent + ' ' + dec_cent, unit=(u.hourangle, u.deg) )
 
-def residual(params, x, data, errors):
-    """ Fitting function for lmfit
-    """
-    m, c = params
-    model = m*x+c
-    inv_sigma2 = 1.0/(errors**2)
-    #print(m,c,-0.5*(np.sum(((data-model)**2)*inv_sigma2)))
-    return -0.5*(np.sum(((data-model)**2)*inv_sigma2))
+    def cacheextra(self):
+        """ Returns the names and dates of the SourceExtractor files and of
+            the catalog files (store tiles or cached query) for the frame
+            position (used for the step cache key)
+        """
+        names = [os.path.expandvars(self.getarg(par))
+                 for par in ['sx_confilename', 'sx_paramfilename', 'sx_filterfilename']]
+        try:
+            center = self.center()
+            if len(self.getarg('catstore')):
+                from stonesteps.catalogstore import CatalogStore # local catalog tiles
+                store = CatalogStore(self.getarg('catstore'))
+                names += [store.tilename(tile) for tile in
+                          store.tiles(center.ra.value, center.dec.value, 0.5)]
+            elif len(self.getarg('gsccache')):
+                names.append(gsccachename(center.ra.value, center.dec.value, 0.5,
+                                          self.getarg('gsccache'))[0])
+        except Exception as error:
+            self.log.debug('No catalog files for the cache key: %s' % str(error))
+        return [(name, os.path.getmtime(name) if os.path.exists(name) else None)
+                for name in names]
+
+    def cacheable(self):
+        """ Results are not cached if side files (sources table, plot data,
+            background image) are written, a cache hit would not make them
+        """
+        return not ( self.getarg('sourcetable') or self.getarg('fitplot') or
+                     self.getarg('savebackground') )
+
+    def skipmessage(self, data):
+        """ Returns the reason why a frame is not calibrated or '': frames
+            left without WCS by the astrometry (ASTRSTAT is set) and frames
+            with triage quality flags in skipquality
+        """
+        if 'ASTRSTAT' in data.header:
+            return 'no astrometry (ASTRSTAT = %s)' % data.getheadval('ASTRSTAT')
+        skipflag = qualityskip(data, self.getarg('skipquality'))
+        if skipflag:
+            return 'quality flag %d (%s)' % (skipflag, qualitytext(skipflag))
+        return ''
+
+    def runsextractor(self):
+        """ Runs source extractor on the input data. Returns the catalog
+            and the background model (from the MINIBACKGROUND and
+            MINIBACK_RMS check images, which are deleted).
+        """
+        ### Run Source Extractor
+        # Make sure input data exists as file
+        if not os.path.exists(self.datain.filename) :
+            self.datain.save()
+        # Make catalog filename
+        catfilename = self.datain.filenamebegin
+        if catfilename[-1] in '._-': catfilename += 'sex_cat.fits'
+        else: catfilename += '.sex_cat.fits'
+        self.log.debug('Sextractor catalog filename = %s' % catfilename)
+        # Make command string
+        command = self.getarg('sx_cmd') % (self.datain.filename)
+        command += ' ' + self.getarg('sx_options')
+        command += ' -c ' + os.path.expandvars(self.getarg('sx_confilename'))
+        command += ' -CATALOG_NAME ' + catfilename
+        command += ' -PARAMETERS_NAME ' + os.path.expandvars(self.getarg('sx_paramfilename'))
+        command += ' -FILTER_NAME ' + os.path.expandvars(self.getarg('sx_filterfilename'))
+        # Still make background mesh so you can subtract it below
+        bkgdnames = [catfilename.replace('sex_cat.fits', name)
+                     for name in ['SxBkgMesh.fits', 'SxRmsMesh.fits']]
+        command += ' -CHECKIMAGE_TYPE MINIBACKGROUND,MINIBACK_RMS'
+        command += ' -CHECKIMAGE_NAME ' + ','.join(bkgdnames)
+        # Call process
+        self.log.debug('running command = %s' % command)
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output, error = process.communicate()
+        if self.getarg('verbose'):
+            self.log.debug(output)
+        #subprocess.check_call(command)
+        ### Extract catalog from source extractor and clean up dataset
+        # Use catalog from sourse extrator (test.cat)
+        seo_catalog = astropy.table.Table.read(catfilename, format="fits", hdu='LDAC_OBJECTS')
+        # Delete source extractor catalog is needed
+        if self.getarg('delete_cat'):
+            os.remove(catfilename)
+        # Make background model from the mesh check images
+        from stonesteps.sepextract import readsexconfig # configuration file reader
+        config = readsexconfig(os.path.expandvars(self.getarg('sx_confilename')))
+        backsize = [int(float(v)) for v in config['BACK_SIZE'].replace(',', ' ').split()]
+        grids = []
+        for name in bkgdnames:
+            grids.append(fits.getdata(name))
+            os.remove(name)
+        bkgmodel = BkgModel(grids[0], grids[1], [backsize[0], backsize[-1]],
+                            self.datain.image.shape)
+        return seo_catalog, bkgmodel
+
+    def runsep(self):
+        """ Extracts the sources of the input data in memory with sep,
+            with the settings of the source extractor configuration and
+            filter files. Returns the catalog and the background model.
+            The background model of the input data is used if it has the
+            mesh size of the configuration.
+        """
+        from stonesteps.sepextract import readsexconfig, readsexfilter, sexcatalog # sep extraction
+        config = readsexconfig(os.path.expandvars(self.getarg('sx_confilename')))
+        kernel = readsexfilter(os.path.expandvars(self.getarg('sx_filterfilename')))
+        backsize = [int(float(v)) for v in config['BACK_SIZE'].replace(',', ' ').split()]
+        bkgmodel = BkgModel.load(self.datain, [backsize[0], backsize[-1]])
+        if bkgmodel is not None:
+            self.log.debug('Using background mesh of the input data')
+        catalog, bkgmodel = sexcatalog(self.datain.image, self.datain.header, config, kernel,
+                                       bkgmodel)
+        self.log.debug('Extracted %d sources with sep' % len(catalog))
+        return catalog, bkgmodel
 
 
 if __name__ == '__main__':
@@ -356,5 +469,17 @@ if __name__ == '__main__':
     StepFluxCalSex().execute()
 
 '''HISTORY:
+2026-10-18 - Frames left without WCS by the astrometry (ASTRSTAT) are not calibrated
+2026-10-18 - Frames with triage quality flags in skipquality are not calibrated
+2026-10-18 - Fit plot is saved as plot data, rendered later (plotrender.py)
+2026-10-18 - Closed form zeropoint fit with sigma clipping, bootstrap uncertainty in PTZRAWER
+2026-10-18 - Catalog matching with SkyMatcher (skymatch.py) instead of SkyCoord
+2026-10-18 - Background kept as mesh model (bkgmodel.py) instead of a full size background file
+2026-10-18 - Added sep extraction backend (extractor = sep)
+2026-10-18 - Catalog stars can be read from the local catalog store (catstore)
+2026-10-18 - Guide star catalog query moved to gsccatalog.py, with optional cache (gsccache)
+2026-10-18 - Scaled image is stored in the working data type (workdtype in [data])
+2026-10-18 - Added checkpoint and resume (StepCheckpoint)
+2026-10-18 - Added step result cache (StepCache)
 2018-09-019 - Started based on Amanda's code. - Marc Berthoud
 '''
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+""" PIPE STEP FORCED PHOTOMETRY - Version 1.0.0
+
+    This multi-input pipe step measures light curves of a list of targets
+    (variable stars, exoplanet hosts) on a sequence of frames. The
+    targets are given in RA / Dec (targetfile and / or targets parameter)
+    and projected through the WCS of each frame. The fluxes are measured
+    with circular apertures and sky annuli of fixed size in arcsec, for
+    all targets on all frames at once (see forcedphot.py).
+
+    The output is one table 'Forced Photometry' with one row for each
+    target on each frame (targets outside a frame are left out), sorted
+    by target and time:
+      NAME, RA, DEC, FILENAME, FILTER, DATEOBS, MJD (mid exposure),
+      EXPTIME, X, Y (0 based pixels), FLUX, FLUXERR, SKY, SKYRMS (per
+      pixel, data units), MAG, MAGERR, MAGZP, ZPERR and FLAG (see
+      forcedphot.py)
+    Flux calibrated frames (BUNIT = Jy/pixel, from StepFluxCalSex or
+    StepFluxCalJoint) get MAG = PHOTZP - 2.5 log(FLUX), frames with only a
+    raw zeropoint (PHTZPRAW) MAG = PHTZPRAW - 2.5 log(FLUX), other frames
+    instrumental magnitudes (MAGZP = 0). The table is also written as text
+    file (tableformat) next to the output file.
+
+    Frames should be of one sequence (same object), use StepDataGroup to
+    run the step on each sequence of a night.
+"""
+
+import os # os library
+import logging # logging object library
+import numpy # numpy library
+from astropy.io import fits # to make the table
+from astropy.io import ascii # to read the target file and write the table
+from astropy.time import Time # to convert DATE-OBS
+from astropy.coordinates import Angle
+import astropy.units as u
+from darepype.drp import StepMIParent # pipe step parent object
+from darepype.drp import DataFits # pipeline data object
+from stonesteps.forcedphot import pixelpositions, measure, FLAGOUTSIDE # forced photometry
+
+class StepForcedPhot(StepMIParent):
+    """ Pipeline Step Object to measure forced aperture photometry of
+        targets on a sequence of frames
+    """
+    stepver = '0.1' # pipe step version
+
+    def __init__(self):
+        """ Constructor: Initialize data objects and variables
+        """
+        # call superclass constructor (calls setup)
+        super(StepForcedPhot,self).__init__()
+        # set configuration
+        self.log.debug('Init: done')
+
+    def setup(self):
+        """ ### Names and Parameters need to be Set Here ###
+            Sets the internal names for the function and for saved files.
+            Defines the input parameters for the current pipe step.
+            Setup() is called at the end of __init__
+            The parameters are stored in a list containing the following
+            information:
+            - name: The name for the parameter. This name is used when
+                    calling the pipe step from command line or python shell.
+                    It is also used to identify the parameter in the pipeline
+                    configuration file.
+            - default: A default value for the parameter. If nothing, set
+                       '' for strings, 0 for integers and 0.0 for floats
+            - help: A short description of the parameter.
+        """
+        ### Set Names
+        # Name of the pipeline reduction step
+        self.name='forcedphot'
+        # Shortcut for pipeline reduction step and identifier for
+        # saved file names.
+        self.procname = 'FPHOT'
+        # Set Logger for this pipe step
+        self.log = logging.getLogger('pipe.step.%s' % self.name)
+        ### Set Parameter list
+        # Clear Parameter list
+        self.paramlist = []
+        # Append parameters
+        self.paramlist.append(['targetfile', '',
+                               'Text table of targets with columns name, ra, dec ' +
+                               '(degrees or sexagesimal hours / degrees)'])
+        self.paramlist.append(['targets', '',
+                               'Additional targets as name=ra dec|name=ra dec'])
+        self.paramlist.append(['aperture', [4.0, 8.0, 12.0],
+                               'Aperture radius, inner and outer sky annulus radius (arcsec)'])
+        self.paramlist.append(['gain', 0.0,
+                               'Detector gain of the raw data (electrons / ADU, ' +
+                               '0 for no source noise in the errors)'])
+        self.paramlist.append(['subpix', 5,
+                               'Subsampling of the pixels on the aperture edge'])
+        self.paramlist.append(['savetable', True,
+                               'Flag to write the table as text file'])
+        self.paramlist.append(['tableformat', 'csv',
+                               'Text table format (see astropy.io.ascii for options)'])
+        # confirm end of setup
+        self.log.debug('Setup: done')
+
+    def run(self):
+        """ Runs the data reduction algorithm. The self.datain is run
+            through the code, the result is in self.dataout.
+        """
+        names, ra, dec = self.targets()
+        self.log.info('Measuring %d targets on %d frames' % (len(names), len(self.datain)))
+        # Frames in time order, target positions and radii of each frame
+        frames = []
+        for data in self.datain:
+            try:
+                x, y, scale = pixelpositions(data.header, ra, dec)
+                frames.append((self.mjd(data), data, x, y, scale))
+            except Exception as error:
+                self.log.warning('No target positions for %s: %s' %
+                                 (os.path.split(data.filename)[1], str(error)))
+        if not len(frames):
+            raise RuntimeError('No frame with valid WCS')
+        frames.sort(key = lambda frame: frame[0])
+        mjd = numpy.array([frame[0] for frame in frames])
+        scale = numpy.array([frame[4] for frame in frames])
+        aperture = numpy.asarray(self.getarg('aperture'), dtype = numpy.float64)
+        zeropoint, zperror, gain = numpy.array([self.calibration(frame[1])
+                                                for frame in frames]).T
+        flux, fluxerr, sky, skyrms, flags = measure(
+            [frame[1].image for frame in frames],
+            [frame[2] for frame in frames], [frame[3] for frame in frames],
+            aperture[0] / scale, numpy.column_stack((aperture[1] / scale, aperture[2] / scale)),
+            gain, self.getarg('subpix'))
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            mag = zeropoint[:, None] - 2.5 * numpy.log10(flux)
+            magerr = 2.5 / numpy.log(10) * fluxerr / flux
+        # Rows of targets inside the frames, by target and time
+        frame, target = numpy.nonzero((flags & FLAGOUTSIDE) == 0)
+        order = numpy.lexsort((frame, target))
+        frame, target = frame[order], target[order]
+        column = lambda values: numpy.asarray(values)[frame, target]
+        perframe = lambda values: numpy.asarray(values)[frame]
+        header = lambda key: [f[1].getheadval(key) if key in f[1].header else ''
+                              for f in frames]
+        cols = [fits.Column(name='NAME', format='%dA' % max(1, max(len(n) for n in names)),
+                            array=numpy.asarray(names)[target]),
+                fits.Column(name='RA', format='D', unit='deg', array=ra[target]),
+                fits.Column(name='DEC', format='D', unit='deg', array=dec[target]),
+                fits.Column(name='FILENAME', format='64A',
+                            array=perframe([os.path.split(f[1].filename)[1] for f in frames])),
+                fits.Column(name='FILTER', format='16A', array=perframe(header('FILTER'))),
+                fits.Column(name='DATEOBS', format='23A', array=perframe(header('DATE-OBS'))),
+                fits.Column(name='MJD', format='D', unit='d', array=perframe(mjd)),
+                fits.Column(name='EXPTIME', format='E', unit='s',
+                            array=perframe([float(v or 0) for v in header('EXPTIME')])),
+                fits.Column(name='X', format='E', unit='pixel', array=column([f[2] for f in frames])),
+                fits.Column(name='Y', format='E', unit='pixel', array=column([f[3] for f in frames])),
+                fits.Column(name='FLUX', format='D', array=column(flux)),
+                fits.Column(name='FLUXERR', format='D', array=column(fluxerr)),
+                fits.Column(name='SKY', format='E', array=column(sky)),
+                fits.Column(name='SKYRMS', format='E', array=column(skyrms)),
+                fits.Column(name='MAG', format='E', unit='magnitude', array=column(mag)),
+                fits.Column(name='MAGERR', format='E', unit='magnitude', array=column(magerr)),
+                fits.Column(name='MAGZP', format='E', unit='magnitude', array=perframe(zeropoint)),
+                fits.Column(name='ZPERR', format='E', unit='magnitude', array=perframe(zperror)),
+                fits.Column(name='FLAG', format='I', array=column(flags))]
+        table = fits.BinTableHDU.from_columns(fits.ColDefs(cols))
+        # Output: header of the first frame and the table
+        first = frames[0][1]
+        self.dataout = DataFits(config = self.config)
+        self.dataout.header = first.header.copy()
+        self.dataout.filename = first.filename
+        self.dataout.tableset(table.data, 'Forced Photometry', table.header)
+        self.dataout.setheadval('FPHOTNTG', len(names), 'Forced photometry: number of targets')
+        self.dataout.setheadval('FPHOTNFR', len(frames), 'Forced photometry: number of frames')
+        self.dataout.setheadval('FPHOTAPR', aperture[0], 'Forced photometry aperture radius (arcsec)')
+        self.dataout.setheadval('HISTORY', 'ForcedPhot: %d targets on %d frames' %
+                                (len(names), len(frames)))
+        self.log.info('Measured %d target positions (%d flagged)' %
+                      (len(frame), numpy.sum(column(flags) > 0)))
+        if self.getarg('savetable'):
+            extension = 'csv' if self.getarg('tableformat') == 'csv' else 'txt'
+            txtname = self.dataout.filenamebegin + 'FPHOT.' + extension
+            ascii.write(self.dataout.tableget('Forced Photometry'), txtname,
+                        format = self.getarg('tableformat'), overwrite = True)
+            self.log.debug('Saved photometry table under %s' % txtname)
+        self.log.debug('Run: Done')
+
+    def targets(self):
+        """ Returns names, RA and Dec (degrees) of the targets from the
+            target file and the targets parameter
+        """
+        names, ra, dec = [], [], []
+        filename = os.path.expandvars(self.getarg('targetfile'))
+        if len(filename):
+            table = ascii.read(filename)
+            columns = dict((name.lower(), name) for name in table.colnames)
+            for row in table:
+                names.append(str(row[columns['name']]).strip())
+                ra.append(str(row[columns['ra']]))
+                dec.append(str(row[columns['dec']]))
+        for entry in self.getarg('targets').split('|'):
+            if '=' in entry:
+                name, position = entry.split('=')
+                names.append(name.strip())
+                ra.append(position.split()[0])
+                dec.append(position.split()[1])
+        if not len(names):
+            raise ValueError('No targets given (targetfile or targets)')
+        # Sexagesimal RA is in hours, decimal RA in degrees
+        ra = numpy.array([Angle(v, unit = u.hour if ':' in v or 'h' in v else u.deg).degree
+                          for v in ra])
+        dec = numpy.array([Angle(v, unit = u.deg).degree for v in dec])
+        return names, ra, dec
+
+    def mjd(self, data):
+        """ Returns the MJD of the middle of the exposure of a frame
+        """
+        mjd = Time(data.getheadval('DATE-OBS'), format = 'isot', scale = 'utc').mjd
+        if 'EXPTIME' in data.header:
+            mjd += float(data.getheadval('EXPTIME')) / 2.0 / 86400.
+        return mjd
+
+    def calibration(self, data):
+        """ Returns the zeropoint, its error and the gain (counts per data
+            unit) of a frame
+        """
+        gain = self.getarg('gain')
+        zperror = data.getheadval('PTZRAWER') if 'PTZRAWER' in data.header else 0.0
+        if 'PHTZPRAW' not in data.header:
+            return 0.0, 0.0, gain
+        zpraw = float(data.getheadval('PHTZPRAW'))
+        if 'Jy' in str(data.getheadval('BUNIT') if 'BUNIT' in data.header else '') and \
+           'PHOTZP' in data.header:
+            # Scaled data: data = 3631 * 10^(-PHTZPRAW / 2.5) * counts
+            return (float(data.getheadval('PHOTZP')), zperror,
+                    gain / (3631. * 10 ** (-zpraw / 2.5)))
+        return zpraw, zperror, gain
+
+if __name__ == '__main__':
+    """ Main function to run the pipe step from command line on a file.
+        Command:
+          python stepparent.py input.fits -arg1 -arg2 . . .
+        Standard arguments:
+          --config=ConfigFilePathName.txt : name of the configuration file
+          -t, --test : runs the functionality test i.e. pipestep.test()
+          --loglevel=LEVEL : configures the logging output for a particular level
+          -h, --help : Returns a list of
+    """
+    StepForcedPhot().execute()
+
+""" === History ===
+2026-10-18 First version
+"""
@@ -18,8 +18,12 @@ import scipy.ndimage #scipy sublibrary
 import logging # logging object library
 from scipy.ndimage import median_filter #Used to filter hot pixels
 from darepype.drp import StepParent # pipe step parent object
+from stonesteps.stepcache import StepCache # pipestep result cache
+from stonesteps.stepcheckpoint import StepCheckpoint # pipestep checkpoints
+from stonesteps.workdtype import asworkdtype # working data type
+from stonesteps.bkgmodel import BkgModel # background mesh model
 
-class StepHotpix(StepParent):
+class StepHotpix(StepCheckpoint, StepCache, StepParent):
     """ HAWC Pipeline Step Parent Object
         The object is callable. It requires a valid configuration input
         (file or object) when it runs.
@@ -66,21 +70,38 @@ class StepHotpix(StepParent):
         self.paramlist.append(['hotpixfile', 'search',
             'Filename for clean file or "search" for searching ' +
             'file in cleanfolder (default = search)'])
+        self.paramlist.append(['bkgsigma', 0.0,
+            'Hot pixel threshold in units of the local background rms ' +
+            '(0 for 10 times the standard deviation of the filter difference)'])
+        self.paramlist.append(['bkgmesh', [64, 3],
+            'Background mesh size and mesh filter size (pixels / meshes) ' +
+            'for bkgsigma > 0, the mesh is stored in the output data'])
+        # Get parameters for StepCache
+        self.cachesetup()
 
     def run(self):
         """ Runs the hot pix removal algorithm. The self.datain is run
             through the code, the result is in self.dataout.
             Tolerance is the number of standard deviations used to cutoff
-            the hot pixels.
+            the hot pixels. With bkgsigma > 0 the local rms of the
+            background mesh model is used instead of the global standard
+            deviation.
         """
         # Copy input to output data
         self.dataout = self.datain.copy()
-        img = self.datain.image
+        img = asworkdtype(self.datain.image, self.config)
         ''' Cleaning Algorithm '''
         #Apply a filter that creates a threshold for hotpixels
         blurred = median_filter(img, size=2)
         difference = img - blurred
-        threshold = 10*numpy.std(difference)
+        if self.getarg('bkgsigma') > 0:
+            meshsize, filtersize = [int(v) for v in self.getarg('bkgmesh')]
+            bkgmodel = BkgModel.fromimage(img, meshsize, filtersize)
+            threshold = self.getarg('bkgsigma') * bkgmodel.rmsimage()[1:-1,1:-1]
+            # Keep the background mesh for the next steps
+            bkgmodel.store(self.dataout)
+        else:
+            threshold = 10*numpy.std(difference, dtype=numpy.float64)
         #Find the hotpixels
         hot_pixels = numpy.nonzero((numpy.abs(difference[1:-1,1:-1])>threshold))
         hot_pixels = numpy.array(hot_pixels) +1 #ignored the edges
@@ -124,4 +145,8 @@ if __name__ == '__main__':
 
 """ === History ===
     2014-06-30 New file created by Neil Stilin from template file by Nicolas Chapman
+    2026-10-18 Added step result cache (StepCache)
+    2026-10-18 Added checkpoint and resume (StepCheckpoint)
+    2026-10-18 Image is processed in the working data type (workdtype in [data])
+    2026-10-18 Optional threshold from the background mesh rms (bkgsigma), mesh is stored
 """
@@ -14,6 +14,8 @@ import string # for string.join
 import time # time library
 import logging
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor # to load files in parallel
+from stonesteps import fitsheadscan # fast FITS header reader
 from darepype.drp import DataParent # Pipeline Data object
 from darepype.drp import StepNIParent # To check if we have datain or [datain, datain, ...]
 
@@ -61,6 +63,10 @@ class StepLoadInput(StepNIParent):
             "List of strings which filename must contain to be loaded (unused if '', | separated)"])
         self.paramlist.append(['fileexclude','MBIAS',
             "List of strings which filename must not contain to be loaded (unused if '' | separated)"])
+        self.paramlist.append(['threads', 8,
+            'Number of threads used to read headers and files'])
+        self.paramlist.append(['headcachefile', '',
+            "File to store read headers between runs (unused if '')"])
 
     def run(self, inpar = '', data = None, multi = False):
         # Loads all files base on glob, parameter 'filelocation'
@@ -69,75 +75,33 @@ class StepLoadInput(StepNIParent):
         inglob = os.path.expandvars(inglob)
         indata = glob.glob(inglob)
         self.log.debug('Files found: %s' % indata)
-        infilenameinclude = self.getarg('fileinclude').split('|')
-        ininclude=[]
-        innamelist = []
-        # From all loaded inputs, includes files in final list which have certain strings in the filename
-        if infilenameinclude[0] !='':
-            for i in indata:
-                split = i.split('/')[len(i.split('/'))-1]
-                innamelist.append(split)
-            count = 0
-            for i in indata:
-                for f in infilenameinclude:
-                    if f in innamelist[count]:
-                        if f not in ininclude:
-                            ininclude.append(i)
-                count +=1
-        else:
-            ininclude=indata
-        infilenameexclude = self.getarg('fileexclude').split('|')
-        inexclude=[]
-        exnamelist = []
-        # From all loaded inputs, excludes files from final list which have certain strings in the filename
-        for i in indata:
-            split = i.split('/')[len(i.split('/'))-1]
-            exnamelist.append(split)
-        count = 0
-        for i in indata:
-            for f in infilenameexclude:
-                if f in exnamelist[count]:
-                    if f not in inexclude:
-                        inexclude.append(i)
-            count +=1
-        self.log.debug('File(s) excluded by filename: %s' % inexclude)
-        indatafinal = list(set(ininclude)-set(inexclude))
-        headlist = []
-        for innam in indatafinal:
-            headlist.append(DataParent(config = self.config).loadhead(innam))
-        includelist = self.getarg('includeheadvals').split('|')
-        keysinclude = []
-        inheadinclude = []
-        # From all loaded inputs, includes files in final list which have certain keywords in the fits header
-        if includelist[0] != '':
-            for f in headlist:
-                for i in includelist:
-                    keysinclude = i.split('=')
-                    if str(f.getheadval(keysinclude[0]))==str(keysinclude[1]):
-                        if f not in inheadinclude:
-                            inheadinclude.append(f)
-        else:
-            inheadinclude=headlist
-        inheadexclude = []
-        # From all loaded inputs, includes files in final list which have certain keywords in the fits header
-        excludelist = self.getarg('excludeheadvals').split('|')
-        if excludelist[0] != '':
-            for f in headlist:
-                for i in excludelist:
-                    keysexclude = i.split('=')
-                    if str(f.getheadval(keysexclude[0]))==str(keysexclude[1]):
-                        if f not in inheadexclude:
-                            inheadexclude.append(f)
-        headlistfinal = list(set(inheadinclude)-(set(inheadexclude)))
-        finalfiles = []
-        for files in headlistfinal:
-            finalfiles.append(files.filename)
+        # From all loaded inputs, includes files in final list which have certain strings
+        # in the filename and excludes files which have other strings in the filename
+        filematch = fitsheadscan.filepredicate(self.getarg('fileinclude'),
+                                               self.getarg('fileexclude'))
+        indatafinal = [f for f in indata if filematch(f)]
+        self.log.debug('File(s) excluded by filename: %s' %
+                       sorted(set(indata) - set(indatafinal)))
+        # Read the headers in parallel (only header blocks are read), use cached
+        # headers for files that have not changed
+        cachefile = os.path.expandvars(self.getarg('headcachefile'))
+        if len(cachefile):
+            fitsheadscan.loadcache(cachefile)
+        headers = fitsheadscan.scanheaders(indatafinal, threads = self.getarg('threads'))
+        if len(cachefile):
+            fitsheadscan.savecache(cachefile)
+        # From all loaded inputs, includes files in final list which have certain keywords
+        # in the fits header and excludes files which have other keywords
+        headmatch = fitsheadscan.headpredicate(self.getarg('includeheadvals'),
+                                               self.getarg('excludeheadvals'),
+                                               self.config)
+        finalfiles = [f for f, h in headers.items() if headmatch(h)]
         # Sorts final output files
         finalsorted=sorted(finalfiles)
-        self.dataout=[]
-        # Appends final list of loaded files to dataout
-        for f in finalsorted:
-            self.dataout.append(DataParent(config = self.config).load(f))
+        # Loads the final list of files and appends them to dataout
+        with ThreadPoolExecutor(max_workers = max(1, self.getarg('threads'))) as pool:
+            self.dataout = list(pool.map(lambda f: DataParent(config = self.config).load(f),
+                                         finalsorted))
 
     def runend(self,data):
         """ Method to call at the end of pipe the pipe step call
@@ -166,4 +130,6 @@ if __name__ == '__main__':
 """ === History ===
     2018-07-20 New step created based on other StepParent child objects - Matt Merz
     2018-08-02 Updates to documentation, step functionality - Matt Merz
+    2026-10-18 Headers are read in parallel with fitsheadscan (header blocks only,
+               cached by file date), include/exclude rules compiled once
 """
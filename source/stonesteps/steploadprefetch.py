@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+""" PIPE STEP LOAD PREFETCH - Version 1.0.0
+
+    This pipe step replaces the 'load' entry of the pipeline stepslist.
+    Instead of reading each file when its turn comes, the files are read
+    and decoded by a background thread (see dataprefetch.py) while the
+    pipeline reduces the previous file. The step returns the prefetched
+    data object, or loads the file itself if it was not prefetched.
+
+    The list of files to prefetch has to be given before the pipeline
+    is run, for example:
+        StepLoadPrefetch.setfilelist(imagelist)
+        result = pipe(imagelist)
+    The list can contain the files for several pipeline runs (for example
+    all objects of a night), the prefetching continues across runs.
+"""
+
+import os # os library
+import logging # logging object library
+from darepype.drp import DataParent # Pipeline Data object
+from darepype.drp import StepParent # pipe step parent object
+from stonesteps.dataprefetch import DataPrefetcher # background loader
+
+class StepLoadPrefetch(StepParent):
+    """ Stone Edge Pipeline Step Load Prefetch Object
+        The object is callable. It requires a valid configuration input
+        (file or object) when it runs.
+    """
+    stepver = '0.1' # pipe step version
+
+    # Shared between step objects, as the pipeline makes new step objects
+    # for every object folder
+    filelist = [] # ordered list of files to prefetch
+    prefetcher = None # DataPrefetcher object (made at the first call)
+
+    def setup(self):
+        """ ### Names and Parameters need to be Set Here ###
+            Sets the internal names for the function and for saved files.
+            Defines the input parameters for the current pipe step.
+            Setup() is called at the end of __init__
+            The parameters are stored in a list containing the following
+            information:
+            - name: The name for the parameter. This name is used when
+                    calling the pipe step from command line or python shell.
+                    It is also used to identify the parameter in the pipeline
+                    configuration file.
+            - default: A default value for the parameter. If nothing, set
+                       '' for strings, 0 for integers and 0.0 for floats
+            - help: A short description of the parameter.
+        """
+        ### Set Names
+        # Name of the pipeline reduction step
+        self.name='loadprefetch'
+        # Shortcut for pipeline reduction step and identifier for
+        # saved file names.
+        self.procname = 'load'
+        # Set Logger for this pipe step
+        self.log = logging.getLogger('pipe.step.%s' % self.name)
+        ### Set Parameter list
+        # Clear Parameter list
+        self.paramlist = []
+        # Append parameters
+        self.paramlist.append(['depth', 1,
+                               'Number of files to load ahead of the pipeline'])
+        self.paramlist.append(['masters', True,
+                               'Flag to also preload the bias/dark/flat masters'])
+        # confirm end of setup
+        self.log.debug('Setup: done')
+
+    @classmethod
+    def setfilelist(cls, filelist):
+        """ Sets the ordered list of files to prefetch. A running
+            prefetcher is stopped, a new one starts at the next call.
+        """
+        if cls.prefetcher is not None:
+            cls.prefetcher.stop()
+            cls.prefetcher = None
+        cls.filelist = list(filelist)
+
+    def run(self):
+        """ Runs the data reduction algorithm. The self.datain is run
+            through the code, the result is in self.dataout.
+        """
+        filename = self.datain.filename
+        # Start the prefetcher if needed
+        cls = self.__class__
+        if cls.prefetcher is None and len(cls.filelist):
+            cls.prefetcher = DataPrefetcher(self.config, cls.filelist,
+                                            depth = self.getarg('depth'),
+                                            masters = self.getarg('masters'))
+            cls.prefetcher.start()
+        # Get the prefetched data
+        data = None
+        if cls.prefetcher is not None:
+            data = cls.prefetcher.get(filename)
+        # Load the file if it was not prefetched
+        if data is None:
+            self.log.debug('File %s not prefetched - loading' % os.path.split(filename)[1])
+            data = DataParent(config = self.config).load(filename)
+        self.dataout = data
+
+    def runend(self, data):
+        """ Method to call at the end of the pipe step call
+            - Sends final log messages
+            The header and filename are not updated (same as the
+            pipeline 'load' step).
+        """
+        self.arglist = {}
+        fname = os.path.split(data.filename)[1]
+        self.log.info('Finished: Pipe Step %s on file %s' % (self.name, fname))
+
+if __name__ == '__main__':
+    """ Main function to run the pipe step from command line on a file.
+        Command:
+          python stepparent.py input.fits -arg1 -arg2 . . .
+        Standard arguments:
+          --config=ConfigFilePathName.txt : name of the configuration file
+          -t, --test : runs the functionality test i.e. pipestep.test()
+          --loglevel=LEVEL : configures the logging output for a particular level
+          -h, --help : Returns a list of
+    """
+    StepLoadPrefetch().execute()
+
+""" === History ===
+2026-10-18 New step to load input files with a background prefetch thread
+"""
@@ -16,6 +16,8 @@ from PIL import ImageFont # Libraries for adding a label to the color image
 from PIL import ImageDraw
 from darepype.drp import DataFits # pipeline data object
 from darepype.drp import StepMIParent # pipe step parent object
+from stonesteps.workdtype import workdtype # working data type
+from stonesteps.bkgmodel import BkgModel # background mesh model
 
 class StepRGB(StepMIParent):
     """ Stone Edge Pipeline Step RGB Object
@@ -65,6 +67,12 @@ class StepRGB(StepMIParent):
 		'Specifies the percentile for the minimum scaling'])
         self.paramlist.append(['maxpercent', 0.999,
 		'Specifies the percentile for the maximum scaling'])
+        self.paramlist.append(['minbackground', False,
+		'Flag to use the background level of the background mesh (see bkgmodel.py) ' +
+		'for the minimum scaling instead of minpercent (if all images have the mesh)'])
+        self.paramlist.append(['minbacksigma', 1.0,
+		'Minimum scaling at background level - minbacksigma * background rms ' +
+		'(with minbackground)'])
 
     def run(self):
         """ Runs the combining algorithm. The self.datain is run
@@ -143,8 +151,8 @@ class StepRGB(StepMIParent):
         img2 = datause[2].image
         
         ''' Finding Min/Max scaling values '''
-        # Create a Data Cube with floats
-        datacube = numpy.zeros((img.shape[0], img.shape[1], 3), dtype=float)
+        # Create a Data Cube with floats (in the working data type)
+        datacube = numpy.zeros((img.shape[0], img.shape[1], 3), dtype=workdtype(self.config))
         # Enter the image data into the cube so an absolute max can be found
         datacube[:,:,0] = img
         datacube[:,:,1] = img1
@@ -154,26 +162,37 @@ class StepRGB(StepMIParent):
         # Create a 1-dimensional array with all the data, then sort it	
         datacube.shape=(datalength,)
         datacube.sort()
-        # Now use arrays for each filter to find separate min values
-        rarray = img.copy()
-        garray = img1.copy()
-        barray = img2.copy()
-        # Shape and sort the arrays
-        arrlength = img.shape[0] * img.shape[1]
-        rarray.shape=(arrlength,)
-        rarray.sort()
-        garray.shape=(arrlength,)
-        garray.sort()
-        barray.shape=(arrlength,)
-        barray.sort()
-        # Find the min/max percentile values in the data for scaling
-        # Values are determined by parameters in the pipe configuration file
-        minpercent = int(arrlength * self.getarg('minpercent'))
+        # Use the background level for the min values if requested
+        bkgmodels = [BkgModel.load(data) for data in datause]
+        if self.getarg('minbackground') and None not in bkgmodels:
+            # The mesh of a FluxCalSex output is the model of the background
+            # subtracted image: level 0, the cut is set by the rms
+            levels = [model.level() for model in bkgmodels]
+            rminsv, gminsv, bminsv = [level - self.getarg('minbacksigma') * rms
+                                      for level, rms in levels]
+            self.log.debug('Using background levels and rms for minimum scaling')
+        else:
+            # Now use arrays for each filter to find separate min values
+            rarray = img.copy()
+            garray = img1.copy()
+            barray = img2.copy()
+            # Shape and sort the arrays
+            arrlength = img.shape[0] * img.shape[1]
+            rarray.shape=(arrlength,)
+            rarray.sort()
+            garray.shape=(arrlength,)
+            garray.sort()
+            barray.shape=(arrlength,)
+            barray.sort()
+            # Find the min percentile values in the data for scaling
+            # Values are determined by parameters in the pipe configuration file
+            minpercent = int(arrlength * self.getarg('minpercent'))
+            # Find the final data values to use for scaling from the image data
+            rminsv = rarray[minpercent]  #sv stands for "scalevalue"
+            gminsv = garray[minpercent]
+            bminsv = barray[minpercent]
+        # Find the max percentile value in the data for scaling
         maxpercent = int(datalength * self.getarg('maxpercent'))
-        # Find the final data values to use for scaling from the image data
-        rminsv = rarray[minpercent]  #sv stands for "scalevalue"
-        gminsv = garray[minpercent]
-        bminsv = barray[minpercent]
         maxsv = datacube[maxpercent]
         self.log.info(' Scale min r/g/b: %f/%f/%f' % (rminsv,gminsv,bminsv))
         self.log.info(' Scale max: %f' % maxsv)
@@ -316,4 +335,7 @@ if __name__ == '__main__':
     2014-07-29 Code has been improved by adding better scaling and image labels
     2014-08-06 Added 'if' functions to the label printing so that if keywords do not exist in the header(s), they are skipped rather than raising an error --NS
     2014-08-11 This file was essentially just renamed. The file called steprgb.py now uses raw inputs to determine the scaling values.  --NS
+    2026-10-18 Data cube is made in the working data type (workdtype in [data])
+    2026-10-18 Optional minimum scaling from the background mesh level (minbackground)
+    2026-10-18 Background minimum scaling is level - minbacksigma * rms
 """
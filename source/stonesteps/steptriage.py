@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+""" PIPE STEP TRIAGE - Version 1.0.0
+
+    This pipe step runs right after the calibration and tags each frame
+    with a quality flag, so the expensive steps later in the pipeline
+    (astrometry, flux calibration) can skip hopeless frames (clouds,
+    twilight, trailed or defocused frames). The quality measures come
+    from framequality() (see framestats.py) on a binned copy of the
+    image and take a few ten milliseconds per frame:
+      star count, background level, saturated pixel fraction, FWHM and
+      elongation of the brightest stars.
+    The measures are stored in the header (QUALNSTR, QUALBKG, QUALNOIS,
+    QUALSAT, QUALFWHM, QUALELON) with the flag QUALFLAG, the sum of the
+    bit values in QUALITY for the limits the frame fails (0 for a good
+    frame). Limits which are 0 are not checked.
+
+    Steps with a skipquality parameter skip frames with any of the
+    skipquality bits set in QUALFLAG (see qualityskip()). The image data
+    is not changed.
+"""
+
+import logging # logging object library
+from darepype.drp import StepParent # pipe step parent object
+from stonesteps.framestats import framequality # frame quality measures
+
+# Quality flag bit values and descriptions
+QUALITY = {1: 'few stars', 2: 'high background', 4: 'saturated',
+           8: 'large FWHM', 16: 'trailed'}
+
+def qualityskip(data, skipquality):
+    """ Returns the QUALFLAG bits of data which are in skipquality (0 if
+        the frame has no QUALFLAG or skipquality is 0)
+    """
+    if not skipquality or 'QUALFLAG' not in data.header:
+        return 0
+    return int(data.getheadval('QUALFLAG')) & int(skipquality)
+
+def qualitytext(flag):
+    """ Returns the descriptions of the bits in flag as text
+    """
+    return ', '.join(QUALITY[bit] for bit in sorted(QUALITY) if flag & bit)
+
+class StepTriage(StepParent):
+    """ Pipeline Step Object to flag frames of bad quality
+    """
+    stepver = '0.1' # pipe step version
+
+    def __init__(self):
+        """ Constructor: Initialize data objects and variables
+        """
+        # call superclass constructor (calls setup)
+        super(StepTriage,self).__init__()
+        # set configuration
+        self.log.debug('Init: done')
+
+    def setup(self):
+        """ ### Names and Parameters need to be Set Here ###
+            Sets the internal names for the function and for saved files.
+            Defines the input parameters for the current pipe step.
+            Setup() is called at the end of __init__
+            The parameters are stored in a list containing the following
+            information:
+            - name: The name for the parameter. This name is used when
+                    calling the pipe step from command line or python shell.
+                    It is also used to identify the parameter in the pipeline
+                    configuration file.
+            - default: A default value for the parameter. If nothing, set
+                       '' for strings, 0 for integers and 0.0 for floats
+            - help: A short description of the parameter.
+        """
+        ### Set Names
+        # Name of the pipeline reduction step
+        self.name='triage'
+        # Shortcut for pipeline reduction step and identifier for
+        # saved file names.
+        self.procname = 'QUAL'
+        # Set Logger for this pipe step
+        self.log = logging.getLogger('pipe.step.%s' % self.name)
+        ### Set Parameter list
+        # Clear Parameter list
+        self.paramlist = []
+        # Append parameters
+        self.paramlist.append(['binning', 2,
+                               'Binning of the image for the quality measures'])
+        self.paramlist.append(['nsigma', 5.0,
+                               'Star detection threshold (in background noise)'])
+        self.paramlist.append(['minstars', 10,
+                               'Minimal number of stars (flag 1)'])
+        self.paramlist.append(['maxbackground', 0.0,
+                               'Maximal background level (flag 2, 0 for no limit)'])
+        self.paramlist.append(['saturation', 0.0,
+                               'Saturation level (0 to not check saturation)'])
+        self.paramlist.append(['maxsaturated', 0.05,
+                               'Maximal fraction of saturated pixels (flag 4)'])
+        self.paramlist.append(['maxfwhm', 0.0,
+                               'Maximal star FWHM (pixels, flag 8, 0 for no limit)'])
+        self.paramlist.append(['maxelongation', 0.0,
+                               'Maximal star elongation (major / minor axis, ' +
+                               'flag 16, 0 for no limit)'])
+        # confirm end of setup
+        self.log.debug('Setup: done')
+
+    def run(self):
+        """ Runs the data reduction algorithm. The self.datain is run
+            through the code, the result is in self.dataout.
+        """
+        stats = framequality(self.datain.image, binning = self.getarg('binning'),
+                             nsigma = self.getarg('nsigma'),
+                             saturation = self.getarg('saturation'))
+        flag = 0
+        if stats['nstars'] < self.getarg('minstars'):
+            flag |= 1
+        if self.getarg('maxbackground') > 0 and stats['background'] > self.getarg('maxbackground'):
+            flag |= 2
+        if self.getarg('saturation') > 0 and stats['saturated'] > self.getarg('maxsaturated'):
+            flag |= 4
+        if self.getarg('maxfwhm') > 0 and stats['fwhm'] > self.getarg('maxfwhm'):
+            flag |= 8
+        if self.getarg('maxelongation') > 0 and stats['elongation'] > self.getarg('maxelongation'):
+            flag |= 16
+        # Store the measures and the flag
+        self.dataout = self.datain.copy()
+        self.dataout.setheadval('QUALFLAG', flag, 'Triage quality flag (0 = good)')
+        self.dataout.setheadval('QUALNSTR', stats['nstars'], 'Triage number of stars')
+        self.dataout.setheadval('QUALBKG', round(stats['background'], 2), 'Triage background level')
+        self.dataout.setheadval('QUALNOIS', round(stats['noise'], 3), 'Triage background noise')
+        self.dataout.setheadval('QUALSAT', round(stats['saturated'], 5),
+                                'Triage saturated pixel fraction')
+        self.dataout.setheadval('QUALFWHM', round(stats['fwhm'], 2), 'Triage star FWHM (pixels)')
+        self.dataout.setheadval('QUALELON', round(stats['elongation'], 2), 'Triage star elongation')
+        if flag:
+            histmsg = 'Triage: quality flag %d - %s' % (flag, qualitytext(flag))
+            self.log.warning(histmsg)
+        else:
+            histmsg = 'Triage: good frame'
+            self.log.info('%s: %d stars, FWHM %.1f pixels' %
+                          (histmsg, stats['nstars'], stats['fwhm']))
+        self.dataout.setheadval('HISTORY', histmsg)
+        self.log.debug('Run: Done')
+
+if __name__ == '__main__':
+    """ Main function to run the pipe step from command line on a file.
+        Command:
+          python stepparent.py input.fits -arg1 -arg2 . . .
+        Standard arguments:
+          --config=ConfigFilePathName.txt : name of the configuration file
+          -t, --test : runs the functionality test i.e. pipestep.test()
+          --loglevel=LEVEL : configures the logging output for a particular level
+          -h, --help : Returns a list of
+    """
+    StepTriage().execute()
+
+""" === History ===
+2026-10-18 First version
+"""
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+""" WCS CACHE - Version 1.0.0
+
+    This module keeps the WCS solutions of solved frames, so frames of
+    targets which are observed again can be solved without a full
+    astrometry search. Solutions are stored in a JSON file under a key
+    made of OBJECT, the telescope pointing (RA/DEC rounded to 'roundto'
+    degrees), XBIN and the camera (DETECTOR). With each solution the sky
+    positions of the brightest stars of the solved frame are stored.
+
+    For a new frame, the closest stored pointing of the same object,
+    binning and camera is used: the stored stars are projected into the
+    frame with the stored WCS and matched with the stars found in the
+    frame (matchoffset). If enough stars match, the stored WCS shifted by
+    the measured offset is used for the frame.
+"""
+
+import os # os library
+import json # to store the solutions
+import time # time library
+import threading # lock for the cache file
+import numpy # numpy library
+from scipy.spatial import cKDTree # to match star positions
+
+# Lock for reading / writing the cache file
+wcscachelock = threading.Lock()
+
+def matchoffset(x, y, refx, refy, searchradius, matchradius = 2.0):
+    """ Finds the shift (dx, dy) which moves the reference positions
+        (refx, refy) onto the positions (x, y). All pair offsets shorter
+        than searchradius are collected, the shift is the offset shared
+        by most pairs (within matchradius). Returns dx, dy, the number of
+        reference stars with a match within matchradius after the shift
+        and the rms distance of the matches (pixels).
+    """
+    if len(x) == 0 or len(refx) == 0:
+        return 0.0, 0.0, 0, 0.0
+    offx = (numpy.asarray(x)[:,None] - numpy.asarray(refx)[None,:]).ravel()
+    offy = (numpy.asarray(y)[:,None] - numpy.asarray(refy)[None,:]).ravel()
+    close = numpy.hypot(offx, offy) < searchradius
+    if not close.any():
+        return 0.0, 0.0, 0, 0.0
+    offsets = numpy.column_stack((offx[close], offy[close]))
+    # Offset with most other offsets nearby
+    tree = cKDTree(offsets)
+    counts = tree.query_ball_point(offsets, matchradius, return_length = True)
+    best = offsets[numpy.argmax(counts)]
+    near = tree.query_ball_point(best, matchradius)
+    dx, dy = numpy.median(offsets[near], axis = 0)
+    # Match the shifted reference stars
+    dist, ind = cKDTree(numpy.column_stack((x, y))).query(
+        numpy.column_stack((numpy.asarray(refx) + dx, numpy.asarray(refy) + dy)))
+    matched = dist < matchradius
+    nmatch = int(matched.sum())
+    rms = float(numpy.sqrt(numpy.mean(dist[matched]**2))) if nmatch else 0.0
+    return float(dx), float(dy), nmatch, rms
+
+class WCSCache(object):
+    """ Store of WCS solutions in a JSON file:
+        {key: {'object', 'ra', 'dec', 'xbin', 'camera', 'shape': [ny, nx],
+               'wcs': {header keyword: value}, 'stars': [[ra, dec], ...],
+               'time': time of solution}}
+    """
+
+    def __init__(self, filename, roundto = 0.1):
+        """ Constructor: set file name and rounding of the pointing
+        """
+        self.filename = os.path.expandvars(filename)
+        self.roundto = roundto
+
+    def key(self, obj, ra, dec, xbin, camera):
+        """ Returns the key for a frame
+        """
+        return '%s|%.4f|%.4f|%s|%s' % (obj, round(ra / self.roundto) * self.roundto,
+                                       round(dec / self.roundto) * self.roundto,
+                                       xbin, camera)
+
+    def read(self):
+        """ Returns the stored solutions
+        """
+        if not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write(self, solutions):
+        """ Writes the solutions to the file
+        """
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(solutions, f)
+        os.replace(tmpname, self.filename)
+
+    def lookup(self, obj, ra, dec, xbin, camera, radius):
+        """ Returns the stored solution for the same object, binning and
+            camera with the closest pointing within radius (degrees).
+            Returns None if there is none.
+        """
+        with wcscachelock:
+            solutions = self.read()
+        best = None
+        bestdist = radius
+        for entry in solutions.values():
+            if ( entry['object'] != obj or entry['xbin'] != str(xbin) or
+                 entry['camera'] != camera ):
+                continue
+            # Angular distance between the pointings
+            dra = (entry['ra'] - ra + 180.) % 360. - 180.
+            dist = numpy.hypot(dra * numpy.cos(numpy.radians(dec)), entry['dec'] - dec)
+            if dist <= bestdist:
+                best = entry
+                bestdist = dist
+        return best
+
+    def store(self, obj, ra, dec, xbin, camera, shape, wcsheader, stars):
+        """ Stores a solution (replaces the solution with the same key)
+            - ra, dec: telescope pointing (degrees)
+            - shape: image shape [ny, nx]
+            - wcsheader: dictionary with the WCS header keywords
+            - stars: list of [ra, dec] of the brightest stars
+        """
+        entry = {'object': obj, 'ra': ra, 'dec': dec, 'xbin': str(xbin),
+                 'camera': camera, 'shape': list(shape), 'wcs': wcsheader,
+                 'stars': stars, 'time': time.time()}
+        with wcscachelock:
+            solutions = self.read()
+            solutions[self.key(obj, ra, dec, xbin, camera)] = entry
+            self.write(solutions)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+""" WCS MATCHING - Version 1.0.0
+
+    This module finds the WCS of a frame from a good first guess (the
+    telescope pointing and the known pixel scale) and a reference
+    catalog, without a blind astrometry search:
+    - initialwcs() makes a TAN WCS from the pointing, scale and rotation
+    - the reference stars are projected into the frame with it and
+      matched with the frame stars by triangle voting (matchtriangles):
+      triangles of the brightest stars are compared by their side ratios
+      (found with a KD-tree), each similar triangle pair votes for its
+      three star pairs. This works for any offset and rotation and for
+      moderate scale errors.
+    - an affine transform is fitted to the voted pairs, all stars are
+      matched with it, and fitwcs() fits a TAN WCS with SIP distortion
+      to the matched stars (refinewcs runs the whole sequence)
+    For frames of the same field, registerstars() finds the transform
+    between the star positions of two frames and transformwcs() derives
+    the WCS of one frame from the WCS of the other.
+"""
+
+import itertools # to make triangles
+import numpy # numpy library
+from scipy.spatial import cKDTree # to match triangles and stars
+from astropy import wcs # WCS object
+from astropy.coordinates import SkyCoord # sky positions for the fit
+from astropy.wcs.utils import fit_wcs_from_points # WCS fit
+import astropy.units as u
+
+def initialwcs(ra, dec, pixscale, width, height, rotation = 0.0, parity = 1):
+    """ Returns a TAN WCS centered on ra, dec (degrees) with pixscale
+        (arcsec/pixel) for an image of width x height pixels. rotation is
+        the angle of north from the +y axis towards east (degrees),
+        parity = 1 is for east to the left of north (-1 flips x).
+    """
+    w = wcs.WCS(naxis = 2)
+    w.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    w.wcs.crval = [ra, dec]
+    w.wcs.crpix = [(width + 1) / 2.0, (height + 1) / 2.0]
+    scale = pixscale / 3600.0
+    rot = numpy.radians(rotation)
+    w.wcs.cd = scale * numpy.array([[-parity * numpy.cos(rot), numpy.sin(rot)],
+                                    [parity * numpy.sin(rot), numpy.cos(rot)]])
+    return w
+
+def triangles(x, y):
+    """ Returns the triangles of the stars x, y as array of star indices
+        (ntri, 3) and their invariants (ntri, 2). The vertices are ordered
+        by the length of the opposite side (longest first), the
+        invariants are the ratios of the two shorter sides to the longest.
+    """
+    tri = numpy.array(list(itertools.combinations(range(len(x)), 3)))
+    if not len(tri):
+        return numpy.zeros((0, 3), int), numpy.zeros((0, 2))
+    px = numpy.asarray(x)[tri]
+    py = numpy.asarray(y)[tri]
+    # Side opposite to each vertex
+    sides = numpy.column_stack([numpy.hypot(px[:,1] - px[:,2], py[:,1] - py[:,2]),
+                                numpy.hypot(px[:,0] - px[:,2], py[:,0] - py[:,2]),
+                                numpy.hypot(px[:,0] - px[:,1], py[:,0] - py[:,1])])
+    order = numpy.argsort(-sides, axis = 1)
+    sides = numpy.take_along_axis(sides, order, axis = 1)
+    tri = numpy.take_along_axis(tri, order, axis = 1)
+    good = sides[:,0] > 0
+    invariants = sides[good,1:] / sides[good,0:1]
+    return tri[good], invariants
+
+def matchtriangles(x, y, refx, refy, nstars = 20, tolerance = 0.01, minvotes = 3):
+    """ Matches the nstars brightest stars x, y with the nstars brightest
+        reference stars refx, refy (both sorted by brightness) by
+        triangle voting. Returns the index arrays (star, reference star)
+        of the pairs with at least minvotes votes which are the best
+        match for each other.
+    """
+    n = min(nstars, len(x))
+    nref = min(nstars, len(refx))
+    if n < 3 or nref < 3:
+        return numpy.zeros(0, int), numpy.zeros(0, int)
+    tri, inv = triangles(x[:n], y[:n])
+    reftri, refinv = triangles(refx[:nref], refy[:nref])
+    # Each pair of similar triangles votes for its three vertex pairs
+    votes = numpy.zeros((n, nref), int)
+    pairs = [(i, j) for i, near in enumerate(cKDTree(refinv).query_ball_point(inv, tolerance))
+             for j in near]
+    if len(pairs):
+        i, j = numpy.array(pairs).T
+        numpy.add.at(votes, (tri[i].ravel(), reftri[j].ravel()), 1)
+    best = numpy.argmax(votes, axis = 1)
+    bestref = numpy.argmax(votes, axis = 0)
+    stars = numpy.arange(n)
+    good = (votes[stars, best] >= minvotes) & (bestref[best] == stars)
+    return stars[good], best[good]
+
+def fitaffine(x, y, refx, refy, clip = 3.0, iterations = 3):
+    """ Fits an affine transform from refx, refy to x, y with outlier
+        rejection (pairs further than clip pixels from the fit are
+        removed). Returns the 2x3 transform matrix and the flag array of
+        the pairs used.
+    """
+    use = numpy.ones(len(x), bool)
+    matrix = None
+    for i in range(iterations):
+        if use.sum() < 3:
+            break
+        design = numpy.column_stack([refx[use], refy[use], numpy.ones(use.sum())])
+        coef, res, rank, sv = numpy.linalg.lstsq(design, numpy.column_stack([x[use], y[use]]),
+                                                 rcond = None)
+        matrix = coef.T
+        tx, ty = applyaffine(matrix, refx, refy)
+        newuse = numpy.hypot(tx - x, ty - y) < clip
+        if (newuse == use).all():
+            break
+        use = newuse
+    return matrix, use
+
+def applyaffine(matrix, x, y):
+    """ Returns the positions x, y transformed by the 2x3 matrix
+    """
+    return ( matrix[0,0] * x + matrix[0,1] * y + matrix[0,2],
+             matrix[1,0] * x + matrix[1,1] * y + matrix[1,2] )
+
+def fitwcs(x, y, ra, dec, center, sipdegree = 2):
+    """ Fits a TAN WCS (with SIP distortion of sipdegree, 0 for none) to
+        the star positions x, y (pixels, starting at 0) and their sky
+        positions ra, dec (degrees). center is the tangent point
+        (SkyCoord). Returns the WCS and the rms residual (pixels).
+    """
+    world = SkyCoord(ra * u.deg, dec * u.deg)
+    if sipdegree > 0:
+        w = fit_wcs_from_points((x, y), world, proj_point = center,
+                                projection = 'TAN', sip_degree = sipdegree)
+    else:
+        w = fit_wcs_from_points((x, y), world, proj_point = center, projection = 'TAN')
+    fx, fy = w.all_world2pix(ra, dec, 0)
+    rms = float(numpy.sqrt(numpy.mean((fx - x)**2 + (fy - y)**2)))
+    return w, rms
+
+def refinewcs(x, y, refra, refdec, guess, nstars = 20, matchradius = 2.0,
+              sipdegree = 2, minmatch = 10):
+    """ Finds the WCS of a frame from the star positions x, y (pixels,
+        starting at 0, brightest first), the reference stars refra, refdec
+        (degrees, brightest first) and the first guess WCS guess.
+        Returns the fitted WCS, the number of matched stars and the rms
+        residual (pixels). Returns None, nmatch, 0 if too few stars match.
+        SIP terms are only fitted with at least 3 * minmatch stars.
+    """
+    x = numpy.asarray(x, float)
+    y = numpy.asarray(y, float)
+    refx, refy = guess.all_world2pix(refra, refdec, 0)
+    # Match the brightest stars by triangle voting
+    stars, refs = matchtriangles(x, y, refx, refy, nstars)
+    if len(stars) < 3:
+        return None, len(stars), 0.0
+    matrix, use = fitaffine(x[stars], y[stars], refx[refs], refy[refs])
+    if matrix is None or use.sum() < 3:
+        return None, int(use.sum()), 0.0
+    # Match all stars with the transform, then with the fitted WCS
+    tx, ty = applyaffine(matrix, refx, refy)
+    center = SkyCoord(guess.wcs.crval[0] * u.deg, guess.wcs.crval[1] * u.deg)
+    w = None
+    rms = 0.0
+    for iteration in range(2):
+        dist, ind = cKDTree(numpy.column_stack((x, y))).query(numpy.column_stack((tx, ty)))
+        matched = dist < matchradius
+        # Keep only the closest reference star for each star
+        order = numpy.argsort(dist)
+        first = numpy.zeros(len(dist), bool)
+        first[order[numpy.unique(ind[order], return_index = True)[1]]] = True
+        matched &= first
+        nmatch = int(matched.sum())
+        if nmatch < minmatch:
+            return None, nmatch, 0.0
+        w, rms = fitwcs(x[ind[matched]], y[ind[matched]], numpy.asarray(refra)[matched],
+                        numpy.asarray(refdec)[matched], center,
+                        sipdegree if nmatch >= 3 * minmatch else 0)
+        tx, ty = w.all_world2pix(refra, refdec, 0)
+    return w, nmatch, rms
+
+def registerstars(x, y, refx, refy, nstars = 20, matchradius = 2.0):
+    """ Finds the affine transform from the pixel positions of frame
+        stars x, y to the reference frame stars refx, refy (both sorted
+        by brightness). Returns the 2x3 transform matrix, the number of
+        matched stars and the rms distance of the matches (pixels).
+        Returns None, nmatch, 0 if fewer than 3 stars match.
+    """
+    x = numpy.asarray(x, float)
+    y = numpy.asarray(y, float)
+    refx = numpy.asarray(refx, float)
+    refy = numpy.asarray(refy, float)
+    refs, stars = matchtriangles(refx, refy, x, y, nstars)
+    if len(stars) < 3:
+        return None, len(stars), 0.0
+    matrix, use = fitaffine(refx[refs], refy[refs], x[stars], y[stars])
+    if matrix is None or use.sum() < 3:
+        return None, int(use.sum()), 0.0
+    # Match all stars with the transform and fit again
+    tree = cKDTree(numpy.column_stack((refx, refy)))
+    for iteration in range(2):
+        tx, ty = applyaffine(matrix, x, y)
+        dist, ind = tree.query(numpy.column_stack((tx, ty)))
+        matched = dist < matchradius
+        if matched.sum() < 3:
+            return None, int(matched.sum()), 0.0
+        matrix, use = fitaffine(refx[ind[matched]], refy[ind[matched]],
+                                x[matched], y[matched], clip = matchradius)
+    tx, ty = applyaffine(matrix, x[matched][use], y[matched][use])
+    rms = float(numpy.sqrt(numpy.mean((tx - refx[ind[matched]][use])**2 +
+                                      (ty - refy[ind[matched]][use])**2)))
+    return matrix, int(use.sum()), rms
+
+def transformwcs(refwcs, matrix, width, height, sipdegree = 2, grid = 10):
+    """ Returns the WCS of a frame of width x height pixels whose pixel
+        positions are transformed to the pixel positions of the reference
+        frame by matrix (see registerstars). The WCS is fitted to a grid
+        of grid x grid points mapped to the sky with refwcs.
+    """
+    gx, gy = numpy.meshgrid(numpy.linspace(0, width - 1, grid),
+                            numpy.linspace(0, height - 1, grid))
+    gx = gx.ravel()
+    gy = gy.ravel()
+    ra, dec = refwcs.all_pix2world(*applyaffine(matrix, gx, gy), 0)
+    center = SkyCoord(*refwcs.all_pix2world(*applyaffine(matrix, (width - 1) / 2.0,
+                                                         (height - 1) / 2.0), 0), unit = 'deg')
+    w, rms = fitwcs(gx, gy, ra, dec, center, sipdegree)
+    return w
+
+def iswcskey(key):
+    """ Returns True if key is a WCS keyword of a celestial solution
+        (projection, reference point, matrix, SIP terms and poles). Time
+        and reference system keywords (DATE-OBS, MJD-OBS, RADESYS ...)
+        are not WCS keywords here, they belong to the frame.
+    """
+    return key in ['WCSAXES', 'LONPOLE', 'LATPOLE'] or \
+           key[:5] in ['CTYPE', 'CRVAL', 'CRPIX', 'CUNIT', 'CDELT', 'CROTA'] or \
+           ( key[:2] in ['CD', 'PC'] and key[2:3].isdigit() ) or \
+           key[:2] in ['A_', 'B_'] or key[:3] in ['AP_', 'BP_']
+
+def setwcs(header, w):
+    """ Writes the WCS keywords of w into the FITS header. WCS keywords
+        of another form (CD or PC matrix, SIP terms) are removed first.
+    """
+    for key in list(header.keys()):
+        if iswcskey(key):
+            del header[key]
+    wcsheader = w.to_header(relax = True)
+    for key in wcsheader:
+        if iswcskey(key):
+            header[key] = (wcsheader[key], wcsheader.comments[key])
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+""" WORKING DATA TYPE - Version 1.0.0
+
+    This module gives the data type used by the pipe steps for image
+    arithmetic. It is set with workdtype in the [data] section of the
+    pipeline configuration (default float32):
+        [data]
+            workdtype = float32
+    Images are converted to this type before they are processed. Pipe
+    steps still accumulate in float64 where a reduction needs it (sums,
+    averages, standard deviations, combines).
+"""
+
+import numpy # numpy library
+
+DEFAULTDTYPE = 'float32' # default working data type
+
+def workdtype(config):
+    """ Returns the working data type (numpy.dtype) from the [data]
+        section of config
+    """
+    try:
+        name = config['data']['workdtype']
+    except (KeyError, TypeError):
+        name = DEFAULTDTYPE
+    return numpy.dtype(name)
+
+def asworkdtype(array, config):
+    """ Returns array converted to the working data type. The array is
+        returned without copy if it has the correct type already.
+    """
+    return numpy.asarray(array).astype(workdtype(config), copy = False)